@@ -19,11 +19,13 @@
 
 Пример использования:
     python3 bot.py
+    python3 bot.py --rebuild-ratings   # пересчитать рейтинги всех пользователей при старте
 
 Требования:
     - Файл .env с токеном TELEGRAM_BOT_TOKEN или BOT_TOKEN
     - База данных SQLite (создается автоматически)
 """
+import argparse
 import asyncio
 import logging
 import os
@@ -36,19 +38,39 @@ from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 
 # Импортируем конфигурацию
-from config import APP_ROOT
+from config import APP_ROOT, FSM_STORAGE
 
 # Импортируем главный роутер со всеми обработчиками
 from обработчики import router
 
 
-async def main() -> None:
+def parse_args() -> argparse.Namespace:
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Kali Linux Academy Bot")
+    parser.add_argument(
+        "--rebuild-ratings",
+        action="store_true",
+        help=(
+            "Пересчитать рейтинги всех пользователей при старте с нуля "
+            "(нужно только после ручных правок БД: в обычной работе счётчики "
+            "обновляются в тех же транзакциях, что и прогресс/тесты)"
+        ),
+    )
+    # Прежний флаг: пересчёт при старте теперь и так выключен по умолчанию
+    parser.add_argument("--skip-rating-rebuild", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+async def main(rebuild_ratings: bool = False) -> None:
     """
     Основная функция запуска бота
     
     Эта функция выполняет всю инициализацию и запускает бота.
     Все ошибки логируются и приводят к остановке программы.
     
+    Args:
+        rebuild_ratings: Пересчитать рейтинги всех пользователей при старте
+    
     Шаги выполнения:
     1. Настройка логирования для отслеживания работы бота
     2. Загрузка токена из переменных окружения
@@ -91,8 +113,11 @@ async def main() -> None:
 
     # ===== СОЗДАНИЕ ДИСПЕТЧЕРА =====
     # Dispatcher - это центральный объект, который маршрутизирует все обновления
-    # MemoryStorage - хранилище состояний в памяти (FSM для aiogram)
-    dp = Dispatcher(storage=MemoryStorage())
+    # Состояния диалогов (FSM для aiogram) хранятся в таблице fsm_states и
+    # переживают перезапуск; FSM_STORAGE=memory - прежнее хранение в памяти
+    from утилиты.fsm_storage import fsm_storage
+    storage = MemoryStorage() if FSM_STORAGE == "memory" else fsm_storage
+    dp = Dispatcher(storage=storage)
     
     # Подключаем главный роутер, который включает все обработчики:
     # - commands.py - команды (/start, /leaderboard, и т.д.)
@@ -119,13 +144,24 @@ async def main() -> None:
 
         # ===== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ =====
         # База данных создаётся автоматически при первом подключении
+        from утилиты.activity_buffer import activity
         from утилиты.database import db
+        from утилиты.async_database import async_db
+        from утилиты.auth import admin_acl
+        from утилиты.history_retention import history_retention
+        from утилиты.openrouter import openrouter
+        from утилиты.test_sessions import test_sessions
+        from утилиты.wal_checkpoint import wal_checkpointer
+        from обработчики.ai import summary_scheduler
         # Добавляем дефолтные материалы/тесты, если отсутствуют
         db.seed_default_content()
-        materials = db.get_all_materials()
-        # Обновляем рейтинги всех пользователей при запуске
-        db.update_all_ratings()
-        logging.info(f"База данных готова: {len(materials)} материалов в базе")
+        materials = db.get_materials_catalog()
+        # Счётчики рейтинга (user_stats) обновляются в тех же транзакциях, что
+        # прогресс и тесты, и сами не расходятся; полный пересчёт одним запросом -
+        # только по --rebuild-ratings (например, после ручных правок БД)
+        if rebuild_ratings:
+            db.update_all_ratings()
+        logging.info(f"База данных готова: {len(materials)} материалов в базе (профиль {db.profile})")
 
         # ===== ЗАПУСК POLLING =====
         # start_polling начинает бесконечный цикл получения обновлений от Telegram
@@ -133,7 +169,34 @@ async def main() -> None:
         # dp.resolve_used_update_types() автоматически определит нужные типы
         # на основе зарегистрированных обработчиков
         logging.info("Бот готов к работе! Ожидание сообщений...")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        # Фоновый перенос старой истории ИИ в архив
+        history_retention.start()
+        # Пакетная запись времени активности пользователей
+        activity.start()
+        # Перечитывание ADMIN_IDS при изменении .env или по SIGHUP
+        admin_acl.start()
+        # Удаление брошенных незавершённых тестов
+        test_sessions.start_purging()
+        # Фоновый перенос WAL-журнала в основной файл БД
+        wal_checkpointer.start()
+        # Пакетная запись состояний диалогов и удаление брошенных
+        if storage is fsm_storage:
+            fsm_storage.start()
+        try:
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        finally:
+            await history_retention.close()
+            await admin_acl.close()
+            await test_sessions.close()
+            # Записываем накопленную активность и состояния диалогов до закрытия БД
+            await activity.close()
+            await fsm_storage.close()
+            await wal_checkpointer.close()
+            # Дожидаемся начатых summary и закрываем пул HTTP-соединений к OpenRouter
+            await summary_scheduler.close()
+            await openrouter.close()
+            # Дожидаемся фоновых операций с БД и закрываем подключения
+            await async_db.close()
 
 
 # ===== ТОЧКА ВХОДА =====
@@ -143,7 +206,8 @@ if __name__ == "__main__":
     try:
         # asyncio.run() создаёт event loop и запускает async функцию main()
         # После завершения main() event loop автоматически закрывается
-        asyncio.run(main())
+        args = parse_args()
+        asyncio.run(main(rebuild_ratings=args.rebuild_ratings))
     except (KeyboardInterrupt, SystemExit):
         # Корректная обработка остановки (Ctrl+C или системный сигнал)
         # Просто выходим без ошибок
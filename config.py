@@ -1,9 +1,168 @@
 """
 Конфигурация приложения
 
-
+Все настройки можно переопределить через переменные окружения или .env
 """
+import os
 from pathlib import Path
 
+from dotenv import load_dotenv
+
 # APP_ROOT: абсолютный путь к корневой директории проекта
 APP_ROOT = Path(__file__).resolve().parent
+
+# Подгружаем .env заранее, чтобы настройки ниже видели значения из файла
+load_dotenv(dotenv_path=APP_ROOT / ".env", override=False)
+
+# ===== БАЗА ДАННЫХ =====
+# Число потоков для запросов на чтение в асинхронном фасаде БД
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "4"))
+# Максимальное число открытых подключений к SQLite в пуле
+# (по умолчанию: читатели + один поток-писатель)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(DB_READER_THREADS + 1)))
+# Сколько секунд ждать свободное подключение, прежде чем выдать ошибку
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Профиль хранения: "wal" (WAL-журнал, synchronous=NORMAL, mmap, кэш страниц)
+# или "legacy" (настройки SQLite по умолчанию: rollback-журнал, synchronous=FULL)
+DB_PROFILE = os.getenv("DB_PROFILE", "wal").strip().lower()
+# Сколько байт файла БД отображать в память (профиль wal)
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Кэш страниц на подключение, КиБ (профиль wal)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+# Сколько миллисекунд ждать снятия блокировки записи, прежде чем выдать ошибку
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Как часто переносить WAL-журнал в основной файл, секунд (0 - только автоматически)
+DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", "300"))
+# Как часто записывать накопленное время активности пользователей, секунд
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+# При скольких пользователях в буфере активности записать его досрочно
+ACTIVITY_BUFFER_MAX = int(os.getenv("ACTIVITY_BUFFER_MAX", "5000"))
+
+# ===== КЭШИ =====
+# Максимальная "несвежесть" закэшированного ТОПа рейтинга, секунд
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", "10"))
+# Сколько материалов хранить в кэше отформатированных страниц
+MATERIAL_CACHE_SIZE = int(os.getenv("MATERIAL_CACHE_SIZE", "256"))
+# Через сколько секунд перечитывать материал из БД, даже без инвалидации
+# (изменения, сделанные другим процессом бота, станут видны не позже)
+MATERIAL_CACHE_TTL = float(os.getenv("MATERIAL_CACHE_TTL", "300"))
+# Сколько учеников держать в кэше контекста для /ask и сколько секунд он живёт
+USER_CONTEXT_CACHE_SIZE = int(os.getenv("USER_CONTEXT_CACHE_SIZE", "1024"))
+USER_CONTEXT_CACHE_TTL = float(os.getenv("USER_CONTEXT_CACHE_TTL", "600"))
+# Сколько профилей пользователей держать в памяти для middleware и сколько секунд
+# (регистрация в этом процессе сбрасывает запись сразу, TTL - для других процессов)
+USER_PROFILE_CACHE_SIZE = int(os.getenv("USER_PROFILE_CACHE_SIZE", "10000"))
+USER_PROFILE_CACHE_TTL = float(os.getenv("USER_PROFILE_CACHE_TTL", "300"))
+
+# ===== ТЕСТЫ =====
+# Через сколько секунд без ответов незавершённый тест удаляется
+TEST_SESSION_TTL = float(os.getenv("TEST_SESSION_TTL", str(6 * 3600)))
+# Сколько незавершённых тестов держать в памяти (остальные читаются из БД)
+TEST_SESSION_CACHE_SIZE = int(os.getenv("TEST_SESSION_CACHE_SIZE", "10000"))
+# Как часто удалять просроченные тесты, секунд
+TEST_SESSION_PURGE_INTERVAL = float(os.getenv("TEST_SESSION_PURGE_INTERVAL", "600"))
+# Сколько определений тестов (вопросы материала) держать в памяти
+TEST_DEFINITION_CACHE_SIZE = int(os.getenv("TEST_DEFINITION_CACHE_SIZE", "256"))
+
+# ===== СОСТОЯНИЯ ДИАЛОГОВ (FSM) =====
+# Где хранить состояния диалогов: "sqlite" (таблица fsm_states, переживают
+# перезапуск) или "memory" (как раньше, теряются при перезапуске)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+# Через сколько секунд без действий незавершённый диалог забывается
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(24 * 3600)))
+# Как часто записывать накопленные изменения в БД, секунд
+# (0 - писать сразу; нужно, если несколько копий бота работают с одной БД)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+# Сколько состояний держать в памяти (0 - всегда читать из БД; нужно для
+# нескольких копий бота) и сколько секунд им доверять
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "60"))
+# Как часто удалять просроченные состояния из БД, секунд
+FSM_PURGE_INTERVAL = float(os.getenv("FSM_PURGE_INTERVAL", "600"))
+
+# ===== ДОСТУП АДМИНИСТРАТОРОВ =====
+# Как часто проверять, не изменился ли .env (ADMIN_IDS), секунд;
+# перечитать сразу можно сигналом SIGHUP
+ADMIN_ACL_RELOAD_INTERVAL = float(os.getenv("ADMIN_ACL_RELOAD_INTERVAL", "5"))
+# Учитывать ли таблицу admins (роли moderator/admin/owner) вдобавок к ADMIN_IDS
+ADMIN_ACL_USE_DB = os.getenv("ADMIN_ACL_USE_DB", "0").lower() in ("1", "true", "yes")
+
+# ===== OPENROUTER (ИИ-НАСТАВНИК) =====
+# Базовый URL API (можно указать локальную заглушку для тестов)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+# Модель по умолчанию для /ask и summary
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o-mini")
+# Полный таймаут запроса и таймаут установки соединения, секунд
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", "30"))
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "10"))
+# Лимиты пула HTTP-соединений: всего и на один хост
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "100"))
+OPENROUTER_MAX_PER_HOST = int(os.getenv("OPENROUTER_MAX_PER_HOST", "32"))
+# Сколько секунд держать простаивающее соединение открытым (keep-alive)
+OPENROUTER_KEEPALIVE = float(os.getenv("OPENROUTER_KEEPALIVE", "60"))
+# Повторы при 429/5xx: число попыток сверх первой, базовая и максимальная пауза, секунд
+# (Retry-After от сервера учитывается; если он больше максимума - не ждём)
+OPENROUTER_MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "3"))
+OPENROUTER_RETRY_BASE_DELAY = float(os.getenv("OPENROUTER_RETRY_BASE_DELAY", "1.0"))
+OPENROUTER_RETRY_MAX_DELAY = float(os.getenv("OPENROUTER_RETRY_MAX_DELAY", "20"))
+
+# ===== ОЧЕРЕДЬ /ask =====
+# Одновременных запросов к модели на весь бот
+ASK_MAX_CONCURRENT = int(os.getenv("ASK_MAX_CONCURRENT", "8"))
+# Запросов одного пользователя (в работе + в очереди)
+ASK_PER_USER = int(os.getenv("ASK_PER_USER", "1"))
+# Мест в очереди ожидания и сколько секунд можно в ней провести
+ASK_QUEUE_SIZE = int(os.getenv("ASK_QUEUE_SIZE", "50"))
+ASK_QUEUE_TIMEOUT = float(os.getenv("ASK_QUEUE_TIMEOUT", "120"))
+
+# ===== ПРОМПТ /ask =====
+# Бюджет токенов на вход модели (персона + контекст + история + вопрос)
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", "3000"))
+# Максимум токенов на одно сообщение истории (длинные ответы укорачиваются)
+AI_HISTORY_MESSAGE_TOKENS = int(os.getenv("AI_HISTORY_MESSAGE_TOKENS", "400"))
+# Сколько последних сообщений истории рассматривать для промпта
+AI_HISTORY_MESSAGES = int(os.getenv("AI_HISTORY_MESSAGES", "6"))
+
+# ===== SUMMARY ДИАЛОГА С ИИ =====
+# Сколько новых сообщений в истории запускают обновление summary
+AI_SUMMARY_EVERY_MESSAGES = int(os.getenv("AI_SUMMARY_EVERY_MESSAGES", "8"))
+# Через сколько секунд после первого нового сообщения обновить summary,
+# даже если порог сообщений не набран
+AI_SUMMARY_DELAY = float(os.getenv("AI_SUMMARY_DELAY", "300"))
+# Максимум одновременных запросов summary к модели
+AI_SUMMARY_CONCURRENCY = int(os.getenv("AI_SUMMARY_CONCURRENCY", "2"))
+
+# ===== ХРАНЕНИЕ ИСТОРИИ ДИАЛОГА С ИИ =====
+# Сколько последних сообщений пользователя всегда остаются в ai_history
+AI_HISTORY_KEEP_LAST = int(os.getenv("AI_HISTORY_KEEP_LAST", "20"))
+# Жёсткий предел: более старые сообщения уходят в архив, даже если
+# summary их ещё не учёл
+AI_HISTORY_HARD_CAP = int(os.getenv("AI_HISTORY_HARD_CAP", "200"))
+# Максимум сообщений, переносимых в архив за одну транзакцию
+AI_HISTORY_ARCHIVE_BATCH = int(os.getenv("AI_HISTORY_ARCHIVE_BATCH", "500"))
+# Как часто запускать перенос в архив, секунд (0 - не запускать)
+AI_HISTORY_RETENTION_INTERVAL = float(os.getenv("AI_HISTORY_RETENTION_INTERVAL", "600"))
+
+# ===== ПОТОКОВЫЕ ОТВЕТЫ ИИ =====
+# Отдавать ответ /ask потоком, дописывая одно сообщение по мере генерации
+AI_STREAMING = os.getenv("AI_STREAMING", "1").lower() in ("1", "true", "yes")
+# Минимальный интервал между правками сообщения при потоковом ответе, секунд
+# (Telegram ограничивает частоту edit_text)
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.0"))
+
+# ===== КЭШ ОТВЕТОВ ИИ =====
+# Отдавать сохранённый ответ на повторяющийся вопрос /ask без запроса к модели
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+# Сколько секунд ответ считается актуальным (по умолчанию неделя)
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600)))
+# Максимум ответов в кэше; лишние вытесняются по давности использования
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "5000"))
+# Общий ответ из кэша - только если ученик не писал /ask столько секунд
+# (иначе вопрос может продолжать разговор и нужен полный контекст)
+AI_CACHE_DIALOG_GAP = float(os.getenv("AI_CACHE_DIALOG_GAP", "1800"))
+# Кэшировать только вопросы не длиннее (символов)
+AI_CACHE_MAX_PROMPT_LENGTH = int(os.getenv("AI_CACHE_MAX_PROMPT_LENGTH", "300"))
+# Искать похожие формулировки (MinHash/LSH), а не только точные совпадения
+AI_CACHE_SIMILAR = os.getenv("AI_CACHE_SIMILAR", "0").lower() in ("1", "true", "yes")
+# Минимальная похожесть формулировок (коэффициент Жаккара по шинглам)
+AI_CACHE_SIMILARITY = float(os.getenv("AI_CACHE_SIMILARITY", "0.8"))
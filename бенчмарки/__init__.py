@@ -0,0 +1 @@
+"""Бенчмарки производительности (запуск: python3 -m бенчмарки.<имя>)"""
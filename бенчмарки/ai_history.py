@@ -0,0 +1,127 @@
+"""
+Бенчмарк: задержка get_ai_history от размера таблицы ai_history
+
+Для каждого размера создаётся временная БД: сообщения равномерно
+распределены по пользователям (--per-user на человека), у всех есть
+summary, покрывающий всю историю. Замеряются:
+- get_ai_history(limit=6): обратный обход индекса (user_id, id);
+- для сравнения - прежний запрос ORDER BY created_at DESC по индексу
+  (user_id, created_at DESC) со строковыми датами;
+- перенос в архив: число пачек, самая долгая пачка (столько держится
+  блокировка записи) и get_ai_history после уменьшения таблицы.
+
+Запуск:
+    python3 -m бенчмарки.ai_history --sizes 100000 1000000
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from утилиты.database import Database
+
+LEGACY_INDEX_SQL = "CREATE INDEX idx_ai_history_legacy ON ai_history(user_id, created_at DESC)"
+LEGACY_HISTORY_SQL = """
+    SELECT role, content, created_at
+    FROM ai_history
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
+
+
+def populate(database: Database, rows: int, per_user: int) -> int:
+    """Заполняет ai_history и ai_summaries, возвращает число пользователей"""
+    users = max(1, rows // per_user)
+    started = datetime(2024, 1, 1)
+    batch = 50_000
+    with database._get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, name, age, country, city) VALUES (?, ?, 20, 'RU', 'Москва')",
+            ((uid, f"user{uid}") for uid in range(1, users + 1)),
+        )
+        for offset in range(0, rows, batch):
+            conn.executemany(
+                "INSERT INTO ai_history (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (
+                    (i % users + 1, "user" if i % 2 else "assistant",
+                     f"Сообщение {i}: как работает nmap -sV против порта {i % 65535}?" * 3,
+                     (started + timedelta(seconds=i)).isoformat())
+                    for i in range(offset, min(offset + batch, rows))
+                ),
+            )
+        conn.executemany(
+            "INSERT INTO ai_summaries (user_id, summary_text, updated_at) VALUES (?, ?, ?)",
+            ((uid, "summary", (started + timedelta(seconds=rows)).isoformat())
+             for uid in range(1, users + 1)),
+        )
+    return users
+
+
+def measure(func: Callable[[], object], repeats: int) -> Dict[str, float]:
+    """Среднее и p95 времени вызова в миллисекундах"""
+    timings: List[float] = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {"mean": statistics.mean(timings), "p95": timings[max(0, int(len(timings) * 0.95) - 1)]}
+
+
+def legacy_history(database: Database, user_id: int) -> None:
+    with database._get_connection() as conn:
+        conn.execute(LEGACY_HISTORY_SQL, (user_id, 6)).fetchall()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--per-user", type=int, default=200, help="Сообщений на пользователя")
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--keep-last", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    print(
+        f"{'строк':>10}{'история, мс':>13}{'p95':>8}{'прежняя, мс':>13}{'p95':>8}"
+        f"{'пачек':>8}{'макс. пачка, мс':>17}{'после, мс':>11}{'строк после':>13}"
+    )
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            database = Database(Path(tmp) / "bench.db")
+            users = populate(database, size, args.per_user)
+            rng = random.Random(size)
+
+            current = measure(lambda: database.get_ai_history(rng.randint(1, users), 6), args.repeats)
+            with database._get_connection() as conn:
+                conn.execute(LEGACY_INDEX_SQL)
+            legacy = measure(lambda: legacy_history(database, rng.randint(1, users)), args.repeats)
+            with database._get_connection() as conn:
+                conn.execute("DROP INDEX idx_ai_history_legacy")
+
+            batches, batch_max, after_user_id = 0, 0.0, 0
+            while after_user_id is not None:
+                started = time.perf_counter()
+                _, after_user_id = database.archive_ai_history(
+                    args.keep_last, args.keep_last * 10, args.batch, after_user_id
+                )
+                batch_max = max(batch_max, (time.perf_counter() - started) * 1000)
+                batches += 1
+            after = measure(lambda: database.get_ai_history(rng.randint(1, users), 6), args.repeats)
+            remaining = database.ai_history_stats()["hot_rows"]
+            database.close()
+
+        print(
+            f"{size:>10}{current['mean']:>13.3f}{current['p95']:>8.3f}"
+            f"{legacy['mean']:>13.3f}{legacy['p95']:>8.3f}"
+            f"{batches:>8}{batch_max:>17.1f}{after['mean']:>11.3f}{remaining:>13}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Бенчмарк: задержка event loop при конкурентных callback'ах
+
+Сравнивает прямые синхронные вызовы Database внутри корутин
+с асинхронным фасадом AsyncDatabase. Пока идёт нагрузка, отдельная
+корутина-пробник спит по 5 мс и замеряет, насколько позже она проснулась.
+Эта задержка и есть время, на которое "замирает" polling для всех пользователей.
+
+Запуск:
+    python3 -m бенчмарки.event_loop_lag --callbacks 300 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from утилиты.async_database import AsyncDatabase
+from утилиты.database import Database
+
+PROBE_INTERVAL = 0.005
+
+
+def prepare_database(path: Path, users: int) -> Database:
+    """Создаёт временную БД с пользователями и материалами"""
+    database = Database(path)
+    database.seed_default_content()
+    for user_id in range(1, users + 1):
+        database.register_user(user_id, f"user{user_id}", 20, "RU", "Москва")
+    return database
+
+
+async def probe_lag(stop: asyncio.Event, samples: List[float]) -> None:
+    """Замеряет опоздание пробуждения event loop"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        samples.append(max(0.0, loop.time() - started - PROBE_INTERVAL))
+
+
+async def simulated_callback(database, user_id: int, material_id: int, is_async: bool) -> None:
+    """Типичный набор запросов одного нажатия кнопки + запись результата теста"""
+    async def call(name: str, *args):
+        result = getattr(database, name)(*args)
+        return await result if is_async else result
+
+    await call("is_user_registered", user_id)
+    await call("update_user_activity", user_id)
+    await call("get_material", material_id)
+    await call("get_questions_for_material", material_id)
+    await call("save_test_result", user_id, material_id, 2, 2, 100.0)
+
+
+async def run_scenario(database, material_ids: List[int], users: int, callbacks: int,
+                       concurrency: int, is_async: bool) -> Dict[str, float]:
+    """Запускает callbacks с ограниченной параллельностью и собирает задержки"""
+    samples: List[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_lag(stop, samples))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(i: int) -> None:
+        async with semaphore:
+            await simulated_callback(
+                database, i % users + 1, material_ids[i % len(material_ids)], is_async
+            )
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(callbacks)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+
+    samples.sort()
+    return {
+        "elapsed_s": elapsed,
+        "lag_max_ms": samples[-1] * 1000 if samples else 0.0,
+        "lag_p99_ms": samples[int(len(samples) * 0.99) - 1] * 1000 if samples else 0.0,
+        "lag_mean_ms": statistics.mean(samples) * 1000 if samples else 0.0,
+        "probes": len(samples),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--callbacks", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = prepare_database(Path(tmp) / "bench.db", args.users)
+        material_ids = [m["id"] for m in database.get_all_materials()]
+
+        sync_result = await run_scenario(
+            database, material_ids, args.users, args.callbacks, args.concurrency, is_async=False
+        )
+        async_database = AsyncDatabase(database)
+        async_result = await run_scenario(
+            async_database, material_ids, args.users, args.callbacks, args.concurrency, is_async=True
+        )
+        await async_database.close()
+
+    print(f"callbacks={args.callbacks} concurrency={args.concurrency} users={args.users}")
+    print(f"{'режим':<12}{'время, с':>10}{'лаг max, мс':>14}{'лаг p99, мс':>14}{'лаг ср., мс':>14}{'проб':>8}")
+    for name, result in (("sync", sync_result), ("async", async_result)):
+        print(
+            f"{name:<12}{result['elapsed_s']:>10.2f}{result['lag_max_ms']:>14.1f}"
+            f"{result['lag_p99_ms']:>14.1f}{result['lag_mean_ms']:>14.2f}{result['probes']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
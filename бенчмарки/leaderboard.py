@@ -0,0 +1,108 @@
+"""
+Бенчмарк: задержка рейтинга (ТОП-10 и место пользователя) от числа пользователей
+
+Для каждого размера создаётся временная БД с синтетическими пользователями:
+по 2 изученных материала и 1 результату теста на человека. Замеряются:
+- get_leaderboard(10) и get_user_rank() по сводной таблице user_stats;
+- для сравнения (до --legacy-max пользователей) - прежний запрос с JOIN
+  users × user_progress × test_results и COUNT(DISTINCT ...).
+
+Запуск:
+    python3 -m бенчмарки.leaderboard --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from утилиты.database import Database
+
+LEGACY_LEADERBOARD_SQL = """
+    SELECT u.user_id, u.name, u.age, u.country, u.city, s.score,
+           COUNT(DISTINCT up.material_id) as materials_studied,
+           COUNT(DISTINCT tr.id) as tests_completed
+    FROM users u
+    LEFT JOIN user_stats s ON u.user_id = s.user_id
+    LEFT JOIN user_progress up ON u.user_id = up.user_id
+    LEFT JOIN test_results tr ON u.user_id = tr.user_id
+    GROUP BY u.user_id, u.name, u.age, u.country, u.city, s.score
+    ORDER BY s.score DESC
+    LIMIT 10
+"""
+
+
+def populate(database: Database, users: int) -> None:
+    """Массово заполняет БД синтетическими пользователями"""
+    database.seed_default_content()
+    material_ids = [m["id"] for m in database.get_all_materials()]
+    rng = random.Random(42)
+    batch = 50_000
+    with database._get_connection() as conn:
+        for start in range(1, users + 1, batch):
+            ids = range(start, min(start + batch, users + 1))
+            conn.executemany(
+                "INSERT INTO users (user_id, name, age, country, city) VALUES (?, ?, 20, 'RU', 'Москва')",
+                ((i, f"user{i}") for i in ids),
+            )
+            conn.executemany(
+                "INSERT INTO user_progress (user_id, material_id) VALUES (?, ?)",
+                ((i, m) for i in ids for m in rng.sample(material_ids, 2)),
+            )
+            conn.executemany(
+                "INSERT INTO test_results (user_id, material_id, correct, total, percentage) "
+                "VALUES (?, ?, 1, 2, ?)",
+                ((i, material_ids[0], rng.uniform(0, 100)) for i in ids),
+            )
+        conn.commit()
+    database.update_all_ratings()
+
+
+def measure(func: Callable[[], object], repeats: int) -> Dict[str, float]:
+    """Среднее и p95 времени вызова в миллисекундах"""
+    timings: List[float] = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {"mean": statistics.mean(timings), "p95": timings[max(0, int(len(timings) * 0.95) - 1)]}
+
+
+def legacy_leaderboard(database: Database) -> None:
+    with database._get_connection() as conn:
+        conn.execute(LEGACY_LEADERBOARD_SQL).fetchall()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--legacy-max", type=int, default=100_000,
+                        help="Максимальный размер, для которого замерять прежний JOIN-запрос")
+    args = parser.parse_args()
+
+    print(f"{'пользователей':>14}{'ТОП-10, мс':>14}{'p95':>9}{'место, мс':>13}{'p95':>9}{'JOIN ТОП-10, мс':>18}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            database = Database(Path(tmp) / "bench.db")
+            populate(database, size)
+            rng = random.Random(size)
+
+            top = measure(lambda: database.get_leaderboard(limit=10), args.repeats)
+            rank = measure(lambda: database.get_user_rank(rng.randint(1, size)), args.repeats)
+            legacy = "-"
+            if size <= args.legacy_max:
+                legacy = f"{measure(lambda: legacy_leaderboard(database), 3)['mean']:.1f}"
+            database.close()
+
+        print(
+            f"{size:>14}{top['mean']:>14.3f}{top['p95']:>9.3f}"
+            f"{rank['mean']:>13.3f}{rank['p95']:>9.3f}{legacy:>18}"
+        )
+
+
+if __name__ == "__main__":
+    main()
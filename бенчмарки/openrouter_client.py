@@ -0,0 +1,110 @@
+"""
+Бенчмарк: конкурентные /ask против локальной заглушки OpenRouter
+
+Поднимает на 127.0.0.1 aiohttp-сервер, который отвечает как
+/chat/completions с искусственной задержкой, и сравнивает:
+- новую ClientSession на каждый запрос (новое соединение каждый раз)
+- общий OpenRouterClient с пулом keep-alive соединений
+
+Параллельно пробник замеряет задержку event loop: при синхронном
+requests.post она была бы равна времени ответа модели.
+
+Запуск:
+    python3 -m бенчмарки.openrouter_client --requests 200 --concurrency 50 --delay 0.2
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List, Set
+
+import aiohttp
+from aiohttp import web
+
+from утилиты.openrouter import OpenRouterClient
+from .event_loop_lag import probe_lag
+
+MESSAGES = [{"role": "user", "content": "Как посмотреть открытые порты?"}]
+
+
+async def start_stub(delay: float, peers: Set[int]) -> web.AppRunner:
+    """Запускает заглушку chat completions и запоминает порты клиентов"""
+    async def completions(request: web.Request) -> web.Response:
+        peers.add(request.transport.get_extra_info("peername")[1])
+        await request.json()
+        await asyncio.sleep(delay)
+        return web.json_response({"choices": [{"message": {"content": "netstat -tulpn"}}]})
+
+    app = web.Application()
+    app.router.add_post("/api/v1/chat/completions", completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+async def run_scenario(base_url: str, requests: int, concurrency: int,
+                       shared: bool, peers: Set[int]) -> Dict[str, float]:
+    """Выполняет запросы с ограниченной параллельностью и собирает метрики"""
+    peers.clear()
+    samples: List[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_lag(stop, samples))
+    semaphore = asyncio.Semaphore(concurrency)
+    client = OpenRouterClient(base_url=base_url, max_per_host=concurrency)
+
+    async def one_request() -> None:
+        async with semaphore:
+            if shared:
+                await client.chat("bench-key", MESSAGES)
+                return
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    f"{base_url}/chat/completions",
+                    json={"model": "bench", "messages": MESSAGES},
+                    headers={"Authorization": "Bearer bench-key"},
+                ) as response:
+                    await response.json()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    await client.close()
+    stop.set()
+    await probe
+
+    return {
+        "elapsed_s": elapsed,
+        "rps": requests / elapsed,
+        "connections": len(peers),
+        "lag_max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.2, help="задержка ответа заглушки, с")
+    args = parser.parse_args()
+
+    peers: Set[int] = set()
+    runner = await start_stub(args.delay, peers)
+    port = runner.addresses[0][1]
+    base_url = f"http://127.0.0.1:{port}/api/v1"
+    try:
+        per_request = await run_scenario(base_url, args.requests, args.concurrency, False, peers)
+        shared = await run_scenario(base_url, args.requests, args.concurrency, True, peers)
+    finally:
+        await runner.cleanup()
+
+    print(f"requests={args.requests} concurrency={args.concurrency} delay={args.delay}s")
+    print(f"{'режим':<20}{'время, с':>10}{'запр./с':>10}{'соединений':>12}{'лаг max, мс':>14}")
+    for name, result in (("сессия на запрос", per_request), ("общий клиент", shared)):
+        print(
+            f"{name:<20}{result['elapsed_s']:>10.2f}{result['rps']:>10.1f}"
+            f"{result['connections']:>12}{result['lag_max_ms']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""
+Бенчмарк: профили хранения БД (wal vs legacy) на смешанной нагрузке
+
+Для каждого профиля создаётся временная БД с пользователями и материалами,
+затем через AsyncDatabase (поток-писатель + пул читателей) конкурентно
+выполняются "обработчики": проверка регистрации, update_user_activity,
+чтение материала и места в рейтинге, каждый --test-every-й - сохранение
+результата теста. Замеряются пропускная способность, задержка чтений
+и записей (p50/p95) и ошибки "database is locked".
+
+Запуск:
+    python3 -m бенчмарки.storage_profile --handlers 5000 --concurrency 50
+"""
+import argparse
+import asyncio
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from утилиты.async_database import AsyncDatabase
+from утилиты.database import STORAGE_PROFILES, Database
+
+
+def prepare_database(path: Path, profile: str, users: int) -> Database:
+    """Создаёт временную БД профиля с пользователями и материалами"""
+    database = Database(path, profile=profile)
+    database.seed_default_content()
+    with database._get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, name, age, country, city) VALUES (?, ?, 20, 'RU', 'Москва')",
+            ((i, f"user{i}") for i in range(1, users + 1)),
+        )
+    database.update_all_ratings()
+    return database
+
+
+def percentile(samples: List[float], share: float) -> float:
+    samples = sorted(samples)
+    return samples[max(0, int(len(samples) * share) - 1)] if samples else 0.0
+
+
+async def run_profile(database: Database, users: int, handlers: int, concurrency: int,
+                      test_every: int) -> Dict[str, float]:
+    """Запускает handlers "обработчиков" с ограниченной параллельностью"""
+    async_db = AsyncDatabase(database)
+    material_ids = [m["id"] for m in database.get_materials_catalog()]
+    rng = random.Random(7)
+    reads: List[float] = []
+    writes: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(samples: List[float], name: str, *args) -> None:
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            await getattr(async_db, name)(*args)
+        except sqlite3.OperationalError:
+            errors += 1
+        samples.append((time.perf_counter() - started) * 1000)
+
+    async def handler(number: int) -> None:
+        user_id = rng.randint(1, users)
+        material_id = rng.choice(material_ids)
+        async with semaphore:
+            await timed(reads, "is_user_registered", user_id)
+            await timed(writes, "update_user_activity", user_id)
+            await timed(reads, "get_material", material_id)
+            await timed(reads, "get_user_rank", user_id)
+            if number % test_every == 0:
+                await timed(writes, "save_test_result", user_id, material_id, 2, 3, 66.7)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(i) for i in range(handlers)))
+    elapsed = time.perf_counter() - started
+    await async_db.close()
+    return {
+        "handlers_per_s": handlers / elapsed,
+        "read_p50": statistics.median(reads),
+        "read_p95": percentile(reads, 0.95),
+        "write_p50": statistics.median(writes),
+        "write_p95": percentile(writes, 0.95),
+        "errors": errors,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=list(STORAGE_PROFILES), choices=STORAGE_PROFILES)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--handlers", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--test-every", type=int, default=5, help="Каждый N-й обработчик сохраняет тест")
+    args = parser.parse_args()
+
+    print(
+        f"{'профиль':>8}{'обраб./с':>10}{'чтение p50, мс':>16}{'p95':>8}"
+        f"{'запись p50, мс':>16}{'p95':>8}{'ошибок':>8}"
+    )
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            database = prepare_database(Path(tmp) / "bench.db", profile, args.users)
+            result = asyncio.run(run_profile(
+                database, args.users, args.handlers, args.concurrency, args.test_every
+            ))
+            database.close()
+        print(
+            f"{profile:>8}{result['handlers_per_s']:>10.0f}"
+            f"{result['read_p50']:>16.2f}{result['read_p95']:>8.2f}"
+            f"{result['write_p50']:>16.2f}{result['write_p95']:>8.2f}{result['errors']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,15 @@ from .callbacks import router as callbacks_router
 from .tests import router as tests_router
 from .admin import router as admin_router
 from .ai import router as ai_router
+from .middlewares import UserProfileMiddleware
 
 # Создаём главный роутер
 router = Router()
 
+# Профиль пользователя (data["user"]) - один раз на обновление для всех под-роутеров
+router.message.outer_middleware(UserProfileMiddleware())
+router.callback_query.outer_middleware(UserProfileMiddleware())
+
 # Включаем все под-роутеры
 router.include_router(commands_router)
 router.include_router(callbacks_router)
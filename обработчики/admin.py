@@ -12,8 +12,23 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Video
 from aiogram.enums import ParseMode
 
-from утилиты.database import db
-from утилиты.auth import is_admin
+from утилиты.activity_buffer import activity
+from утилиты.admission import ask_admission
+from утилиты.answer_cache import answer_cache
+from утилиты.async_database import async_db as db
+from утилиты.auth import admin_acl, is_admin
+from утилиты.context_cache import user_contexts
+from утилиты.fsm_storage import fsm_storage
+from утилиты.history_retention import history_retention
+from утилиты.leaderboard import leaderboard
+from утилиты.material_cache import material_pages
+from утилиты.openrouter import openrouter
+from утилиты.profile_cache import user_profiles
+from утилиты.prompt_budget import prompt_budget
+from утилиты.test_definitions import test_definitions
+from утилиты.test_sessions import test_sessions
+from утилиты.wal_checkpoint import wal_checkpointer
+from обработчики.ai import summary_scheduler
 
 router = Router()
 
@@ -121,7 +136,7 @@ async def process_level(callback: CallbackQuery, state: FSMContext) -> None:
     data = await state.get_data()
     
     # Добавляем материал в БД
-    material_id = db.add_material(
+    material_id = await db.add_material(
         title=data['title'],
         text_content=data['text_content'],
         level=level
@@ -212,12 +227,12 @@ async def process_correct_answer(message: Message, state: FSMContext) -> None:
         
         # Добавляем вопрос в БД
         material_id = data['material_id']
-        question_id = db.add_question(material_id, data['current_question'])
+        question_id = await db.add_question(material_id, data['current_question'])
         
         # Добавляем ответы
         for i, answer_text in enumerate(answer_list):
             is_correct = (i == correct_index)
-            db.add_answer(question_id, answer_text, is_correct)
+            await db.add_answer(question_id, answer_text, is_correct)
         
         # Сохраняем счетчик вопросов
         questions_count = data.get('questions_count', 0) + 1
@@ -262,7 +277,7 @@ async def cmd_edit_material(message: Message, state: FSMContext) -> None:
         await message.answer("❌ У вас нет прав администратора")
         return
     
-    materials = db.get_all_materials()
+    materials = await db.get_materials_catalog()
     
     if not materials:
         await message.answer("📚 Материалы не найдены")
@@ -297,7 +312,7 @@ async def on_edit_material_selected(callback: CallbackQuery, state: FSMContext)
         return
     
     material_id = int(callback.data.split(":")[1])
-    material = db.get_material(material_id)
+    material = await db.get_material(material_id)
     
     if not material:
         await callback.answer("Материал не найден", show_alert=True)
@@ -376,7 +391,7 @@ async def process_new_title(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     material_id = data['material_id']
     
-    if db.update_material(material_id, title=new_title):
+    if await db.update_material(material_id, title=new_title):
         await state.clear()
         await message.answer(
             f"✅ Название обновлено: <b>{new_title}</b>",
@@ -397,7 +412,7 @@ async def process_additional_text(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     material_id = data['material_id']
     
-    if db.append_to_material(material_id, additional_text):
+    if await db.append_to_material(material_id, additional_text):
         await state.clear()
         await message.answer(
             f"✅ Текст добавлен к материалу!\n\n"
@@ -416,7 +431,7 @@ async def process_video(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     material_id = data['material_id']
     
-    if db.update_material(material_id, video_file_id=video_file_id):
+    if await db.update_material(material_id, video_file_id=video_file_id):
         await state.clear()
         await message.answer(
             f"✅ Видео добавлено к материалу!",
@@ -439,7 +454,7 @@ async def cmd_list_materials(message: Message) -> None:
         await message.answer("❌ У вас нет прав администратора")
         return
     
-    materials = db.get_all_materials()
+    materials = await db.get_materials_catalog()
     
     if not materials:
         await message.answer("📚 Материалы не найдены")
@@ -448,15 +463,14 @@ async def cmd_list_materials(message: Message) -> None:
     text = f"📚 <b>Всего материалов: {len(materials)}</b>\n\n"
     
     for material in materials[:20]:  # Показываем первые 20
-        questions = db.get_questions_for_material(material['id'])
         level_emoji = {"базовый": "🔰", "средний": "⚡", "продвинутый": "🔥"}
         emoji = level_emoji.get(material.get('level', 'базовый'), "📖")
-        has_video = "📹" if material.get('video_file_id') else "  "
+        has_video = "📹" if material['has_video'] else "  "
         
         text += (
             f"{emoji} {has_video} <b>ID {material['id']}:</b> {material['title']}\n"
             f"   📊 Уровень: {material.get('level', 'не указан')}\n"
-            f"   ❓ Вопросов: {len(questions)}\n\n"
+            f"   ❓ Вопросов: {material['question_count']}\n\n"
         )
     
     if len(materials) > 20:
@@ -473,7 +487,7 @@ async def cmd_delete_material(message: Message, state: FSMContext) -> None:
         return
     
     # Показываем список материалов для выбора
-    materials = db.get_all_materials()
+    materials = await db.get_materials_catalog()
     
     if not materials:
         await message.answer("📚 Материалы не найдены")
@@ -509,14 +523,14 @@ async def confirm_delete(callback: CallbackQuery) -> None:
         return
     
     material_id = int(callback.data.split(":")[1])
-    material = db.get_material(material_id)
+    material = await db.get_material(material_id)
     
     if not material:
         await callback.answer("Материал не найден", show_alert=True)
         return
     
     # Удаляем
-    if db.delete_material(material_id):
+    if await db.delete_material(material_id):
         await callback.message.edit_text(
             f"✅ <b>Материал удален!</b>\n\n"
             f"📝 {material['title']}\n"
@@ -543,7 +557,7 @@ async def cmd_add_question(message: Message, state: FSMContext) -> None:
         await message.answer("❌ У вас нет прав администратора")
         return
     
-    materials = db.get_all_materials()
+    materials = await db.get_materials_catalog()
     
     if not materials:
         await message.answer("📚 Сначала создайте материал командой /add_material")
@@ -577,7 +591,7 @@ async def start_add_question(callback: CallbackQuery, state: FSMContext) -> None
         return
     
     material_id = int(callback.data.split(":")[1])
-    material = db.get_material(material_id)
+    material = await db.get_material(material_id)
     
     if not material:
         await callback.answer("Материал не найден", show_alert=True)
@@ -612,6 +626,136 @@ async def process_question_text(message: Message, state: FSMContext) -> None:
     )
 
 
+@router.message(Command("perf"))
+async def cmd_perf(message: Message) -> None:
+    """Метрики производительности (пул подключений к БД, кэши)"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет прав администратора")
+        return
+    
+    pool = await db.pool_stats()
+    wal = wal_checkpointer.stats()
+    touches = activity.stats()
+    top = leaderboard.stats()
+    pages = material_pages.stats()
+    contexts = user_contexts.stats()
+    sessions = test_sessions.stats()
+    definitions = test_definitions.stats()
+    stored_sessions = await db.count_test_sessions()
+    states = fsm_storage.stats()
+    stored_states = await db.count_fsm_records()
+    profiles = user_profiles.stats()
+    acl = admin_acl.stats()
+    prompts = prompt_budget.stats()
+    llm = openrouter.stats()
+    admission = ask_admission.stats()
+    summaries = summary_scheduler.stats()
+    answers = answer_cache.stats()
+    cached_answers = await db.count_cached_answers()
+    retention = history_retention.stats()
+    history = await db.ai_history_stats()
+    text = (
+        "📈 <b>МЕТРИКИ ПРОИЗВОДИТЕЛЬНОСТИ</b>\n\n"
+        "🗄 <b>Пул подключений к БД</b>\n"
+        f"   Открыто: {pool['size']}/{pool['max_size']} "
+        f"(свободно {pool['idle']}, занято {pool['in_use']})\n"
+        f"   Выдач: {pool['checkouts']} | попаданий: {pool['hits']} "
+        f"({pool['hit_rate'] * 100:.1f}%) | новых: {pool['misses']}\n"
+        f"   Вложенных: {pool['reentrant']}\n"
+        f"   Ожиданий: {pool['waits']} | таймаутов: {pool['timeouts']}\n"
+        f"   Ожидание: ср. {pool['wait_avg_ms']:.1f} мс, макс. {pool['wait_max_ms']:.1f} мс\n"
+        f"   Профиль: {wal['profile']} | checkpoint: {wal['runs']} "
+        f"(занято {wal['busy']}, ошибок {wal['failures']}, макс. {wal['duration_max_ms']:.0f} мс)\n"
+        f"   Страниц в WAL: {wal['last_wal_pages']} | перенесено всего: {wal['pages_checkpointed']}\n\n"
+        "⏱ <b>Буфер активности</b>\n"
+        f"   Отметок: {touches['touches']} | в буфере: {touches['pending']} | "
+        f"схлопнуто: {touches['coalesced']}\n"
+        f"   Записей: {touches['flushes']} (раз в {touches['interval_s']:.0f} с, "
+        f"макс. {touches['flush_max_ms']:.0f} мс) | строк: {touches['written']} | "
+        f"ошибок: {touches['failures']}\n\n"
+        "🏆 <b>Кэш рейтинга</b>\n"
+        f"   Попаданий: {top['hits']} (+{top['stale_hits']} устаревших) | промахов: {top['misses']} "
+        f"({top['hit_rate'] * 100:.1f}%)\n"
+        f"   Инвалидаций: {top['invalidations']} | возраст: {top['age_s']:.1f}/{top['ttl_s']:.0f} с\n\n"
+        "📄 <b>Кэш страниц материалов</b>\n"
+        f"   Материалов: {pages['entries']}/{pages['max_entries']} | страниц: {pages['pages']}\n"
+        f"   Попаданий: {pages['hits']} | промахов: {pages['misses']} "
+        f"({pages['hit_rate'] * 100:.1f}%) | инвалидаций: {pages['invalidations']}\n\n"
+        "🪪 <b>Кэш профилей (middleware)</b>\n"
+        f"   Записей: {profiles['entries']}/{profiles['max_entries']}\n"
+        f"   Попаданий: {profiles['hits']} | промахов: {profiles['misses']} "
+        f"({profiles['hit_rate'] * 100:.1f}%) | инвалидаций: {profiles['invalidations']}\n\n"
+        "📝 <b>Незавершённые тесты</b>\n"
+        f"   В памяти: {sessions['in_memory']}/{sessions['max_entries']} | в БД: {stored_sessions}\n"
+        f"   Память: {sessions['memory_bytes'] / 1024:.1f} КБ "
+        f"(~{sessions['bytes_per_session']:.0f} Б на тест)\n"
+        f"   Начато: {sessions['started']} | завершено: {sessions['finished']} | "
+        f"продолжено из БД: {sessions['resumed']} | брошено: {sessions['expired']}\n"
+        f"   Скомпилированных тестов: {definitions['entries']}/{definitions['max_entries']} "
+        f"(попаданий {definitions['hit_rate'] * 100:.1f}%, "
+        f"{definitions['memory_bytes'] / 1024:.1f} КБ)\n"
+        f"   Компиляций: {definitions['compiled']} | ждали чужую загрузку: {definitions['coalesced']}\n\n"
+        "💬 <b>Состояния диалогов (FSM)</b>\n"
+        f"   В БД: {stored_states} | в кэше: {states['cached']}/{states['cache_size']} | "
+        f"ждут записи: {states['pending']}\n"
+        f"   Чтений: {states['reads']} | из памяти: {states['cache_hits']} "
+        f"({states['hit_rate'] * 100:.1f}%) | из БД: {states['db_reads']}\n"
+        f"   Изменений: {states['writes']} | записей: {states['flushed']} за {states['flushes']} раз "
+        f"(схлопнуто {states['coalesced']}) | ошибок: {states['failures']} | "
+        f"просрочено: {states['expired']}\n\n"
+        "👤 <b>Кэш контекста учеников (/ask)</b>\n"
+        f"   Записей: {contexts['entries']}/{contexts['max_entries']}\n"
+        f"   Попаданий: {contexts['hits']} | промахов: {contexts['misses']} "
+        f"({contexts['hit_rate'] * 100:.1f}%) | инвалидаций: {contexts['invalidations']}\n\n"
+        "🧮 <b>Промпты /ask</b>\n"
+        f"   Запросов: {prompts['requests']} | токенов: ср. {prompts['tokens_avg']:.0f}, "
+        f"макс. {prompts['tokens_max']} (бюджет {prompts['budget']})\n"
+        f"   Обрезано: {prompts['trimmed']} | выброшено сообщений истории: {prompts['history_dropped']}\n\n"
+        "🤖 <b>OpenRouter</b>\n"
+        f"   Запросов: {llm['requests']} | ошибок: {llm['errors']} | в работе: {llm['in_flight']}\n"
+        f"   Ответ: ср. {llm['latency_avg_ms']:.0f} мс, макс. {llm['latency_max_ms']:.0f} мс\n"
+        f"   Соединений: новых {llm['connections_created']}, повторно {llm['connections_reused']} "
+        f"(лимит {llm['max_connections']}, на хост {llm['max_per_host']})\n"
+        f"   Повторов: {llm['retries']} | ответов 429: {llm['rate_limited']}\n\n"
+        "🚦 <b>Очередь /ask</b>\n"
+        f"   В работе: {admission['active']}/{admission['max_concurrent']} | "
+        f"в очереди: {admission['queue']}/{admission['max_queue']} (пик {admission['queue_peak']})\n"
+        f"   Допущено: {admission['admitted']} | ждали: {admission['queued']} "
+        f"(ср. {admission['wait_avg_ms']:.0f} мс, макс. {admission['wait_max_ms']:.0f} мс)\n"
+        f"   Отказов: занят {admission['rejected_user_busy']}, очередь полна "
+        f"{admission['rejected_queue_full']}, таймаут {admission['rejected_timeout']}\n\n"
+        "🧠 <b>Фоновые summary</b>\n"
+        f"   Уведомлений: {summaries['notifications']} | объединено: {summaries['coalesced']}\n"
+        f"   Запусков: {summaries['runs']} | ошибок: {summaries['failures']} | "
+        f"ср. {summaries['run_avg_ms']:.0f} мс\n"
+        f"   Ожидают: {summaries['scheduled']} | выполняются: {summaries['running']} "
+        f"(порог {summaries['every_messages']} сообщ. / {summaries['delay_s']:.0f} с)\n\n"
+        "🗃 <b>История ИИ</b>\n"
+        f"   В таблице: {history['hot_rows']} | в архиве: {history['archived_rows']} "
+        f"({history['archive_blobs']} пачек, {history['archive_bytes'] / 1024:.1f} КБ)\n"
+        f"   Переносов: {retention['runs']} | пачек: {retention['batches']} | "
+        f"перенесено: {retention['archived']} | ошибок: {retention['failures']}\n"
+        f"   Самая долгая пачка: {retention['batch_max_ms']:.0f} мс "
+        f"(хранится {retention['keep_last']}, предел {retention['hard_cap']})\n\n"
+        "🔐 <b>Права администраторов</b>\n"
+        f"   Проверок: {acl['checks']} | перезагрузок: {acl['reloads']}\n"
+        f"   ADMIN_IDS: {acl['env_admins']} | в таблице: "
+        f"{acl['db_admins'] if acl['use_db'] else 'выкл.'}"
+        f"{' | доступ у всех' if acl['allow_all'] else ''}\n\n"
+        "💾 <b>Кэш ответов ИИ</b>"
+        f"{'' if answers['enabled'] else ' (выключен)'}\n"
+        f"   Записей: {cached_answers} | сохранено: {answers['stored']}\n"
+        f"   Попаданий: {answers['hits']} (точных {answers['exact_hits']}, "
+        f"похожих {answers['similar_hits']}) | промахов: {answers['misses']} "
+        f"({answers['hit_rate'] * 100:.1f}%)\n"
+        f"   Персональных вопросов (не кэшируются): {answers['skipped']}\n"
+        f"   Сэкономлено: {answers['saved_ms'] / 1000:.1f} с "
+        f"(ср. {answers['saved_avg_ms']:.0f} мс на попадание)\n"
+    )
+    
+    await message.answer(text, parse_mode=ParseMode.HTML)
+
+
 @router.message(Command("help_admin"))
 async def cmd_help_admin(message: Message) -> None:
     """Справка по административным командам"""
@@ -630,6 +774,7 @@ async def cmd_help_admin(message: Message) -> None:
         "❓ <b>/add_question</b> - Добавить вопрос к существующему материалу\n\n"
         "📋 <b>/list_materials</b> - Показать список всех материалов\n\n"
         "🗑️ <b>/delete_material</b> - Удалить материал\n\n"
+        "📈 <b>/perf</b> - Метрики производительности\n\n"
         "✅ <b>/done</b> - Завершить добавление вопросов\n\n"
         "💡 <b>Совет:</b> Используйте /add_material для создания материала с тестом за один раз!"
     )
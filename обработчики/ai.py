@@ -1,71 +1,84 @@
 """Интеграция команды /ask c OpenRouter + память по пользователю"""
+import asyncio
 import logging
 import os
-from typing import Any, Dict, List
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 
-import requests
 from aiogram import Router
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import Message
 
-from утилиты.database import db
+from config import (
+    AI_CACHE_DIALOG_GAP,
+    AI_HISTORY_MESSAGES,
+    AI_STREAM_EDIT_INTERVAL,
+    AI_STREAMING,
+    OPENROUTER_MODEL,
+)
+from утилиты.admission import AdmissionRejected, ask_admission
+from утилиты.answer_cache import answer_cache, persona_key
+from утилиты.async_database import async_db as db
+from утилиты.context_cache import user_contexts
+from утилиты.openrouter import OpenRouterError, openrouter
+from утилиты.prompt_budget import log_prompt_report, prompt_budget
+from утилиты.summary_scheduler import SummaryScheduler
 
 router = Router()
 
+# Заголовок ответа и лимит длины сообщения Telegram
+REPLY_HEADER = "💬 Ответ Specter:\n"
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Курсор в конце сообщения, пока ответ ещё генерируется
+STREAM_CURSOR = " ▌"
+# Ответы на отказ в допуске к модели (см. утилиты/admission.py)
+ADMISSION_MESSAGES = {
+    "user_busy": "⏳ Specter ещё отвечает на твой прошлый вопрос. Дождись ответа.",
+    "queue_full": "🚦 Сейчас слишком много вопросов к Specter. Попробуй через минуту.",
+    "timeout": "⌛ Не дождались очереди к Specter. Попробуй ещё раз чуть позже.",
+}
 
-def build_persona(user_alias: str) -> Dict[str, str]:
-    """Базовая персона Specter."""
-    return {
-        "role": "system",
-        "content": (
-            "Ты — Specter, ИИ-наставник из BLACKCORE. Говори кратко, мрачно, по делу,"
-            " только про компьютеры, Kali Linux, безопасность, анонимность и хакерство."
-            " Без отклонений в другие темы. Поддерживай учеников, но будь требовательным."
-            f" Пользователь: {user_alias}."
-        ),
-    }
 
+# Системный промпт персоны; от ученика зависит только имя в конце
+PERSONA_TEMPLATE = (
+    "Ты — Specter, ИИ-наставник из BLACKCORE. Говори кратко, мрачно, по делу,"
+    " только про компьютеры, Kali Linux, безопасность, анонимность и хакерство."
+    " Без отклонений в другие темы. Поддерживай учеников, но будь требовательным."
+)
+# Ключ персоны для кэша ответов (без имени ученика)
+PERSONA_KEY = persona_key(PERSONA_TEMPLATE, OPENROUTER_MODEL)
+
+
+def build_persona(user_alias: Optional[str] = None) -> Dict[str, str]:
+    """Базовая персона Specter (без имени - общая для ответов из кэша)."""
+    content = f"{PERSONA_TEMPLATE} Пользователь: {user_alias}." if user_alias else PERSONA_TEMPLATE
+    return {"role": "system", "content": content}
 
-def build_user_context(user_id: int) -> Dict[str, Any]:
-    """Собирает профиль и прогресс пользователя для промпта."""
-    snapshot = db.get_user_snapshot(user_id)
-    user = snapshot.get("user") or {}
-
-    profile_lines = []
-    if user:
-        profile_lines.append(
-            f"Профиль: {user.get('name', 'неизвестно')} / {user_id}, "
-            f"{user.get('age', 'N/A')} лет, {user.get('country', 'N/A')}, {user.get('city', 'N/A')}"
-        )
-    profile_lines.append(f"Изучено материалов: {snapshot.get('studied_count', 0)}")
-
-    last_materials = snapshot.get("last_materials") or []
-    if last_materials:
-        titles = [f"{m['title']} ({m['level']})" for m in last_materials]
-        profile_lines.append("Недавно изучал: " + "; ".join(titles))
-
-    recent_tests = snapshot.get("recent_tests") or []
-    if recent_tests:
-        tests_text = []
-        for t in recent_tests:
-            tests_text.append(
-                f"{t.get('title','Материал')} — {t['correct']}/{t['total']} ({t['percentage']:.1f}%)"
-            )
-        profile_lines.append("Последние тесты: " + "; ".join(tests_text))
-
-    summary = db.get_ai_summary(user_id)
-    if summary:
-        profile_lines.append(f"Краткое summary: {summary}")
 
+async def build_user_context(user_id: int) -> Dict[str, Any]:
+    """Собирает профиль и прогресс пользователя для промпта."""
     return {
         "role": "system",
-        "content": "Контекст ученика:\n" + "\n".join(profile_lines),
+        "content": await user_contexts.get(user_id),
     }
 
 
-def build_history(user_id: int, limit: int = 6) -> List[Dict[str, str]]:
+async def in_dialog(user_id: int, gap: float = AI_CACHE_DIALOG_GAP) -> bool:
+    """Писал ли пользователь /ask последние gap секунд (вопрос может быть продолжением)"""
+    last_at = await db.get_last_ai_message_at(user_id)
+    if not last_at:
+        return False
+    try:
+        return (datetime.now() - datetime.fromisoformat(str(last_at))).total_seconds() < gap
+    except ValueError:
+        return True
+
+
+async def build_history(user_id: int, limit: int = 6) -> List[Dict[str, str]]:
     """Возвращает последние сообщения для подмешивания в контекст."""
-    history = db.get_ai_history(user_id, limit=limit)
+    history = await db.get_ai_history(user_id, limit=limit)
     messages: List[Dict[str, str]] = []
     for item in history:
         role = item.get("role", "user")
@@ -75,9 +88,13 @@ def build_history(user_id: int, limit: int = 6) -> List[Dict[str, str]]:
     return messages
 
 
-def summarize_history(api_key: str, user_id: int, model: str = "openai/gpt-4o-mini") -> None:
-    """Делает краткое summary по истории и сохраняет его в БД."""
-    history = db.get_ai_history(user_id, limit=12)
+async def summarize_history(api_key: str, user_id: int, model: str = OPENROUTER_MODEL) -> None:
+    """Обновляет summary по истории и сохраняет его в БД.
+
+    Summary накопительное: в запрос уходит прошлое summary и последние
+    сообщения, так что тезисы о ранних диалогах не теряются.
+    """
+    history = await db.get_ai_history(user_id, limit=12)
     if len(history) < 8:
         return  # нет смысла сворачивать маленькую историю
 
@@ -87,37 +104,251 @@ def summarize_history(api_key: str, user_id: int, model: str = "openai/gpt-4o-mi
             "content": (
                 "Сделай краткое summary диалога в 3-5 тезисах."
                 " Фокус: интересы, цели, проблемы пользователя и данные о прогрессе."
+                " Если есть прошлое summary — обнови его с учётом новых сообщений."
                 " Формат — маркированные строки без лишнего."
             ),
         }
     ]
+    previous = await db.get_ai_summary(user_id)
+    if previous:
+        messages.append({"role": "system", "content": f"Прошлое summary:\n{previous}"})
     for h in history:
         messages.append({"role": h["role"], "content": h["content"]})
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    payload = {"model": model, "messages": messages}
+    summary = await openrouter.chat(api_key, messages, model=model, timeout=20)
+    if summary:
+        await db.upsert_ai_summary(user_id, summary)
+
+
+async def _summary_worker(user_id: int) -> None:
+    """Запуск summary из фонового планировщика"""
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if api_key:
+        await summarize_history(api_key, user_id)
+
+
+# Summary строится в фоне после N новых сообщений или T секунд (см. config)
+summary_scheduler = SummaryScheduler(_summary_worker)
+
+
+def split_position(text: str, limit: int) -> int:
+    """Где разрезать текст длиннее limit: по переводу строки или пробелу"""
+    cut = max(text.rfind("\n", 0, limit), text.rfind(" ", 0, limit))
+    return cut if cut > 0 else limit
+
+
+async def send_chunks(message: Message, text: str) -> None:
+    """Отправляет текст простыми сообщениями по лимиту длины (ждёт RetryAfter)"""
+    while text:
+        cut = split_position(text, TELEGRAM_MESSAGE_LIMIT) if len(text) > TELEGRAM_MESSAGE_LIMIT else len(text)
+        try:
+            await message.answer(text[:cut], parse_mode=None)
+        except TelegramRetryAfter as exc:
+            await asyncio.sleep(exc.retry_after)
+            continue
+        text = text[cut:].lstrip()
+
+
+async def send_long_reply(message: Message, reply: str) -> None:
+    """Отправляет готовый ответ, разбивая его по лимиту длины сообщения"""
+    await send_chunks(message, REPLY_HEADER + reply)
+
+
+class StreamingReply:
+    """Ответ модели, который дописывается в сообщение Telegram по мере генерации
+
+    Правки идут не чаще AI_STREAM_EDIT_INTERVAL; если текст перерастает
+    лимит сообщения, текущее сообщение фиксируется и продолжение идёт в новом.
+    """
 
+    def __init__(self, message: Message, edit_interval: float = AI_STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.text = ""  # весь ответ целиком
+        self._sent: Optional[Message] = None
+        self._prefix = REPLY_HEADER  # заголовок только у первого сообщения
+        self._body = ""  # часть ответа в текущем сообщении
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def start(self) -> None:
+        """Сразу показывает пользователю, что ответ готовится"""
+        self._sent = await self.message.answer(self._prefix + "…", parse_mode=None)
+        # Первый фрагмент показываем сразу, дальше - не чаще edit_interval
+        self._next_edit = asyncio.get_running_loop().time()
+
+    async def feed(self, delta: str) -> None:
+        """Добавляет фрагмент ответа и при необходимости обновляет сообщение"""
+        self.text += delta
+        self._body += delta
+
+        limit = TELEGRAM_MESSAGE_LIMIT - len(self._prefix) - len(STREAM_CURSOR)
+        while len(self._body) > limit:
+            # Режем по последнему переводу строки или пробелу в пределах лимита
+            cut = split_position(self._body, limit)
+            await self._edit(self._body[:cut], final=True)
+            # Зафиксированное сообщение уже не трогаем, даже если Telegram откажет дальше
+            self._body, self._prefix, self._sent = self._body[cut:].lstrip(), "", None
+            self._sent = await self.message.answer(self._body + STREAM_CURSOR, parse_mode=None)
+            self._shown = self._body + STREAM_CURSOR
+            limit = TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR)
+
+        if asyncio.get_running_loop().time() >= self._next_edit:
+            await self._edit(self._body, final=False)
+
+    def append(self, delta: str) -> None:
+        """Добавляет фрагмент ответа без правки сообщения (Telegram недоступен)"""
+        self.text += delta
+        self._body += delta
+
+    async def fallback(self, suffix: str = "") -> None:
+        """Досылает неотправленную часть ответа обычными сообщениями
+
+        Вызывается, когда правка сообщения не удалась: недописанное сообщение
+        удаляется, остаток ответа отправляется простым текстом.
+        """
+        if self._sent is not None:
+            try:
+                await self._sent.delete()
+            except TelegramAPIError:
+                pass
+        await send_chunks(self.message, self._prefix + (self._body + suffix or "⚠️ Пустой ответ от модели."))
+
+    async def finish(self, suffix: str = "") -> None:
+        """Показывает окончательный текст без курсора"""
+        body = self._body + suffix
+        if len(self._prefix) + len(body) > TELEGRAM_MESSAGE_LIMIT:
+            body = body[:TELEGRAM_MESSAGE_LIMIT - len(self._prefix)]
+        await self._edit(body or "⚠️ Пустой ответ от модели.", final=True)
+
+    async def _edit(self, body: str, final: bool) -> None:
+        """Правит текущее сообщение; финальная правка ждёт окончания лимита Telegram"""
+        content = self._prefix + body + ("" if final else STREAM_CURSOR)
+        if content == self._shown:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self._sent.edit_text(content, parse_mode=None)
+                self._shown = content
+                self._next_edit = loop.time() + self.edit_interval
+                return
+            except TelegramRetryAfter as exc:
+                self._next_edit = loop.time() + exc.retry_after
+                if not final:
+                    return  # промежуточную правку просто пропускаем
+                await asyncio.sleep(exc.retry_after)
+            except TelegramBadRequest as exc:
+                if "message is not modified" in str(exc):
+                    return
+                if final:
+                    raise
+                logging.debug("Промежуточная правка ответа не удалась: %s", exc)
+                return
+
+
+async def stream_llm_reply(message: Message, api_key: str,
+                           messages: List[Dict[str, str]]) -> Tuple[str, bool]:
+    """Потоковый ответ модели с прогрессивной правкой сообщения
+
+    Returns:
+        (итоговый текст для истории, получен ли ответ модели полностью)
+    """
+    reply = StreamingReply(message)
+    # После ошибки Telegram ответ дочитывается без правок и досылается в конце
+    telegram_failed = False
     try:
-        resp = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=20,
+        await reply.start()
+    except TelegramAPIError as exc:
+        logging.warning("Не удалось отправить заготовку ответа: %s", exc)
+        telegram_failed = True
+
+    error: Optional[OpenRouterError] = None
+    try:
+        async for delta in openrouter.stream_chat(api_key, messages):
+            if telegram_failed:
+                reply.append(delta)
+                continue
+            try:
+                await reply.feed(delta)
+            except TelegramAPIError as exc:
+                logging.warning("Правка потокового ответа не удалась: %s", exc)
+                telegram_failed = True
+    except OpenRouterError as exc:
+        logging.warning("Ошибка потокового ответа OpenRouter: %s", exc)
+        error = exc
+
+    if error is not None and not reply.text:
+        result = suffix = f"🚨 Ошибка при запросе к ИИ:\n{error}"
+    elif error is not None:
+        result, suffix = reply.text, f"\n\n⚠️ Ответ прерван: {error}"
+    else:
+        result, suffix = reply.text or "⚠️ Пустой ответ от модели.", ""
+    complete = error is None and bool(reply.text)
+
+    if not telegram_failed:
+        try:
+            await reply.finish(suffix)
+        except TelegramAPIError as exc:
+            logging.warning("Финальная правка ответа не удалась: %s", exc)
+            telegram_failed = True
+    if telegram_failed:
+        try:
+            await reply.fallback(suffix)
+        except TelegramAPIError as exc:
+            logging.error("Не удалось доставить ответ ИИ: %s", exc)
+    return result, complete
+
+
+async def generate_reply(message: Message, api_key: str, user_id: int,
+                         user_alias: str, user_prompt: str, shared: bool = False) -> str:
+    """Собирает промпт, получает ответ модели и показывает его пользователю
+
+    Args:
+        shared: Ответ общий для всех учеников (уйдёт в кэш): модель спрашивается
+            без имени, профиля, прогресса и истории этого ученика
+
+    Returns:
+        Итоговый текст для истории (ответ модели или текст ошибки)
+    """
+    question = {"role": "user", "content": user_prompt}
+    if shared:
+        messages, report = prompt_budget.assemble(build_persona(), None, [], question)
+    else:
+        # Сбор контекста в пределах бюджета токенов
+        messages, report = prompt_budget.assemble(
+            build_persona(user_alias),
+            await build_user_context(user_id),
+            await build_history(user_id, limit=AI_HISTORY_MESSAGES),
+            question,
         )
-        resp.raise_for_status()
-        data = resp.json()
-        summary = (
-            data.get("choices", [{}])[0]
-            .get("message", {})
-            .get("content", "")
+    log_prompt_report(user_id, report)
+
+    started = time.perf_counter()
+    if AI_STREAMING:
+        reply, complete = await stream_llm_reply(message, api_key, messages)
+    else:
+        try:
+            reply = await openrouter.chat(api_key, messages)
+            complete = bool(reply)
+            if not reply:
+                reply = "⚠️ Пустой ответ от модели."
+        except Exception as exc:
+            logging.exception("Ошибка при запросе к OpenRouter: %s", exc)
+            reply = f"🚨 Ошибка при запросе к ИИ:\n{exc}"
+            complete = False
+    # Ответ с личным контекстом ученика в кэш не попадает
+    if complete and shared:
+        await answer_cache.put(
+            user_prompt, PERSONA_KEY, reply, (time.perf_counter() - started) * 1000
         )
-        if summary:
-            db.upsert_ai_summary(user_id, summary)
-    except Exception as exc:  # pylint: disable=broad-except
-        logging.warning("Не удалось обновить summary: %s", exc)
+    if not AI_STREAMING:
+        try:
+            await send_long_reply(message, reply)
+        except TelegramAPIError as exc:
+            # Ответ всё равно попадёт в историю
+            logging.error("Не удалось доставить ответ ИИ: %s", exc)
+    return reply
 
 
 @router.message(Command("ask"))
@@ -141,47 +372,39 @@ async def ask_llm(message: Message) -> None:
     )
     user_id = message.from_user.id
 
-    # Сбор контекста
-    messages: List[Dict[str, str]] = [build_persona(user_alias), build_user_context(user_id)]
-    messages += build_history(user_id, limit=6)
-    messages.append({"role": "user", "content": user_prompt})
-
-    payload = {
-        "model": "openai/gpt-4o-mini",
-        "messages": messages,
-    }
+    # Типовой вопрос вне текущего диалога мог уже задавать другой ученик -
+    # отвечаем из кэша; продолжение разговора идёт с полной историей мимо кэша
+    shared = answer_cache.accepts(user_prompt) and not await in_dialog(user_id)
+    reply = await answer_cache.get(user_prompt, PERSONA_KEY) if shared else None
+    if reply is not None:
+        try:
+            await send_long_reply(message, reply)
+        except TelegramAPIError as exc:
+            logging.error("Не удалось доставить ответ ИИ: %s", exc)
+    else:
+        queue_notices: List[Message] = []
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+        async def on_queued(position: int) -> None:
+            queue_notices.append(await message.answer(
+                f"⏳ Specter сейчас отвечает другим ученикам. Твоё место в очереди: {position}"
+            ))
 
-    try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=30,
-        )
-        response.raise_for_status()
-        result = response.json()
-        reply = (
-            result.get("choices", [{}])[0]
-            .get("message", {})
-            .get("content", "")
-        )
-        if not reply:
-            reply = "⚠️ Пустой ответ от модели."
-    except Exception as exc:
-        logging.exception("Ошибка при запросе к OpenRouter: %s", exc)
-        reply = f"🚨 Ошибка при запросе к ИИ:\n{exc}"
+        try:
+            async with ask_admission.slot(user_id, on_queued=on_queued):
+                for notice in queue_notices:
+                    try:
+                        await notice.delete()
+                    except TelegramAPIError:
+                        pass
+                reply = await generate_reply(message, api_key, user_id, user_alias, user_prompt, shared)
+        except AdmissionRejected as exc:
+            await message.answer(ADMISSION_MESSAGES[exc.reason])
+            return
 
-    # Логируем историю
+    # Логируем итоговый текст; summary обновится в фоне, не задерживая ответ
     try:
-        db.log_ai_message(user_id, "user", user_prompt)
-        db.log_ai_message(user_id, "assistant", reply)
-        summarize_history(api_key, user_id)
+        await db.log_ai_message(user_id, "user", user_prompt)
+        await db.log_ai_message(user_id, "assistant", reply)
+        summary_scheduler.notify(user_id, new_messages=2)
     except Exception as exc:
         logging.warning("Не удалось сохранить историю ИИ: %s", exc)
-
-    await message.answer(f"💬 Ответ Specter:\n{reply}", reply_markup=None)
@@ -1,11 +1,12 @@
 """Упрощенные обработчики callback для работы с БД"""
 import logging
-from typing import Dict
+from typing import Dict, Optional
 from aiogram import Router, F, Bot
 from aiogram.enums import ParseMode
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 
-from утилиты.database import db
+from утилиты.activity_buffer import activity
+from утилиты.async_database import async_db as db
 from утилиты.keyboards import (
     build_main_keyboard,
     build_materials_level_keyboard,
@@ -15,6 +16,8 @@ from утилиты.keyboards import (
     build_back_to_home_keyboard,
     build_stats_keyboard
 )
+from утилиты.leaderboard import leaderboard, render_user_rank
+from утилиты.material_cache import material_pages
 
 router = Router()
 
@@ -37,20 +40,19 @@ async def delete_user_video_message(bot: Bot, user_id: int, chat_id: int) -> Non
 
 
 @router.callback_query(F.data == "home")
-async def on_home(callback: CallbackQuery, bot: Bot) -> None:
+async def on_home(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Главное меню"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы. Используйте /start", show_alert=True)
         return
     
     # Удаляем видео-сообщение при переходе на главную
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
-    user = db.get_user(user_id)
     await callback.message.edit_text(
         f"👋 Добро пожаловать, <b>{user['name']} </b>!\n\n"
         "Выберите действие:",
@@ -61,18 +63,18 @@ async def on_home(callback: CallbackQuery, bot: Bot) -> None:
 
 
 @router.callback_query(F.data == "materials_list")
-async def on_materials_list(callback: CallbackQuery, bot: Bot) -> None:
+async def on_materials_list(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Список материалов с выбором уровня"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
         return
     
     # Удаляем видео-сообщение при переходе к списку материалов
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
     text = "📚 <b>Выберите уровень сложности</b>\n\n"
     text += "🔰 Базовый - для начинающих\n"
@@ -88,28 +90,28 @@ async def on_materials_list(callback: CallbackQuery, bot: Bot) -> None:
 
 
 @router.callback_query(F.data.startswith("materials_level:"))
-async def on_materials_level(callback: CallbackQuery, bot: Bot) -> None:
+async def on_materials_level(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Список материалов по уровню"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
         return
     
     # Удаляем видео-сообщение при переходе к списку материалов
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
     level = callback.data.split(":")[1]
-    user_progress = db.get_user_progress(user_id)
+    user_progress = await db.get_user_progress(user_id)
     
     # Получаем материалы
     if level == "все":
-        materials = db.get_all_materials()
+        materials = await db.get_materials_catalog()
         level_name = "Все материалы"
     else:
-        materials = db.get_all_materials(level=level)
+        materials = await db.get_materials_catalog(level=level)
         level_names = {
             "базовый": "🔰 Базовый уровень",
             "средний": "⚡ Средний уровень",
@@ -136,29 +138,29 @@ async def on_materials_level(callback: CallbackQuery, bot: Bot) -> None:
 
 
 @router.callback_query(F.data.startswith("material:"))
-async def on_material(callback: CallbackQuery, bot: Bot) -> None:
+async def on_material(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Просмотр материала"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
         return
     
     # Удаляем предыдущее видео-сообщение при открытии нового материала
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
     material_id = int(callback.data.split(":")[1])
     await show_material_page(callback, bot, material_id, page_index=0)
 
 
 @router.callback_query(F.data.startswith("material_page:"))
-async def on_material_page(callback: CallbackQuery, bot: Bot) -> None:
+async def on_material_page(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Переход на страницу материала"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
         return
     
@@ -175,12 +177,12 @@ async def on_material_page(callback: CallbackQuery, bot: Bot) -> None:
 
 async def show_material_page(callback: CallbackQuery, bot: Bot, material_id: int, page_index: int = 0) -> None:
     """Показывает страницу материала с форматированием"""
-    from утилиты.text_formatter import format_text
-    
     user_id = callback.from_user.id
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
-    material = db.get_material(material_id)
+    # Страницы отформатированы при сохранении материала и лежат в кэше
+    # (при промахе читается только нужная страница по первичному ключу)
+    material = await material_pages.get(material_id, page_index)
     
     if not material:
         await callback.answer("Материал не найден", show_alert=True)
@@ -188,11 +190,11 @@ async def show_material_page(callback: CallbackQuery, bot: Bot, material_id: int
     
     # Отмечаем как изученный (только при первом просмотре)
     if page_index == 0:
-        db.mark_material_studied(user_id, material_id)
+        await db.mark_material_studied(user_id, material_id)
     
-    # Проверяем наличие теста
-    questions = db.get_questions_for_material(material_id)
-    has_test = len(questions) > 0
+    # Проверяем наличие теста (только счётчик, без загрузки вопросов)
+    question_counts = await db.count_questions([material_id])
+    has_test = question_counts[material_id] > 0
     
     # Показываем уровень сложности
     level_emoji = {
@@ -200,43 +202,36 @@ async def show_material_page(callback: CallbackQuery, bot: Bot, material_id: int
         "средний": "⚡",
         "продвинутый": "🔥"
     }
-    level = material.get('level', 'базовый')
+    level = material.level
     emoji = level_emoji.get(level, "📖")
     
     # Проверяем наличие видео
-    video_file_id = material.get('video_file_id')
-    
-    # Форматируем и разбиваем текст
-    content_text = material['text_content']
-    formatted_parts = format_text(content_text, max_length=3500)
+    video_file_id = material.video_file_id
     
     # Формируем заголовок
-    header = f"{emoji} <b>{material['title']}</b>\n"
+    header = f"{emoji} <b>{material.title}</b>\n"
     header += f"📊 Уровень: <b>{level.capitalize()}</b>\n\n"
     
     # Формируем текст для текущей страницы
-    if page_index < len(formatted_parts):
-        page_text = formatted_parts[page_index]
-        full_text = header + page_text
-    else:
-        full_text = header + formatted_parts[0] if formatted_parts else header
+    total_pages = material.total_pages
+    full_text = header + material.page(page_index)
     
     # Добавляем информацию о странице, если несколько частей
-    if len(formatted_parts) > 1:
-        full_text += f"\n\n📄 <i>Страница {page_index + 1} из {len(formatted_parts)}</i>"
+    if total_pages > 1:
+        full_text += f"\n\n📄 <i>Страница {page_index + 1} из {total_pages}</i>"
     
     # Создаем клавиатуру навигации
-    is_last_page = (page_index == len(formatted_parts) - 1)
+    is_last_page = (page_index == total_pages - 1)
     keyboard = build_material_navigation_keyboard(
         material_id=material_id,
         has_test=has_test,
         page_index=page_index,
-        total_pages=len(formatted_parts),
+        total_pages=total_pages,
         is_last_page=is_last_page
     )
     
     # Добавляем сообщение об изучении только на первой странице
-    if page_index == 0 and len(formatted_parts) == 1:
+    if page_index == 0 and total_pages == 1:
         full_text += "\n\n✅ Материал отмечен как изученным!"
     
     # Если есть видео на первой странице
@@ -332,26 +327,26 @@ async def on_material_info(callback: CallbackQuery, bot: Bot) -> None:
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
     material_id = int(callback.data.split(":")[1])
-    material = db.get_material(material_id)
+    material = await material_pages.get(material_id)
     
     if not material:
         await callback.answer("Материал не найден", show_alert=True)
         return
     
-    questions = db.get_questions_for_material(material_id)
+    question_counts = await db.count_questions([material_id])
     level_emoji = {
         "базовый": "🔰",
         "средний": "⚡",
         "продвинутый": "🔥"
     }
-    level = material.get('level', 'базовый')
+    level = material.level
     emoji = level_emoji.get(level, "📖")
     
     info_text = (
-        f"{emoji} <b>{material['title']}</b>\n\n"
+        f"{emoji} <b>{material.title}</b>\n\n"
         f"📊 Уровень: <b>{level.capitalize()}</b>\n"
-        f"📝 Вопросов в тесте: <b>{len(questions)}</b>\n"
-        f"📄 Длина текста: <b>{len(material['text_content'])}</b> символов"
+        f"📝 Вопросов в тесте: <b>{question_counts[material_id]}</b>\n"
+        f"📄 Длина текста: <b>{material.text_length}</b> символов"
     )
     
     await callback.message.edit_text(
@@ -363,23 +358,23 @@ async def on_material_info(callback: CallbackQuery, bot: Bot) -> None:
 
 
 @router.callback_query(F.data == "leaderboard")
-async def on_leaderboard_callback(callback: CallbackQuery, bot: Bot) -> None:
+async def on_leaderboard_callback(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Рейтинг через callback"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
         return
     
     # Удаляем видео-сообщение при переходе к рейтингу
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
-    leaderboard = db.get_leaderboard(limit=10)
-    user_rank = db.get_user_rank(user_id)
+    # ТОП берётся из общего кэша, место пользователя - отдельным запросом
+    top_text = await leaderboard.get_text()
     
-    if not leaderboard:
+    if not top_text:
         await callback.message.edit_text(
             "📊 Рейтинг пока пуст. Станьте первым!",
             reply_markup=build_back_to_home_keyboard()
@@ -387,36 +382,8 @@ async def on_leaderboard_callback(callback: CallbackQuery, bot: Bot) -> None:
         await callback.answer()
         return
     
-    text = "🏆 <b>ТОП-10 ПОЛЬЗОВАТЕЛЕЙ</b>\n\n"
-    
-    medals = ["🥇", "🥈", "🥉"]
-    for entry in leaderboard:
-        rank = entry['rank']
-        medal = medals[rank - 1] if rank <= 3 else "  "
-        name = entry['name']
-        score = entry['total_score']
-        materials = entry['materials_studied'] or 0
-        tests = entry['tests_completed'] or 0
-        country = entry.get('country', 'Неизвестно') or 'Неизвестно'
-        city = entry.get('city', 'Неизвестно') or 'Неизвестно'
-        age = entry.get('age', 'Неизвестно') or 'Неизвестно'
-        
-        text += (
-            f"{medal} <b>#{rank}</b> {name}\n"
-            f"   🌍 {country}, {city} | 👤 {age} лет\n"
-            f"   ⭐ Баллов: {score:.1f} | "
-            f"📚 Материалов: {materials} | "
-            f"📝 Тестов: {tests}\n\n"
-        )
-    
-    if user_rank and user_rank.get('rank'):
-        rank = user_rank['rank']
-        if rank > 10:
-            text += f"\n━━━━━━━━━━━━━━━━━━━━\n"
-            text += f"📍 <b>Ваше место: #{rank}</b>\n"
-            text += f"⭐ Баллов: {user_rank['total_score']:.1f}\n"
-            text += f"📚 Материалов: {user_rank['materials_studied'] or 0}\n"
-            text += f"📝 Тестов: {user_rank['tests_completed'] or 0}"
+    user_rank = await db.get_user_rank(user_id)
+    text = top_text + render_user_rank(user_rank, leaderboard.limit)
     
     text += "\n\n💪 Изучайте материалы и проходите тесты!"
     
@@ -429,24 +396,23 @@ async def on_leaderboard_callback(callback: CallbackQuery, bot: Bot) -> None:
 
 
 @router.callback_query(F.data == "my_stats")
-async def on_my_stats(callback: CallbackQuery, bot: Bot) -> None:
+async def on_my_stats(callback: CallbackQuery, bot: Bot, user: Optional[Dict]) -> None:
     """Статистика пользователя"""
     user_id = callback.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
         return
     
     # Удаляем видео-сообщение при переходе к статистике
     await delete_user_video_message(bot, user_id, callback.message.chat.id)
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
-    user = db.get_user(user_id)
-    user_progress = db.get_user_progress(user_id)
-    user_rank = db.get_user_rank(user_id)
+    user_progress = await db.get_user_progress(user_id)
+    user_rank = await db.get_user_rank(user_id)
     
-    all_materials = db.get_all_materials()
+    all_materials = await db.get_materials_catalog()
     total_materials = len(all_materials)
     studied_count = len(user_progress)
     percentage = (studied_count / total_materials * 100) if total_materials > 0 else 0
@@ -1,4 +1,6 @@
 """Упрощенные обработчики команд"""
+from typing import Dict, Optional
+
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
@@ -6,8 +8,10 @@ from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from утилиты.database import db
+from утилиты.activity_buffer import activity
+from утилиты.async_database import async_db as db
 from утилиты.keyboards import build_main_keyboard
+from утилиты.leaderboard import leaderboard, render_user_rank
 
 router = Router()
 
@@ -21,14 +25,13 @@ class RegistrationStates(StatesGroup):
 
 
 @router.message(CommandStart())
-async def on_start(message: Message, state: FSMContext) -> None:
+async def on_start(message: Message, state: FSMContext, user: Optional[Dict]) -> None:
     """Обработчик команды /start - начало регистрации"""
     user_id = message.from_user.id
     
     # Проверяем, зарегистрирован ли пользователь
-    if db.is_user_registered(user_id):
+    if user is not None:
         # Пользователь уже зарегистрирован - показываем главное меню
-        user = db.get_user(user_id)
         await message.answer(
             f"👋 Добро пожаловать, <b>{user['name']}</b>!\n\n"
             "Выберите действие:",
@@ -101,7 +104,7 @@ async def process_city(message: Message, state: FSMContext) -> None:
     data = await state.get_data()
     
     # Регистрируем пользователя
-    db.register_user(
+    await db.register_user(
         user_id=message.from_user.id,
         name=data['name'],
         age=data['age'],
@@ -124,56 +127,25 @@ async def process_city(message: Message, state: FSMContext) -> None:
 
 
 @router.message(Command("leaderboard"))
-async def on_leaderboard(message: Message) -> None:
+async def on_leaderboard(message: Message, user: Optional[Dict]) -> None:
     """Показывает рейтинг пользователей"""
     user_id = message.from_user.id
     
-    if not db.is_user_registered(user_id):
+    if user is None:
         await message.answer("❌ Вы не зарегистрированы. Используйте /start")
         return
     
-    db.update_user_activity(user_id)
+    activity.touch(user_id)
     
-    # Получаем рейтинг
-    leaderboard = db.get_leaderboard(limit=10)
-    user_rank = db.get_user_rank(user_id)
+    # ТОП берётся из общего кэша, место пользователя - отдельным запросом
+    top_text = await leaderboard.get_text()
     
-    if not leaderboard:
+    if not top_text:
         await message.answer("📊 Рейтинг пока пуст. Станьте первым!")
         return
     
-    # Формируем текст рейтинга
-    text = "🏆 <b>ТОП-10 ПОЛЬЗОВАТЕЛЕЙ</b>\n\n"
-    
-    medals = ["🥇", "🥈", "🥉"]
-    for entry in leaderboard:
-        rank = entry['rank']
-        medal = medals[rank - 1] if rank <= 3 else "  "
-        name = entry['name']
-        score = entry['total_score']
-        materials = entry['materials_studied'] or 0
-        tests = entry['tests_completed'] or 0
-        country = entry.get('country', 'Неизвестно') or 'Неизвестно'
-        city = entry.get('city', 'Неизвестно') or 'Неизвестно'
-        age = entry.get('age', 'Неизвестно') or 'Неизвестно'
-
-        text += (
-            f"{medal} <b>#{rank}</b> {name}\n"
-            f"   🌍 {country}, {city} | 👤 {age} лет\n"
-            f"   ⭐ Баллов: {score:.1f} | "
-            f"📚 Материалов: {materials} | "
-            f"📝 Тестов: {tests}\n\n"
-        )
-    
-    # Показываем место пользователя
-    if user_rank and user_rank.get('rank'):
-        rank = user_rank['rank']
-        if rank > 10:
-            text += f"\n━━━━━━━━━━━━━━━━━━━━\n"
-            text += f"📍 <b>Ваше место: #{rank}</b>\n"
-            text += f"⭐ Баллов: {user_rank['total_score']:.1f}\n"
-            text += f"📚 Материалов: {user_rank['materials_studied'] or 0}\n"
-            text += f"📝 Тестов: {user_rank['tests_completed'] or 0}"
+    user_rank = await db.get_user_rank(user_id)
+    text = top_text + render_user_rank(user_rank, leaderboard.limit)
     
     text += "\n\n💪 Изучайте материалы и проходите тесты, чтобы подняться выше!"
     
@@ -0,0 +1,38 @@
+"""
+Middleware обработчиков
+
+Принцип разделения ответственности:
+- Только подготовка данных, общих для всех обработчиков
+- Кэш профилей - в утилиты/profile_cache.py
+
+UserProfileMiddleware:
+- Подключается как outer middleware к сообщениям и callback'ам главного
+  роутера и срабатывает один раз на обновление, до фильтров
+- Кладёт профиль отправителя в данные обработчика под ключом "user"
+  (dict из таблицы users или None, если пользователь не зарегистрирован)
+- Обработчику достаточно объявить параметр user вместо вызовов
+  db.is_user_registered + db.get_user
+"""
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from утилиты.profile_cache import UserProfileCache, user_profiles
+
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Подставляет профиль пользователя из кэша в данные обработчика"""
+
+    def __init__(self, profiles: UserProfileCache = user_profiles):
+        self.profiles = profiles
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        from_user: User = data.get("event_from_user")
+        data["user"] = await self.profiles.get(from_user.id) if from_user else None
+        return await handler(event, data)
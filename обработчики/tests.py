@@ -1,112 +1,65 @@
 """Упрощенные обработчики тестов для работы с БД"""
 import logging
-from typing import List, Dict
+from typing import Dict, Optional
 
 from aiogram import Router, F
 from aiogram.enums import ParseMode
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 
-from утилиты.database import db
+from утилиты.activity_buffer import activity
+from утилиты.async_database import async_db as db
+from утилиты.test_definitions import CompiledTest, test_definitions
+from утилиты.test_sessions import TestSession, test_sessions
 
 router = Router()
 
-# Временное хранилище активных тестов
-user_active_tests: Dict[int, Dict] = {}
-
-
-def create_answer_keyboard(question_index: int, answers: List[Dict], user_id: int, material_id: int) -> InlineKeyboardMarkup:
-    """Создает клавиатуру с вариантами ответов
-    
-    Args:
-        question_index: Индекс вопроса
-        answers: Список ответов
-        user_id: ID пользователя
-        material_id: ID материала
-    """
-    buttons = []
-    
-    for i, answer in enumerate(answers):
-        answer_text = answer['answer_text']
-        button_text = answer_text[:50] + "..." if len(answer_text) > 50 else answer_text
-        # Формат: test_answer:user_id:material_id:question_index:answer_index
-        buttons.append([
-            InlineKeyboardButton(
-                text=f"{chr(65 + i)}. {button_text}",
-                callback_data=f"test_answer:{user_id}:{material_id}:{question_index}:{i}"
-            )
-        ])
-    
-    buttons.append([
-        InlineKeyboardButton(text="❌ Отменить тест", callback_data=f"test_cancel:{user_id}:{material_id}")
-    ])
-    
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
 
 @router.callback_query(F.data.startswith("test_start:"))
-async def on_test_start(callback: CallbackQuery) -> None:
+async def on_test_start(callback: CallbackQuery, user: Optional[Dict]) -> None:
     """Начало теста"""
     try:
         user_id = callback.from_user.id
         
-        if not db.is_user_registered(user_id):
+        if user is None:
             await callback.answer("❌ Вы не зарегистрированы", show_alert=True)
             return
         
-        db.update_user_activity(user_id)
+        activity.touch(user_id)
         
         material_id = int(callback.data.split(":")[1])
         
-        # Получаем вопросы для материала
-        questions = db.get_questions_for_material(material_id)
+        # Скомпилированный тест один на материал и общий для всех учеников
+        definition = await test_definitions.get(material_id)
         
-        if not questions:
+        if not definition:
             await callback.answer("Тест для этого материала не найден", show_alert=True)
             return
         
-        # Сохраняем активный тест
-        user_active_tests[user_id] = {
-            "material_id": material_id,
-            "questions": questions,
-            "current_question": 0,
-            "answers": []
-        }
+        # Сохраняем активный тест (прошлый незавершённый заменяется)
+        session = await test_sessions.start(user_id, definition)
         
         # Показываем первый вопрос
-        await show_question(callback, user_id, 0)
+        await show_question(callback, session, definition)
         
     except Exception as e:
         logging.exception(f"Error starting test: {e}")
         await callback.answer("Ошибка при запуске теста", show_alert=True)
 
 
-async def show_question(callback: CallbackQuery, user_id: int, question_index: int) -> None:
-    """Показывает вопрос теста"""
-    if user_id not in user_active_tests:
-        await callback.answer("Тест не найден", show_alert=True)
-        return
-    
-    test = user_active_tests[user_id]
-    questions = test["questions"]
+async def show_question(callback: CallbackQuery, session: TestSession, definition: CompiledTest) -> None:
+    """Показывает текущий вопрос теста"""
+    questions = definition.questions
+    question_index = session.current_question
     
     if question_index >= len(questions):
         # Все вопросы отвечены - завершаем тест
-        await finish_test(callback, user_id)
+        await finish_test(callback, session, definition)
         return
     
+    # Текст вопроса и клавиатура собраны при компиляции теста
     question = questions[question_index]
-    material_id = test["material_id"]
-    answers = question['answers']
-    
-    # Формируем текст вопроса
-    question_text = (
-        f"📝 <b>Вопрос {question_index + 1} из {len(questions)}</b>\n\n"
-        f"{question['question_text']}\n\n"
-        f"Выберите правильный ответ:"
-    )
-    
-    # Создаем клавиатуру (передаем user_id и material_id отдельно)
-    kb = create_answer_keyboard(question_index, answers, user_id, material_id)
+    question_text = question.prompt_html
+    kb = question.keyboard
     
     try:
         await callback.message.edit_text(question_text, reply_markup=kb, parse_mode=ParseMode.HTML)
@@ -121,63 +74,64 @@ async def show_question(callback: CallbackQuery, user_id: int, question_index: i
 async def on_test_answer(callback: CallbackQuery) -> None:
     """Обработка ответа на вопрос"""
     try:
-        # Формат: test_answer:user_id:material_id:question_index:answer_index
-        # Разбиваем правильно, учитывая что test_id содержит двоеточие
-        data = callback.data[len("test_answer:"):]  # Убираем префикс
-        parts = data.split(":")
+        # Формат: test_answer:material_id:question_index:answer_index
+        # (старые сообщения: test_answer:user_id:material_id:question_index:answer_index)
+        parts = callback.data[len("test_answer:"):].split(":")
         
-        if len(parts) < 4:
+        if len(parts) < 3:
             await callback.answer("Неверный формат", show_alert=False)
             return
         
-        # Формат: user_id:material_id:question_index:answer_index
-        user_id_from_data = int(parts[0])
-        material_id_from_data = int(parts[1])
-        question_index = int(parts[2])
-        answer_index = int(parts[3])
+        material_id_from_data = int(parts[-3])
+        question_index = int(parts[-2])
+        answer_index = int(parts[-1])
         
         user_id = callback.from_user.id
         
-        # Проверяем, что user_id совпадает
-        if user_id != user_id_from_data:
+        # В старом формате проверяем, что user_id совпадает
+        if len(parts) >= 4 and user_id != int(parts[-4]):
             await callback.answer("Неверный пользователь", show_alert=True)
             return
         
-        if user_id not in user_active_tests:
+        session = await test_sessions.get(user_id)
+        if session is None:
             await callback.answer("Тест не найден", show_alert=True)
             return
         
-        test = user_active_tests[user_id]
-        
         # Проверяем, что material_id совпадает
-        if test["material_id"] != material_id_from_data:
+        if session.material_id != material_id_from_data:
             await callback.answer("Неверный тест", show_alert=True)
             return
         
-        if test["current_question"] != question_index:
+        if session.current_question != question_index:
             await callback.answer("Вопрос уже отвечен", show_alert=False)
             return
         
-        # Сохраняем ответ
-        question = test["questions"][question_index]
-        answers = question['answers']
-        selected_answer = answers[answer_index]
+        definition = await test_definitions.get(session.material_id)
+        if definition is None or not session.matches(definition):
+            # Вопросы материала изменились, пока шёл тест
+            await test_sessions.discard(user_id)
+            await callback.answer("Тест изменился, начните его заново", show_alert=True)
+            return
         
-        test["answers"].append(answer_index)
-        test["current_question"] += 1
+        question = definition.questions[question_index]
+        if not 0 <= answer_index < len(question.answers):
+            await callback.answer("Неверный ответ", show_alert=False)
+            return
         
-        # Показываем результат
-        is_correct = selected_answer['is_correct']
-        if is_correct:
+        # Сохраняем ответ; пока грузился тест, вопрос мог быть отвечен повторным нажатием
+        if not await test_sessions.record_answer(session, question_index, answer_index):
+            await callback.answer("Вопрос уже отвечен", show_alert=False)
+            return
+        
+        # Показываем результат (правильный ответ известен заранее)
+        if question.is_correct(answer_index):
             await callback.answer("✅ Правильно!", show_alert=False)
         else:
-            # Находим правильный ответ
-            correct_answer = next((a for a in answers if a['is_correct']), None)
-            correct_text = correct_answer['answer_text'] if correct_answer else "Не указано"
-            await callback.answer(f"❌ Неправильно. Правильный ответ: {correct_text[:50]}", show_alert=True)
+            await callback.answer(f"❌ Неправильно. Правильный ответ: {question.correct_text[:50]}", show_alert=True)
         
         # Показываем следующий вопрос
-        await show_question(callback, user_id, test["current_question"])
+        await show_question(callback, session, definition)
         
     except Exception as e:
         logging.exception(f"Error processing answer: {e}")
@@ -188,25 +142,23 @@ async def on_test_answer(callback: CallbackQuery) -> None:
 async def on_test_cancel(callback: CallbackQuery) -> None:
     """Отмена теста"""
     try:
-        # Формат: test_cancel:user_id:material_id
-        data = callback.data[len("test_cancel:"):]
-        parts = data.split(":")
+        # Формат: test_cancel:material_id (старые сообщения: test_cancel:user_id:material_id)
+        parts = callback.data[len("test_cancel:"):].split(":")
         
-        if len(parts) < 2:
+        if not parts[-1]:
             await callback.answer("Ошибка", show_alert=True)
             return
         
-        user_id_from_data = int(parts[0])
-        material_id_from_data = int(parts[1])
+        material_id_from_data = int(parts[-1])
         user_id = callback.from_user.id
         
-        if user_id != user_id_from_data:
+        if len(parts) >= 2 and user_id != int(parts[-2]):
             await callback.answer("Ошибка", show_alert=True)
             return
         
-        if user_id in user_active_tests:
-            if user_active_tests[user_id]["material_id"] == material_id_from_data:
-                del user_active_tests[user_id]
+        session = await test_sessions.get(user_id)
+        if session is not None and session.material_id == material_id_from_data:
+            await test_sessions.discard(user_id)
         
         await callback.message.edit_text(
             "❌ Тест отменён.\n\nВы можете начать его заново в любое время.",
@@ -221,34 +173,21 @@ async def on_test_cancel(callback: CallbackQuery) -> None:
         await callback.answer("Ошибка", show_alert=True)
 
 
-async def finish_test(callback: CallbackQuery, user_id: int) -> None:
+async def finish_test(callback: CallbackQuery, session: TestSession, definition: CompiledTest) -> None:
     """Завершение теста и показ результатов"""
-    if user_id not in user_active_tests:
-        await callback.answer("Тест не найден", show_alert=True)
-        return
-    
-    test = user_active_tests[user_id]
-    material_id = test["material_id"]
-    questions = test["questions"]
-    answers = test["answers"]
-    
-    # Подсчитываем результаты
-    correct = 0
-    total = len(questions)
+    user_id = session.user_id
+    material_id = session.material_id
     
-    for i, question in enumerate(questions):
-        if i < len(answers):
-            answer_index = answers[i]
-            selected_answer = question['answers'][answer_index]
-            if selected_answer['is_correct']:
-                correct += 1
+    # Подсчитываем результаты: сравнение выбранных индексов с правильными
+    correct = definition.score(session.answers)
+    total = len(definition.questions)
     
     percentage = (correct / total * 100) if total > 0 else 0.0
     passed = percentage >= 60.0
     
     # Сохраняем результат
-    db.save_test_result(user_id, material_id, correct, total, percentage)
-    db.update_user_activity(user_id)
+    await db.save_test_result(user_id, material_id, correct, total, percentage)
+    activity.touch(user_id)
     
     # Формируем текст результата
     if percentage >= 80:
@@ -281,7 +220,7 @@ async def finish_test(callback: CallbackQuery, user_id: int) -> None:
     ])
     
     # Удаляем активный тест
-    del user_active_tests[user_id]
+    await test_sessions.finish(user_id)
     
     # Показываем результаты
     try:
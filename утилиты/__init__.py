@@ -1,5 +1,6 @@
 """Упрощенные утилиты для бота"""
 from .database import db
+from .async_database import async_db
 from .auth import is_admin
 from .keyboards import (
     build_main_keyboard,
@@ -13,6 +14,7 @@ from .keyboards import (
 
 __all__ = [
     "db",
+    "async_db",
     "is_admin",
     "build_main_keyboard",
     "build_materials_level_keyboard",
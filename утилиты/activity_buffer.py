@@ -0,0 +1,136 @@
+"""
+Отложенная запись времени последней активности пользователей
+
+Принцип разделения ответственности:
+- Только накопление и пакетная запись users.last_active
+- SQL записи - в database.py (update_users_activity)
+
+Зачем нужен буфер:
+- Почти каждый callback отмечает активность пользователя, и раньше каждая
+  отметка была отдельной транзакцией записи (UPDATE + commit) в очереди
+  потока-писателя - впереди сохранения тестов и прогресса
+- Время активности не нужно с точностью до секунды: обработчик лишь
+  запоминает последнее время в словаре (touch не ждёт БД)
+- Раз в ACTIVITY_FLUSH_INTERVAL секунд весь буфер записывается одним
+  executemany в одной транзакции; повторные нажатия одного пользователя
+  между записями схлопываются в одну строку
+- Буфер записывается досрочно, если в нём ACTIVITY_BUFFER_MAX пользователей,
+  и обязательно - при остановке бота
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from config import ACTIVITY_BUFFER_MAX, ACTIVITY_FLUSH_INTERVAL
+from .async_database import AsyncDatabase, async_db
+
+
+class ActivityBuffer:
+    """Последнее время активности по user_id с периодической записью в БД"""
+
+    def __init__(self, database: AsyncDatabase, interval: float = ACTIVITY_FLUSH_INTERVAL,
+                 max_pending: int = ACTIVITY_BUFFER_MAX):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            interval: Как часто записывать буфер, секунд
+            max_pending: При скольких пользователях записать буфер досрочно
+        """
+        self._db = database
+        self.interval = interval
+        self.max_pending = max(1, max_pending)
+        # user_id -> время последней активности (ISO, как в update_user_activity)
+        self._pending: Dict[int, str] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+        # Метрики
+        self._touches = 0
+        self._flushes = 0
+        self._written = 0
+        self._failures = 0
+        self._flush_max = 0.0
+
+    def touch(self, user_id: int) -> None:
+        """Отмечает активность пользователя (не обращается к БД)"""
+        self._touches += 1
+        self._pending[user_id] = datetime.now().isoformat()
+        if len(self._pending) >= self.max_pending and self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush_early())
+
+    async def _flush_early(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            self._flushing = None
+
+    async def flush(self) -> int:
+        """Записывает накопленные отметки одной транзакцией
+
+        Returns:
+            Сколько пользователей записано
+        """
+        if not self._pending:
+            return 0
+        # Подменяем словарь: новые отметки копятся, пока идёт запись
+        pending, self._pending = self._pending, {}
+        started = time.perf_counter()
+        try:
+            await self._db.update_users_activity(list(pending.items()))
+        except Exception:
+            self._failures += 1
+            # Возвращаем в буфер, не затирая более свежие отметки
+            for user_id, last_active in pending.items():
+                self._pending.setdefault(user_id, last_active)
+            raise
+        self._flush_max = max(self._flush_max, time.perf_counter() - started)
+        self._flushes += 1
+        self._written += len(pending)
+        return len(pending)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Не удалось записать активность пользователей: %s", exc)
+
+    def start(self) -> None:
+        """Запускает периодическую запись"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        """Останавливает периодическую запись и записывает остаток буфера"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+        try:
+            written = await self.flush()
+            logging.info("Буфер активности записан при остановке: %d пользователей", written)
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Не удалось записать активность при остановке: %s", exc)
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: отметки, записи, схлопнутые отметки"""
+        return {
+            "pending": len(self._pending),
+            "touches": self._touches,
+            "flushes": self._flushes,
+            "written": self._written,
+            # Отметки, которые не стали отдельными транзакциями
+            "coalesced": self._touches - self._written - len(self._pending),
+            "failures": self._failures,
+            "flush_max_ms": self._flush_max * 1000,
+            "interval_s": self.interval,
+        }
+
+
+# Глобальный буфер активности
+activity = ActivityBuffer(async_db)
@@ -0,0 +1,178 @@
+"""
+Контроль допуска запросов /ask к модели
+
+Принцип разделения ответственности:
+- Только решение "выполнять сейчас, поставить в очередь или отказать"
+- Сообщения пользователю формирует обработчик (обработчики/ai.py)
+
+Как устроено:
+- У пользователя не больше ASK_PER_USER запросов в работе или в очереди:
+  повторный /ask, пока идёт прошлый, сразу получает отказ
+- Одновременно к модели идут не больше ASK_MAX_CONCURRENT запросов
+- Остальные ждут в общей очереди FIFO (до ASK_QUEUE_SIZE мест); с лимитом
+  на пользователя FIFO честна - один ученик не займёт всю очередь
+- Освободившийся слот передаётся первому в очереди напрямую
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+from config import ASK_MAX_CONCURRENT, ASK_PER_USER, ASK_QUEUE_SIZE, ASK_QUEUE_TIMEOUT
+
+# Вызывается, когда запрос встал в очередь: on_queued(позиция, начиная с 1)
+QueuedCallback = Callable[[int], Awaitable[None]]
+
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен: reason = user_busy | queue_full | timeout"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Лимиты на пользователя, общий лимит и очередь ожидания"""
+
+    def __init__(self, max_concurrent: int = ASK_MAX_CONCURRENT,
+                 per_user: int = ASK_PER_USER,
+                 max_queue: int = ASK_QUEUE_SIZE,
+                 queue_timeout: float = ASK_QUEUE_TIMEOUT):
+        """
+        Args:
+            max_concurrent: Максимум одновременно выполняемых запросов
+            per_user: Максимум запросов одного пользователя (в работе + в очереди)
+            max_queue: Максимум ожидающих в очереди
+            queue_timeout: Сколько секунд ждать в очереди, прежде чем отказать
+        """
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_user = max(1, per_user)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+
+        self._active = 0
+        self._user_counts: Dict[int, int] = {}
+        self._waiters: Deque[asyncio.Future] = deque()
+
+        # Метрики
+        self._admitted = 0
+        self._queued = 0
+        self._rejected: Dict[str, int] = {"user_busy": 0, "queue_full": 0, "timeout": 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._queue_max = 0
+
+    def position(self, waiter: asyncio.Future) -> Optional[int]:
+        """Текущая позиция ожидающего в очереди (1 - следующий)"""
+        try:
+            return self._waiters.index(waiter) + 1
+        except ValueError:
+            return None
+
+    async def _acquire(self, user_id: int, on_queued: Optional[QueuedCallback]) -> None:
+        if self._user_counts.get(user_id, 0) >= self.per_user:
+            self._rejected["user_busy"] += 1
+            raise AdmissionRejected("user_busy")
+
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self._user_counts[user_id] = self._user_counts.get(user_id, 0) + 1
+            self._admitted += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self._rejected["queue_full"] += 1
+            raise AdmissionRejected("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._user_counts[user_id] = self._user_counts.get(user_id, 0) + 1
+        self._queued += 1
+        self._queue_max = max(self._queue_max, len(self._waiters))
+        started = time.perf_counter()
+        try:
+            if on_queued is not None:
+                # Уведомление об очереди необязательно: его ошибка не лишает места
+                try:
+                    await on_queued(len(self._waiters))
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.warning("Не удалось сообщить пользователю %s о месте в очереди: %s",
+                                    user_id, exc)
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as exc:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже передан нам - возвращаем его следующему
+                self._release_slot()
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            self._decrement_user(user_id)
+            if isinstance(exc, asyncio.TimeoutError):
+                self._rejected["timeout"] += 1
+                raise AdmissionRejected("timeout") from exc
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        self._admitted += 1
+
+    def _decrement_user(self, user_id: int) -> None:
+        count = self._user_counts.get(user_id, 0) - 1
+        if count > 0:
+            self._user_counts[user_id] = count
+        else:
+            self._user_counts.pop(user_id, None)
+
+    def _release_slot(self) -> None:
+        """Передаёт слот первому живому ожидающему или освобождает его"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: int,
+                   on_queued: Optional[QueuedCallback] = None) -> AsyncIterator[None]:
+        """Держит слот выполнения на время блока async with
+
+        Raises:
+            AdmissionRejected: лимит пользователя, переполненная очередь
+                               или слишком долгое ожидание
+        """
+        await self._acquire(user_id, on_queued)
+        try:
+            yield
+        finally:
+            self._decrement_user(user_id)
+            self._release_slot()
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: занятость, очередь, ожидание, отказы"""
+        waits = self._queued
+        return {
+            "active": self._active,
+            "max_concurrent": self.max_concurrent,
+            "queue": len(self._waiters),
+            "max_queue": self.max_queue,
+            "queue_peak": self._queue_max,
+            "admitted": self._admitted,
+            "queued": self._queued,
+            "wait_avg_ms": (self._wait_total / waits * 1000) if waits else 0.0,
+            "wait_max_ms": self._wait_max * 1000,
+            "rejected_user_busy": self._rejected["user_busy"],
+            "rejected_queue_full": self._rejected["queue_full"],
+            "rejected_timeout": self._rejected["timeout"],
+        }
+
+
+# Глобальный контроль допуска для /ask
+ask_admission = AdmissionController()
@@ -0,0 +1,283 @@
+"""
+Кэш ответов ИИ на повторяющиеся вопросы /ask
+
+Принцип разделения ответственности:
+- Только решение "можно ли взять ответ из кэша" и ключи поиска
+- SQL хранения (TTL, LRU) - в database.py, запрос к модели - в обработчики/ai.py
+
+Как устроено:
+- Вопрос нормализуется (регистр, пробелы, знаки препинания в конце);
+  точное совпадение ищется по хэшу "персона + вопрос"
+- Ключ персоны строится из шаблона персоны без имени пользователя и модели,
+  поэтому ответ одного ученика подходит другому
+- Кэшируются только "безопасные" вопросы: без отсылок к себе, своему прогрессу
+  или к прошлому диалогу, без указательных слов и продолжений ("а подробнее?",
+  "что это значит", "почему?")
+- Общий ответ используется, только если ученик не вёл диалог с ИИ последние
+  AI_CACHE_DIALOG_GAP секунд (обработчики/ai.py): иначе вопрос может быть
+  продолжением разговора. Тогда модель отвечает по общему промпту (персона
+  без имени, без профиля и истории ученика), и в кэш не попадает ничего
+  личного; в остальных случаях - полный промпт и кэш не используется
+- Опционально (AI_CACHE_SIMILAR) похожие формулировки находятся через MinHash
+  по символьным шинглам и LSH-корзины, затем сверяются точным Жаккаром;
+  ключи команд, пути и числа при этом должны совпадать дословно
+"""
+import hashlib
+import logging
+import re
+import struct
+import time
+from typing import Dict, FrozenSet, List, Optional
+
+from config import (
+    AI_CACHE_ENABLED,
+    AI_CACHE_MAX_ENTRIES,
+    AI_CACHE_MAX_PROMPT_LENGTH,
+    AI_CACHE_SIMILAR,
+    AI_CACHE_SIMILARITY,
+    AI_CACHE_TTL,
+)
+from .async_database import AsyncDatabase, async_db
+
+# Отсылки к себе и к контексту диалога: ответ на такой вопрос персональный
+PERSONAL_PATTERN = re.compile(
+    r"\b(я|меня|мне|мной|мой|моя|моё|мое|мои|моего|моей|моих|моим|мою|"
+    r"нас|нам|наш|наша|наше|наши|"
+    r"выше|ранее|раньше|прошлый|прошлом|прошлого|предыдущ\w*|продолжи\w*|"
+    r"i|me|my|mine|we|our)\b",
+    re.IGNORECASE,
+)
+# Указательные слова и продолжения: вопрос опирается на прошлый ответ
+FOLLOWUP_PATTERN = re.compile(
+    r"\b(это|эта|этот|эти|этого|этой|этом|этим|этих|эту|"
+    r"его|ее|их|ему|ей|им|ним|него|нее|нему|ней|них|"
+    r"тот|та|те|того|том|там|тут|здесь|туда|оттуда|"
+    r"подробнее|подробней|дальше|далее|еще|следующ\w*|остальн\w*|"
+    r"it|this|that|these|those|more|next|then)\b",
+    re.IGNORECASE,
+)
+# Продолжение реплики ("а как...", "и что...") или голое "почему?"
+FOLLOWUP_START = re.compile(r"^(а|и|но|так|тогда|ну|and|but|so)\b", re.IGNORECASE)
+BARE_QUESTIONS = frozenset({
+    "почему", "зачем", "как", "что", "а", "и", "ок", "да", "нет", "why", "how", "what",
+})
+# Ключи, порты, пути, версии: в похожих вопросах должны совпадать точно
+TECHNICAL_TOKEN = re.compile(r"^-|[\d/._=:]")
+TRAILING_PUNCTUATION = re.compile(r"[\s?!.,;:…]+$")
+WHITESPACE = re.compile(r"\s+")
+
+# Параметры MinHash/LSH: 16 корзин по 4 значения (порог срабатывания ~0.5)
+SHINGLE_SIZE = 4
+LSH_BANDS = 16
+LSH_ROWS = 4
+NUM_PERMUTATIONS = LSH_BANDS * LSH_ROWS
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def _permutations() -> List[tuple]:
+    """Детерминированные коэффициенты (a, b) хэш-функций MinHash"""
+    params = []
+    for i in range(NUM_PERMUTATIONS):
+        digest = hashlib.blake2b(f"minhash:{i}".encode(), digest_size=16).digest()
+        a, b = struct.unpack("<QQ", digest)
+        params.append((a % (_MERSENNE_PRIME - 1) + 1, b % _MERSENNE_PRIME))
+    return params
+
+
+PERMUTATIONS = _permutations()
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Приводит вопрос к канонической форме
+
+    Регистр убирается у всех слов, кроме ключей командной строки
+    (-sV и -sv в nmap - разные флаги).
+    """
+    words = WHITESPACE.split(TRAILING_PUNCTUATION.sub("", prompt.strip()))
+    return " ".join(
+        word if word.startswith("-") else word.lower().replace("ё", "е")
+        for word in words if word
+    )
+
+
+def is_followup(prompt_norm: str) -> bool:
+    """Опирается ли вопрос на прошлые реплики ("а подробнее?", "что это значит")"""
+    return (prompt_norm in BARE_QUESTIONS
+            or FOLLOWUP_START.search(prompt_norm) is not None
+            or FOLLOWUP_PATTERN.search(prompt_norm) is not None)
+
+
+def is_cacheable(prompt_norm: str, max_length: int = AI_CACHE_MAX_PROMPT_LENGTH) -> bool:
+    """Можно ли отдать ответ на вопрос другому ученику"""
+    if not prompt_norm or len(prompt_norm) > max_length:
+        return False
+    return PERSONAL_PATTERN.search(prompt_norm) is None and not is_followup(prompt_norm)
+
+
+def persona_key(persona_template: str, model: str) -> str:
+    """Ключ персоны: шаблон системного промпта (без имени ученика) + модель"""
+    return hashlib.sha1(f"{model}\n{persona_template}".encode()).hexdigest()[:16]
+
+
+def prompt_hash(persona: str, prompt_norm: str) -> str:
+    """Ключ точного совпадения"""
+    return hashlib.sha1(f"{persona}\n{prompt_norm}".encode()).hexdigest()
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> FrozenSet[str]:
+    """Символьные шинглы нормализованного текста"""
+    if len(text) <= size:
+        return frozenset([text])
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+def technical_tokens(prompt_norm: str) -> FrozenSet[str]:
+    """Слова, от которых зависит смысл команды (nmap -sV и nmap -sS - разные вопросы)"""
+    return frozenset(word for word in prompt_norm.split() if TECHNICAL_TOKEN.search(word))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Коэффициент Жаккара двух множеств шинглов"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_buckets(persona: str, prompt_norm: str) -> List[int]:
+    """MinHash-сигнатура, разбитая на LSH-корзины (по одной на полосу)"""
+    hashes = [
+        struct.unpack("<I", hashlib.blake2b(s.encode(), digest_size=4).digest())[0]
+        for s in shingles(prompt_norm)
+    ]
+    signature = [
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in PERMUTATIONS
+    ]
+    buckets = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(
+            f"{persona}:{band}:{rows}".encode(), digest_size=8
+        ).digest()
+        # Знаковое 64-битное число - влезает в INTEGER SQLite
+        buckets.append(struct.unpack("<q", digest)[0])
+    return buckets
+
+
+class AnswerCache:
+    """Поиск и сохранение ответов ИИ с метриками попаданий"""
+
+    def __init__(self, database: AsyncDatabase, enabled: bool = AI_CACHE_ENABLED,
+                 ttl: float = AI_CACHE_TTL, max_entries: int = AI_CACHE_MAX_ENTRIES,
+                 similar: bool = AI_CACHE_SIMILAR, similarity: float = AI_CACHE_SIMILARITY):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            enabled: Включён ли кэш
+            ttl: Сколько секунд ответ считается актуальным
+            max_entries: Максимум записей (лишние вытесняются по LRU)
+            similar: Искать ли похожие формулировки (MinHash/LSH)
+            similarity: Минимальный коэффициент Жаккара для похожего вопроса
+        """
+        self.database = database
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similar = similar
+        self.similarity = similarity
+
+        # Метрики
+        self._lookups = 0
+        self._exact_hits = 0
+        self._similar_hits = 0
+        self._skipped = 0
+        self._stored = 0
+        self._saved_ms = 0.0
+
+    def accepts(self, prompt: str) -> bool:
+        """Подходит ли формулировка вопроса для общего ответа (без учёта диалога)"""
+        return self.enabled and is_cacheable(normalize_prompt(prompt))
+
+    async def get(self, prompt: str, persona: str) -> Optional[str]:
+        """Возвращает сохранённый ответ или None"""
+        if not self.enabled:
+            return None
+        prompt_norm = normalize_prompt(prompt)
+        if not is_cacheable(prompt_norm):
+            self._skipped += 1
+            return None
+
+        self._lookups += 1
+        started = time.perf_counter()
+        min_created_at = time.time() - self.ttl
+        entry = await self.database.get_cached_answer(prompt_hash(persona, prompt_norm), min_created_at)
+        if entry:
+            self._exact_hits += 1
+        elif self.similar:
+            entry = await self._find_similar(persona, prompt_norm, min_created_at)
+            if entry:
+                self._similar_hits += 1
+        if not entry:
+            return None
+
+        await self.database.touch_cached_answer(entry["id"])
+        lookup_ms = (time.perf_counter() - started) * 1000
+        self._saved_ms += max(0.0, entry["latency_ms"] - lookup_ms)
+        return entry["answer"]
+
+    async def _find_similar(self, persona: str, prompt_norm: str,
+                            min_created_at: float) -> Optional[Dict]:
+        """Лучший кандидат из LSH-корзин с Жаккаром не ниже порога"""
+        candidates = await self.database.get_similar_cached_answers(
+            persona, lsh_buckets(persona, prompt_norm), min_created_at
+        )
+        query = shingles(prompt_norm)
+        tokens = technical_tokens(prompt_norm)
+        best, best_score = None, self.similarity
+        for candidate in candidates:
+            if technical_tokens(candidate["prompt_norm"]) != tokens:
+                continue
+            score = jaccard(query, shingles(candidate["prompt_norm"]))
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+    async def put(self, prompt: str, persona: str, answer: str, latency_ms: float) -> None:
+        """Сохраняет ответ, если вопрос не персональный"""
+        if not self.enabled or not answer:
+            return
+        prompt_norm = normalize_prompt(prompt)
+        if not is_cacheable(prompt_norm):
+            return
+        buckets = lsh_buckets(persona, prompt_norm) if self.similar else []
+        try:
+            await self.database.store_cached_answer(
+                prompt_hash(persona, prompt_norm), persona, prompt_norm, answer,
+                latency_ms, buckets, self.max_entries, time.time() - self.ttl,
+            )
+            self._stored += 1
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Не удалось сохранить ответ ИИ в кэш: %s", exc)
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: попадания, пропуски, сэкономленное время"""
+        hits = self._exact_hits + self._similar_hits
+        return {
+            "enabled": self.enabled,
+            "similar": self.similar,
+            "lookups": self._lookups,
+            "hits": hits,
+            "exact_hits": self._exact_hits,
+            "similar_hits": self._similar_hits,
+            "misses": self._lookups - hits,
+            "skipped": self._skipped,
+            "stored": self._stored,
+            "hit_rate": (hits / self._lookups) if self._lookups else 0.0,
+            "saved_ms": self._saved_ms,
+            "saved_avg_ms": (self._saved_ms / hits) if hits else 0.0,
+        }
+
+
+# Глобальный кэш ответов
+answer_cache = AnswerCache(async_db)
@@ -0,0 +1,105 @@
+"""
+Асинхронный фасад над базой данных
+
+Принцип разделения ответственности:
+- Только перенос вызовов Database в фоновые потоки
+- SQL и бизнес-логика остаются в database.py
+
+Как устроено:
+- Все записи выполняются одним потоком-писателем (SQLite допускает
+  только одного писателя, так мы не боремся за блокировку файла)
+- Чтения идут через небольшой пул потоков-читателей
+- Имена методов те же, что у Database: await async_db.get_material(...)
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from config import DB_READER_THREADS
+from .database import Database, db
+
+# Методы Database, которые изменяют данные и идут через поток-писатель
+WRITE_METHODS = frozenset({
+    "register_user",
+    "update_user_activity",
+    "update_users_activity",
+    "add_material",
+    "update_material",
+    "append_to_material",
+    "delete_material",
+    "add_question",
+    "add_answer",
+    "mark_material_studied",
+    "save_test_result",
+    "save_test_session",
+    "delete_test_session",
+    "delete_expired_test_sessions",
+    "update_all_ratings",
+    "log_ai_message",
+    "upsert_ai_summary",
+    "archive_ai_history",
+    "store_cached_answer",
+    "touch_cached_answer",
+    "seed_default_content",
+    "set_admin_role",
+    "remove_admin",
+    "save_fsm_records",
+    "delete_expired_fsm_records",
+    # checkpoint в очереди писателя не конкурирует с записями бота
+    "checkpoint_wal",
+})
+
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database с теми же именами методов"""
+
+    def __init__(self, database: Database, reader_threads: int = DB_READER_THREADS):
+        """
+        Args:
+            database: Синхронный экземпляр базы данных
+            reader_threads: Число потоков для запросов на чтение
+        """
+        self._db = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(
+            max_workers=max(1, reader_threads), thread_name_prefix="db-reader"
+        )
+
+    @property
+    def sync(self) -> Database:
+        """Синхронный экземпляр (для кода вне event loop)"""
+        return self._db
+
+    def __getattr__(self, name: str) -> Any:
+        """Превращает метод Database в корутину, выполняемую в фоновом потоке"""
+        attr = getattr(self._db, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        executor = self._writer if name in WRITE_METHODS else self._readers
+        method = self._wrap(attr, executor)
+        # Кэшируем обёртку, чтобы __getattr__ не вызывался повторно
+        setattr(self, name, method)
+        return method
+
+    @staticmethod
+    def _wrap(func: Callable, executor: ThreadPoolExecutor) -> Callable:
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+        return call
+
+    async def close(self) -> None:
+        """Дожидается фоновых операций и закрывает подключения"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.shutdown, True)
+        await loop.run_in_executor(None, self._readers.shutdown, True)
+        self._db.close()
+        logging.info("Асинхронный фасад БД остановлен")
+
+
+# Глобальный асинхронный экземпляр поверх общего db
+async_db = AsyncDatabase(db)
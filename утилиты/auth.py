@@ -4,41 +4,245 @@
 Принцип разделения ответственности:
 - Только проверка прав доступа
 - Не содержит бизнес-логики обработчиков
+
+Как устроено:
+- Список администраторов (ADMIN_IDS) разбирается один раз в frozenset,
+  проверка is_admin - поиск в множестве без обращения к файлам
+- .env перечитывается, только когда меняется время его изменения
+  (проверка раз в ADMIN_ACL_RELOAD_INTERVAL секунд) или по сигналу SIGHUP
+- ADMIN_IDS берётся из .env; из окружения процесса - только если при запуске
+  в .env его не было (иначе значение в окружении - копия из того же .env,
+  и удаление администраторов из файла не подействовало бы)
+- Перезагрузка не расширяет доступ: если перечитанный ADMIN_IDS пуст или не
+  разобран и это открыло бы права всем, остаётся прежний снимок прав.
+  Права всем после запуска - только явным ADMIN_IDS=*
+- Опционально (ADMIN_ACL_USE_DB) учитывается таблица admins с ролями
+  moderator < admin < owner; ADMIN_IDS из .env имеют роль owner.
+  Изменения таблицы через set_admin_role/remove_admin видны сразу
+- Если при запуске ADMIN_IDS не указаны и таблица admins не используется,
+  права есть у всех (для тестирования). При ADMIN_ACL_USE_DB пустая таблица означает,
+  что администраторов нет: удаление последней строки не открывает доступ всем
 """
-from pathlib import Path
+import asyncio
+import logging
 import os
-from dotenv import load_dotenv
+import signal
+import time
+from pathlib import Path
+from typing import Dict, FrozenSet, NamedTuple, Optional
+
+from dotenv import dotenv_values
+
+from config import ADMIN_ACL_RELOAD_INTERVAL, ADMIN_ACL_USE_DB, APP_ROOT
+from .database import Database, db
+
+# Уровни ролей: роль разрешает всё, что разрешают роли ниже
+ROLE_LEVELS = {"moderator": 1, "admin": 2, "owner": 3}
+ENV_ROLE = "owner"
+
+
+def parse_admin_ids(value: Optional[str]) -> FrozenSet[int]:
+    """Разбирает строку ADMIN_IDS ("123, 456") в множество ID"""
+    if not value:
+        return frozenset()
+    return frozenset(int(x.strip()) for x in value.split(",") if x.strip().isdigit())
+
+
+class AclSnapshot(NamedTuple):
+    """Неизменяемый снимок прав: подменяется целиком при перезагрузке"""
+    env_ids: FrozenSet[int]
+    db_levels: Dict[int, int]
+    allow_all: bool
+
+
+class AdminACL:
+    """Права администраторов в памяти с перезагрузкой при изменениях"""
+
+    def __init__(self, env_path: Path = APP_ROOT / ".env", database: Database = db,
+                 use_db: bool = ADMIN_ACL_USE_DB, reload_interval: float = ADMIN_ACL_RELOAD_INTERVAL):
+        """
+        Args:
+            env_path: Путь к .env с ADMIN_IDS
+            database: База данных с таблицей admins
+            use_db: Учитывать ли таблицу admins
+            reload_interval: Как часто проверять время изменения .env, секунд
+        """
+        self.env_path = env_path
+        self.use_db = use_db
+        self.reload_interval = reload_interval
+        self._db = database
+        self._env_ids: FrozenSet[int] = frozenset()
+        self._env_allow_all = False
+        self._db_levels: Dict[int, int] = {}
+        # До первой загрузки прав нет ни у кого
+        self._snapshot = AclSnapshot(frozenset(), {}, False)
+        self._mtime: Optional[int] = None
+        self._loaded = False
+        # ADMIN_IDS из окружения процесса, если он задан не через .env
+        self._process_value = None if self._read_file_value() else os.getenv("ADMIN_IDS")
+        self._task: Optional[asyncio.Task] = None
+
+        # Метрики
+        self._checks = 0
+        self._reloads = 0
+        self._last_reload: Optional[float] = None
+
+        self._load_env()
+        if use_db:
+            self._load_db()
+            # Вызывается из потока-писателя после фиксации изменений таблицы
+            database.add_listener(self._on_db_change)
+
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return self.env_path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_file_value(self) -> Optional[str]:
+        """ADMIN_IDS из .env или None, если файла или ключа нет (ошибка чтения - исключение)"""
+        if not self.env_path.exists():
+            return None
+        return dotenv_values(self.env_path).get("ADMIN_IDS")
+
+    def _load_env(self) -> None:
+        """Перечитывает ADMIN_IDS из .env (при ошибке остаются прежние права)"""
+        mtime = self._file_mtime()
+        try:
+            value = self._read_file_value()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Не удалось прочитать %s: %s", self.env_path, exc)
+            return
+        self._mtime = mtime
+        if value is None:
+            value = self._process_value
+        ids = parse_admin_ids(value)
+        explicit_all = (value or "").strip() == "*"
+        if self._loaded and not ids and not explicit_all and not self.use_db:
+            # Пустой или недописанный .env не должен открыть права всем
+            logging.warning("ADMIN_IDS в %s пуст или не разобран - права не изменены "
+                            "(права всем - ADMIN_IDS=*)", self.env_path)
+            return
+        self._env_ids = ids
+        # При запуске без ADMIN_IDS и без таблицы admins - права у всех (для тестирования)
+        self._env_allow_all = explicit_all or (not self._loaded and not ids and not self.use_db)
+        self._loaded = True
+        self._publish()
 
+    def _load_db(self) -> None:
+        """Перечитывает роли из таблицы admins"""
+        try:
+            roles = self._db.get_admin_roles()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.warning("Не удалось прочитать таблицу admins: %s", exc)
+            return
+        self._db_levels = {
+            user_id: ROLE_LEVELS[role] for user_id, role in roles.items() if role in ROLE_LEVELS
+        }
+        self._publish()
 
-def is_admin(user_id: int) -> bool:
+    def _publish(self) -> None:
+        """Собирает новый снимок прав и заменяет текущий одним присваиванием"""
+        self._snapshot = AclSnapshot(
+            env_ids=self._env_ids,
+            db_levels=dict(self._db_levels),
+            # Только ADMIN_IDS: изменения таблицы admins не расширяют доступ
+            allow_all=self._env_allow_all,
+        )
+        self._reloads += 1
+        self._last_reload = time.time()
+
+    def _on_db_change(self, event: str, entity_id: Optional[int]) -> None:
+        if event == "admins":
+            self._load_db()
+
+    def reload(self) -> None:
+        """Перечитывает .env и таблицу admins (SIGHUP)"""
+        self._load_env()
+        if self.use_db:
+            self._load_db()
+        logging.info("Права администраторов перечитаны: %d в ADMIN_IDS, %d в таблице",
+                     len(self._env_ids), len(self._db_levels))
+
+    def reload_if_changed(self) -> bool:
+        """Перечитывает .env, если файл изменился с прошлой загрузки"""
+        if self._file_mtime() == self._mtime:
+            return False
+        self._load_env()
+        logging.info("ADMIN_IDS перечитаны из изменённого .env: %d администраторов", len(self._env_ids))
+        return True
+
+    def is_admin(self, user_id: int, role: str = "admin") -> bool:
+        """Есть ли у пользователя роль не ниже указанной (без файлового ввода-вывода)"""
+        self._checks += 1
+        snapshot = self._snapshot
+        if snapshot.allow_all or user_id in snapshot.env_ids:
+            return True
+        return snapshot.db_levels.get(user_id, 0) >= ROLE_LEVELS[role]
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                self.reload_if_changed()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Не удалось проверить изменения .env: %s", exc)
+
+    def start(self) -> None:
+        """Запускает слежение за .env и обработчик SIGHUP"""
+        if self.reload_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            # Windows: SIGHUP нет, остаётся проверка времени изменения
+            pass
+
+    async def close(self) -> None:
+        """Останавливает слежение за .env"""
+        try:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: проверки, перезагрузки, число администраторов"""
+        snapshot = self._snapshot
+        return {
+            "checks": self._checks,
+            "reloads": self._reloads,
+            "env_admins": len(snapshot.env_ids),
+            "db_admins": len(snapshot.db_levels),
+            "allow_all": snapshot.allow_all,
+            "use_db": self.use_db,
+            "last_reload_ago_s": (time.time() - self._last_reload) if self._last_reload else -1,
+        }
+
+
+# Глобальные права администраторов
+admin_acl = AdminACL()
+
+
+def is_admin(user_id: int, role: str = "admin") -> bool:
     """
     Проверяет, является ли пользователь администратором
-    
+
     Принцип работы:
-    1. Читает список администраторов из переменной окружения ADMIN_IDS
-    2. Если список не указан, разрешает всем (для тестирования)
-    3. В продакшене рекомендуется указать ADMIN_IDS в .env
-    
+    1. Ищет пользователя в ADMIN_IDS (разобраны заранее, см. AdminACL)
+    2. При ADMIN_ACL_USE_DB - сравнивает его роль в таблице admins с нужной
+    3. Разрешает всем при ADMIN_IDS=* или если при запуске ADMIN_IDS не указаны
+       и таблица admins выключена (для тестирования)
+
     Args:
         user_id: ID пользователя Telegram
-    
+        role: Минимальная роль: moderator, admin или owner
+
     Returns:
-        True если пользователь администратор, False иначе
+        True если у пользователя есть нужные права, False иначе
     """
-    try:
-        env_path = Path(__file__).parent.parent / ".env"
-        if env_path.exists():
-            load_dotenv(env_path)
-            admin_ids_str = os.getenv("ADMIN_IDS", "")
-            
-            if admin_ids_str:
-                admin_list = [int(x.strip()) for x in admin_ids_str.split(",") if x.strip().isdigit()]
-                return user_id in admin_list
-        
-        # Если не указаны админы, разрешаем всем (для тестирования)
-        # В продакшене лучше требовать указания ADMIN_IDS
-        return True  # Временно разрешаем всем
-    except Exception:
-        # В случае ошибки разрешаем всем (для простоты)
-        return True
-
+    return admin_acl.is_admin(user_id, role)
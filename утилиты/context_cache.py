@@ -0,0 +1,169 @@
+"""
+Кэш блока "Контекст ученика" для промпта /ask
+
+Принцип разделения ответственности:
+- Только сборка текста контекста из снимка профиля и его кэширование
+- SQL снимка - в database.py (get_user_snapshot), сборка диалога - в обработчики/ai.py
+
+Зачем нужен кэш:
+- Контекст меняется только когда ученик изучает материал, проходит тест,
+  меняет профиль или обновляется summary, а /ask может идти подряд
+- При попадании промпт собирается без обращения к БД
+- При промахе снимок читается одним запросом с CTE
+
+Запись сбрасывается по событиям БД "user", "progress", "progress_seen"
+(порядок недавних материалов), "test_result" и "summary" этого
+пользователя; событие "material" (переименование/удаление) сбрасывает
+весь кэш, т.к. в контексте есть названия материалов. Событие одного
+пользователя отменяет только его загрузки, начатые до события.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import USER_CONTEXT_CACHE_SIZE, USER_CONTEXT_CACHE_TTL
+from .async_database import AsyncDatabase, async_db
+
+# События БД, после которых контекст конкретного пользователя устаревает
+USER_EVENTS = frozenset({"user", "progress", "progress_seen", "test_result", "summary"})
+
+
+def render_user_context(user_id: int, snapshot: Dict) -> str:
+    """Собирает текст системного сообщения с профилем и прогрессом ученика"""
+    user = snapshot.get("user") or {}
+
+    profile_lines = []
+    if user:
+        profile_lines.append(
+            f"Профиль: {user.get('name', 'неизвестно')} / {user_id}, "
+            f"{user.get('age', 'N/A')} лет, {user.get('country', 'N/A')}, {user.get('city', 'N/A')}"
+        )
+    profile_lines.append(f"Изучено материалов: {snapshot.get('studied_count', 0)}")
+
+    last_materials = snapshot.get("last_materials") or []
+    if last_materials:
+        titles = [f"{m['title']} ({m['level']})" for m in last_materials]
+        profile_lines.append("Недавно изучал: " + "; ".join(titles))
+
+    recent_tests = snapshot.get("recent_tests") or []
+    if recent_tests:
+        tests_text = []
+        for t in recent_tests:
+            tests_text.append(
+                f"{t.get('title') or 'Материал'} — {t['correct']}/{t['total']} ({t['percentage']:.1f}%)"
+            )
+        profile_lines.append("Последние тесты: " + "; ".join(tests_text))
+
+    summary = snapshot.get("summary")
+    if summary:
+        profile_lines.append(f"Краткое summary: {summary}")
+
+    return "Контекст ученика:\n" + "\n".join(profile_lines)
+
+
+class UserContextCache:
+    """LRU-кэш готового текста контекста по user_id"""
+
+    def __init__(self, database: AsyncDatabase, max_entries: int = USER_CONTEXT_CACHE_SIZE,
+                 ttl: float = USER_CONTEXT_CACHE_TTL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            max_entries: Сколько пользователей держать в памяти
+            ttl: Максимальный возраст записи, секунд (изменения из другого процесса)
+        """
+        self._db = database
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        # user_id -> (текст, время загрузки)
+        self._entries: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        # Подписчик БД вызывается из потока-писателя
+        self._lock = threading.Lock()
+        # Растёт при сбросе всего кэша: загрузка, начатая до него, не попадёт в кэш
+        self._generation = 0
+        # user_id -> [загрузок в работе, поколение пользователя]; запись живёт,
+        # пока идут загрузки, инвалидация пользователя увеличивает его поколение
+        self._loading: Dict[int, List[int]] = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+        database.sync.add_listener(self._on_db_change)
+
+    def _on_db_change(self, event: str, entity_id: Optional[int]) -> None:
+        if event in USER_EVENTS and entity_id is not None:
+            self.invalidate(entity_id)
+        elif event == "material":
+            self.clear()
+
+    def invalidate(self, user_id: int) -> None:
+        """Удаляет контекст пользователя из кэша"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            loading = self._loading.get(user_id)
+            if loading is not None:
+                loading[1] += 1
+            self._invalidations += 1
+
+    def clear(self) -> None:
+        """Сбрасывает весь кэш"""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidations += 1
+
+    def _finish_load(self, user_id: int) -> Tuple[int, int]:
+        """Отмечает конец загрузки и возвращает текущее поколение (под блокировкой)"""
+        loading = self._loading[user_id]
+        generation = (self._generation, loading[1])
+        loading[0] -= 1
+        if not loading[0]:
+            del self._loading[user_id]
+        return generation
+
+    async def get(self, user_id: int) -> str:
+        """Возвращает текст контекста ученика (из кэша или одним запросом к БД)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            loading = self._loading.setdefault(user_id, [0, 0])
+            loading[0] += 1
+            generation = (self._generation, loading[1])
+
+        try:
+            text = render_user_context(user_id, await self._db.get_user_snapshot(user_id))
+        except BaseException:
+            with self._lock:
+                self._finish_load(user_id)
+            raise
+
+        with self._lock:
+            if self._finish_load(user_id) == generation:
+                self._entries[user_id] = (text, time.monotonic())
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return text
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов кэша"""
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_rate": (self._hits / requests) if requests else 0.0,
+            }
+
+
+# Глобальный кэш контекста учеников
+user_contexts = UserContextCache(async_db)
@@ -3,47 +3,181 @@
 
 Структура:
 - users: пользователи (ID, имя, возраст, страна, город)
-- materials: материалы/уроки (ID, title, text_content)
+- materials: материалы/уроки (ID, title, text_content, version - растёт при каждом изменении
+  материала, его вопросов или ответов; rendered_with - версия рендера страниц;
+  text_length и page_count записываются вместе со страницами)
+- material_pages: готовые HTML-страницы материала (material_id, page_index, html);
+  рендерятся один раз при записи материала через text_formatter.format_text
 - questions: вопросы (ID, material_id, question_text)
 - answers: варианты ответов (ID, question_id, answer_text, is_correct)
 - user_progress: прогресс изучения (user_id, material_id, studied_at)
 - test_results: результаты тестов (user_id, material_id, correct, total, percentage, completed_at)
-- ratings: рейтинг пользователей (user_id, total_score, rank)
+- user_stats: сводка по пользователю (materials_studied, tests_completed, score);
+  обновляется в той же транзакции, что и прогресс/тесты; место вычисляется при чтении
+- ai_history / ai_history_archive: история диалога с ИИ; старые сообщения,
+  уже учтённые в summary, переносятся пачками в сжатый архив
+- ai_answer_cache / ai_answer_lsh: кэш ответов ИИ на типовые вопросы (TTL + LRU)
+  и LSH-корзины для поиска похожих вопросов
+- test_sessions: незавершённые тесты (ID вопросов и индексы ответов), переживают перезапуск
+- admins: администраторы с ролями (moderator, admin, owner) в дополнение к ADMIN_IDS
+- fsm_states: состояния диалогов aiogram (регистрация, добавление материала и т.п.),
+  переживают перезапуск бота (утилиты/fsm_storage.py)
+
+Подключения берутся из пула (утилиты/db_pool.py), а не открываются на каждый вызов.
+Профиль хранения (DB_PROFILE): по умолчанию WAL-журнал с synchronous=NORMAL,
+mmap и кэшем страниц; WAL переносится в основной файл периодически
+(утилиты/wal_checkpoint.py).
 """
+import json
 import sqlite3
 import logging
+import time
+import zlib
+from contextlib import AbstractContextManager
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
-from config import APP_ROOT
+from config import (
+    APP_ROOT,
+    DB_BUSY_TIMEOUT_MS,
+    DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_PROFILE,
+)
+from .db_pool import DEFAULT_PRAGMAS, ConnectionPool
+from .text_formatter import format_text
 
 # Путь к файлу базы данных
 DB_PATH = APP_ROOT / "данные" / "bot.db"
 DB_PATH.parent.mkdir(exist_ok=True)
 
+# Формула рейтинга: +10 баллов за изученный материал, процент теста * 0.1
+MATERIAL_SCORE = 10
+TEST_SCORE_FACTOR = 0.1
+
+# Максимальная длина страницы материала (с запасом до лимита Telegram в 4096)
+MATERIAL_PAGE_LENGTH = 3500
+# Версия рендера страниц: при изменении format_text/MATERIAL_PAGE_LENGTH
+# увеличьте её, и страницы всех материалов перерендерятся при старте
+PAGE_RENDERER_VERSION = 1
+
+# Сколько ID подставлять в один запрос с IN (...)
+QUERY_CHUNK_SIZE = 500
+# Сколько пользователей просматривает одна транзакция переноса истории в архив
+ARCHIVE_USERS_PER_BATCH = 64
+
+# Профили хранения: режим журнала (ставится один раз в файле БД)
+STORAGE_PROFILES = ("wal", "legacy")
+
+
+def storage_pragmas(profile: str) -> Tuple[str, ...]:
+    """PRAGMA, выполняемые для каждого нового подключения в профиле хранения
+    
+    - wal: synchronous=NORMAL безопасен в WAL (при сбое питания теряются лишь
+      последние транзакции, файл не портится), fsync только при checkpoint;
+      mmap и увеличенный кэш страниц убирают лишние read() на чтениях
+    - legacy: только то, что было раньше (настройки SQLite по умолчанию)
+    """
+    if profile == "legacy":
+        return DEFAULT_PRAGMAS
+    return DEFAULT_PRAGMAS + (
+        "PRAGMA synchronous = NORMAL;",
+        f"PRAGMA mmap_size = {DB_MMAP_SIZE};",
+        # Отрицательное значение - размер в КиБ, а не в страницах
+        f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB};",
+        f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};",
+        "PRAGMA temp_store = MEMORY;",
+    )
+
+
+# Подписчик на изменения данных: callback(событие, ID сущности или None)
+# События: "user", "progress", "progress_seen", "test_result", "ratings", "material",
+# "questions", "summary", "admins"; "progress_seen" - материал открыт повторно
+# (обновилось только studied_at, рейтинг не изменился)
+ChangeListener = Callable[[str, Optional[int]], None]
+
 
 class Database:
     """Класс для работы с упрощенной SQLite базой данных"""
     
-    def __init__(self, db_path: Path = DB_PATH):
-        """Инициализация подключения к базе данных"""
+    def __init__(self, db_path: Path = DB_PATH, pool_size: int = DB_POOL_SIZE,
+                 pool_timeout: float = DB_POOL_TIMEOUT, profile: str = DB_PROFILE):
+        """Инициализация подключения к базе данных
+        
+        Args:
+            profile: Профиль хранения "wal" или "legacy" (см. storage_pragmas)
+        """
+        if profile not in STORAGE_PROFILES:
+            logging.warning("Неизвестный профиль БД %r, используется wal", profile)
+            profile = "wal"
         self.db_path = db_path
+        self.profile = profile
+        # PRAGMA профиля выполняются пулом один раз на подключение
+        self.pool = ConnectionPool(db_path, max_size=pool_size, timeout=pool_timeout,
+                                   pragmas=storage_pragmas(profile))
+        self._listeners: List[ChangeListener] = []
         self._init_database()
     
-    def _get_connection(self) -> sqlite3.Connection:
-        """Создаёт и возвращает подключение к базе данных"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        # Гарантируем работу внешних ключей для всех клиентов
-        conn.execute("PRAGMA foreign_keys = ON;")
-        return conn
+    def _get_connection(self) -> AbstractContextManager:
+        """Выдаёт подключение из пула для использования в блоке with"""
+        return self.pool.connection()
+    
+    def pool_stats(self) -> Dict[str, float]:
+        """Метрики пула подключений (попадания, ожидания, занятость)"""
+        return self.pool.stats()
+    
+    def checkpoint_wal(self, mode: str = "PASSIVE") -> Dict[str, int]:
+        """Переносит страницы WAL-журнала в основной файл БД
+        
+        PASSIVE не ждёт читателей и писателей: переносит то, что можно сейчас.
+        
+        Returns:
+            busy (1 - checkpoint не завершён из-за блокировки), wal_pages
+            (страниц в журнале), checkpointed (перенесено); в legacy - нули
+        """
+        if self.profile != "wal":
+            return {"busy": 0, "wal_pages": 0, "checkpointed": 0}
+        with self._get_connection() as conn:
+            busy, wal_pages, checkpointed = conn.execute(
+                f"PRAGMA wal_checkpoint({mode})"
+            ).fetchone()
+            return {"busy": busy, "wal_pages": wal_pages, "checkpointed": checkpointed}
+    
+    def close(self) -> None:
+        """Закрывает все подключения пула"""
+        self.pool.close()
+    
+    def add_listener(self, listener: ChangeListener) -> None:
+        """Подписывает кэш на изменения данных (для инвалидации)
+        
+        Вызывается после фиксации транзакции, в том потоке, где шла запись,
+        поэтому подписчик должен быть быстрым и потокобезопасным.
+        """
+        self._listeners.append(listener)
+    
+    def _notify(self, event: str, entity_id: Optional[int] = None) -> None:
+        """Сообщает подписчикам об изменении данных"""
+        for listener in self._listeners:
+            try:
+                listener(event, entity_id)
+            except Exception:
+                logging.exception("Ошибка в подписчике на событие БД %s", event)
     
     def _init_database(self) -> None:
         """Создаёт таблицы, если их нет"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
+            # Режим журнала хранится в самом файле БД: в WAL читатели не ждут
+            # писателя, а писатель - читателей
+            journal_mode = "WAL" if self.profile == "wal" else "DELETE"
+            mode = cursor.execute(f"PRAGMA journal_mode = {journal_mode}").fetchone()[0]
+            if mode.upper() != journal_mode:
+                logging.warning("Не удалось включить journal_mode=%s (сейчас %s)", journal_mode, mode)
+            
             # Таблица пользователей
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS users (
@@ -65,6 +199,10 @@ class Database:
                     text_content TEXT NOT NULL,
                     level TEXT NOT NULL DEFAULT 'базовый',
                     video_file_id TEXT,
+                    version INTEGER NOT NULL DEFAULT 1,
+                    rendered_with INTEGER NOT NULL DEFAULT 0,
+                    text_length INTEGER NOT NULL DEFAULT 0,
+                    page_count INTEGER NOT NULL DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
@@ -76,6 +214,63 @@ class Database:
                 # Колонка уже существует
                 pass
             
+            # Версия содержимого материала (для инвалидации кэшей страниц)
+            try:
+                cursor.execute("ALTER TABLE materials ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+            except sqlite3.OperationalError:
+                # Колонка уже существует
+                pass
+            
+            # Версия рендера, которым построены страницы материала (0 - не рендерились)
+            rendered_with_added = True
+            try:
+                cursor.execute("ALTER TABLE materials ADD COLUMN rendered_with INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                # Колонка уже существует
+                rendered_with_added = False
+            
+            # Длина текста и число страниц (пишутся вместе со страницами, чтобы
+            # не читать text_content целиком при каждом открытии материала)
+            page_stats_added = True
+            for column in ("text_length", "page_count"):
+                try:
+                    cursor.execute(f"ALTER TABLE materials ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    # Колонка уже существует
+                    page_stats_added = False
+            
+            # Отформатированные страницы материалов (рендерятся при записи)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS material_pages (
+                    material_id INTEGER NOT NULL,
+                    page_index INTEGER NOT NULL,
+                    html TEXT NOT NULL,
+                    PRIMARY KEY (material_id, page_index),
+                    FOREIGN KEY (material_id) REFERENCES materials(id) ON DELETE CASCADE
+                ) WITHOUT ROWID
+            """)
+            
+            # Страницы, построенные до появления rendered_with, уже отрендерены текущей версией
+            if rendered_with_added:
+                cursor.execute("""
+                    UPDATE materials SET rendered_with = ?
+                    WHERE id IN (SELECT DISTINCT material_id FROM material_pages)
+                """, (PAGE_RENDERER_VERSION,))
+            if page_stats_added:
+                cursor.execute("""
+                    UPDATE materials SET
+                        text_length = LENGTH(text_content),
+                        page_count = (SELECT COUNT(*) FROM material_pages mp WHERE mp.material_id = materials.id)
+                """)
+            
+            # Рендерим материалы без страниц или со страницами старой версии рендера
+            # (материал с пустым текстом даёт ноль страниц, но тоже помечается)
+            cursor.execute("""
+                SELECT id, text_content FROM materials WHERE rendered_with < ?
+            """, (PAGE_RENDERER_VERSION,))
+            for material_id, text_content in cursor.fetchall():
+                self._store_material_pages(cursor, material_id, text_content)
+            
             # Таблица вопросов
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS questions (
@@ -124,23 +319,36 @@ class Database:
                 )
             """)
             
-            # Таблица рейтингов (обновляется автоматически)
+            # Сводная статистика пользователя (рейтинг). Счётчики обновляются
+            # инкрементально в mark_material_studied/save_test_result, поэтому
+            # рейтинг и ТОП не требуют JOIN с прогрессом и тестами
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS ratings (
+                CREATE TABLE IF NOT EXISTS user_stats (
                     user_id INTEGER PRIMARY KEY,
-                    total_score REAL DEFAULT 0,
-                    rank INTEGER,
+                    materials_studied INTEGER NOT NULL DEFAULT 0,
+                    tests_completed INTEGER NOT NULL DEFAULT 0,
+                    score REAL NOT NULL DEFAULT 0,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
                 )
             """)
             
             # Индексы
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_materials_level ON materials(level, id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_questions_material ON questions(material_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_answers_question ON answers(question_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_progress_user ON user_progress(user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_results_user ON test_results(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ratings_score ON ratings(total_score DESC)")
+            # Место в рейтинге считается при чтении по этому индексу
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_rank ON user_stats(score DESC, user_id)")
+            
+            # Старая таблица ratings заменена на user_stats: один раз пересчитываем
+            # статистику из прогресса и тестов и удаляем устаревшую таблицу
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ratings'")
+            if cursor.fetchone():
+                self._rebuild_user_stats(cursor)
+                cursor.execute("DROP TABLE ratings")
+                logging.info("Таблица ratings заменена на user_stats")
 
             # История обращений к ИИ
             cursor.execute("""
@@ -153,7 +361,25 @@ class Database:
                     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
                 )
             """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_history_user ON ai_history(user_id, created_at DESC)")
+            # Последние сообщения пользователя: поиск по (user_id, id), id растёт с записью
+            cursor.execute("DROP INDEX IF EXISTS idx_ai_history_user")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_history_user_id ON ai_history(user_id, id)")
+
+            # Архив старой истории: пачки сообщений пользователя в сжатом JSON (zlib)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ai_history_archive (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    first_id INTEGER NOT NULL,
+                    last_id INTEGER NOT NULL,
+                    messages INTEGER NOT NULL,
+                    first_at TIMESTAMP,
+                    last_at TIMESTAMP,
+                    payload BLOB NOT NULL,
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_history_archive_user ON ai_history_archive(user_id, last_id)")
 
             # Краткие summary по пользователю
             cursor.execute("""
@@ -165,6 +391,68 @@ class Database:
                 )
             """)
             
+            # Кэш ответов ИИ на типовые вопросы (время - unix timestamp для TTL/LRU)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ai_answer_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    prompt_hash TEXT NOT NULL UNIQUE, -- хэш персоны + нормализованного вопроса
+                    persona_key TEXT NOT NULL,
+                    prompt_norm TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    latency_ms REAL NOT NULL DEFAULT 0, -- сколько генерировался ответ
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_answer_cache_lru ON ai_answer_cache(last_used_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_answer_cache_created ON ai_answer_cache(created_at)")
+            # LSH-корзины MinHash для поиска похожих вопросов
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ai_answer_lsh (
+                    bucket INTEGER NOT NULL,
+                    entry_id INTEGER NOT NULL,
+                    PRIMARY KEY (bucket, entry_id),
+                    FOREIGN KEY (entry_id) REFERENCES ai_answer_cache(id) ON DELETE CASCADE
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_answer_lsh_entry ON ai_answer_lsh(entry_id)")
+
+            # Незавершённые тесты: только номера вопросов и выбранные ответы,
+            # сами вопросы берутся из общего кэша определений тестов
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS test_sessions (
+                    user_id INTEGER PRIMARY KEY,
+                    material_id INTEGER NOT NULL,
+                    question_ids TEXT NOT NULL,
+                    answers BLOB NOT NULL,
+                    updated_at REAL NOT NULL,
+                    FOREIGN KEY (material_id) REFERENCES materials(id) ON DELETE CASCADE
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_sessions_updated ON test_sessions(updated_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_sessions_material ON test_sessions(material_id)")
+
+            # Состояния диалогов aiogram (FSM), см. утилиты/fsm_storage.py
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_states (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}',
+                    updated_at REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
+
+            # Администраторы с ролями (дополнение к ADMIN_IDS, см. утилиты/auth.py)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS admins (
+                    user_id INTEGER PRIMARY KEY,
+                    role TEXT NOT NULL DEFAULT 'admin',
+                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
             conn.commit()
             logging.info("Database initialized successfully")
     
@@ -180,7 +468,8 @@ class Database:
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (user_id, name, age, country, city, datetime.now().isoformat(), datetime.now().isoformat()))
             conn.commit()
-            return True
+        self._notify("user", user_id)
+        return True
     
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получает информацию о пользователе"""
@@ -205,6 +494,51 @@ class Database:
             """, (datetime.now().isoformat(), user_id))
             conn.commit()
     
+    def update_users_activity(self, activity: Iterable[Tuple[int, str]]) -> int:
+        """Записывает время активности многих пользователей одной транзакцией
+        
+        Args:
+            activity: Пары (user_id, время последней активности в ISO)
+        
+        Returns:
+            Сколько пользователей обновлено
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                UPDATE users SET last_active = ? WHERE user_id = ?
+            """, ((last_active, user_id) for user_id, last_active in activity))
+            return cursor.rowcount
+    
+    # ===== АДМИНИСТРАТОРЫ =====
+    
+    def get_admin_roles(self) -> Dict[int, str]:
+        """Возвращает роли администраторов из таблицы admins: {user_id: роль}"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, role FROM admins")
+            return {row["user_id"]: row["role"] for row in cursor.fetchall()}
+    
+    def set_admin_role(self, user_id: int, role: str) -> None:
+        """Назначает пользователю роль администратора (или меняет её)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO admins (user_id, role) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET role = excluded.role
+            """, (user_id, role))
+        self._notify("admins", user_id)
+    
+    def remove_admin(self, user_id: int) -> bool:
+        """Удаляет пользователя из таблицы admins"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+            removed = cursor.rowcount > 0
+        if removed:
+            self._notify("admins", user_id)
+        return removed
+    
     # ===== МЕТОДЫ ДЛЯ МАТЕРИАЛОВ =====
     
     def add_material(self, title: str, text_content: str, level: str = "базовый", video_file_id: Optional[str] = None) -> int:
@@ -222,8 +556,28 @@ class Database:
                 INSERT INTO materials (title, text_content, level, video_file_id, created_at)
                 VALUES (?, ?, ?, ?, ?)
             """, (title, text_content, level, video_file_id, datetime.now().isoformat()))
+            material_id = cursor.lastrowid
+            self._store_material_pages(cursor, material_id, text_content)
             conn.commit()
-            return cursor.lastrowid
+            return material_id
+    
+    def _store_material_pages(self, cursor: sqlite3.Cursor, material_id: int, text_content: str) -> int:
+        """Рендерит текст материала в страницы и сохраняет их в material_pages
+        
+        Returns:
+            Количество страниц
+        """
+        pages = format_text(text_content, max_length=MATERIAL_PAGE_LENGTH)
+        cursor.execute("DELETE FROM material_pages WHERE material_id = ?", (material_id,))
+        cursor.executemany("""
+            INSERT INTO material_pages (material_id, page_index, html)
+            VALUES (?, ?, ?)
+        """, [(material_id, page_index, html) for page_index, html in enumerate(pages)])
+        cursor.execute("""
+            UPDATE materials SET rendered_with = ?, text_length = ?, page_count = ?
+            WHERE id = ?
+        """, (PAGE_RENDERER_VERSION, len(text_content), len(pages), material_id))
+        return len(pages)
     
     def get_material(self, material_id: int) -> Optional[Dict]:
         """Получает материал по ID"""
@@ -235,6 +589,39 @@ class Database:
                 return dict(row)
             return None
     
+    def get_material_page(self, material_id: int, page_index: int = 0) -> Optional[Dict]:
+        """Получает одну готовую страницу материала и его заголовочные данные
+        
+        Текст материала целиком не загружается: страница читается по
+        первичному ключу material_pages, длина текста и число страниц -
+        из колонок materials, записанных вместе со страницами.
+        
+        Returns:
+            Словарь (id, title, level, video_file_id, version, text_length,
+            total_pages, html) или None, если материал не найден.
+            html равен None, если страницы с таким номером нет.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT 
+                    m.id,
+                    m.title,
+                    m.level,
+                    m.video_file_id,
+                    m.version,
+                    m.text_length,
+                    m.page_count as total_pages,
+                    p.html
+                FROM materials m
+                LEFT JOIN material_pages p ON p.material_id = m.id AND p.page_index = ?
+                WHERE m.id = ?
+            """, (page_index, material_id))
+            row = cursor.fetchone()
+            if row:
+                return dict(row)
+            return None
+    
     def get_all_materials(self, level: Optional[str] = None) -> List[Dict]:
         """Получает все материалы, опционально фильтруя по уровню
         
@@ -249,6 +636,37 @@ class Database:
                 cursor.execute("SELECT * FROM materials ORDER BY level, id")
             return [dict(row) for row in cursor.fetchall()]
     
+    def get_materials_catalog(self, level: Optional[str] = None) -> List[Dict]:
+        """Каталог материалов для списков и меню выбора
+        
+        Один сгруппированный запрос без текста материала: id, title, level,
+        has_video и question_count. Порядок тот же, что у get_all_materials.
+        
+        Args:
+            level: Уровень сложности для фильтрации (базовый, средний, продвинутый)
+        """
+        query = """
+            SELECT m.id, m.title, m.level,
+                   m.video_file_id IS NOT NULL AND m.video_file_id != '' AS has_video,
+                   COALESCE(q.cnt, 0) AS question_count
+            FROM materials m
+            LEFT JOIN (
+                SELECT material_id, COUNT(*) AS cnt
+                FROM questions
+                GROUP BY material_id
+            ) q ON q.material_id = m.id
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            if level:
+                cursor.execute(query + " WHERE m.level = ? ORDER BY m.id", (level,))
+            else:
+                cursor.execute(query + " ORDER BY m.level, m.id")
+            return [
+                {**dict(row), 'has_video': bool(row['has_video'])}
+                for row in cursor.fetchall()
+            ]
+    
     def delete_material(self, material_id: int) -> bool:
         """Удаляет материал и все связанные вопросы/ответы
         
@@ -261,10 +679,22 @@ class Database:
             cursor.execute("SELECT 1 FROM materials WHERE id = ?", (material_id,))
             if not cursor.fetchone():
                 return False
+            # Пользователи, чей рейтинг изменится после каскадного удаления
+            cursor.execute("""
+                SELECT user_id FROM user_progress WHERE material_id = ?
+                UNION
+                SELECT user_id FROM test_results WHERE material_id = ?
+            """, (material_id, material_id))
+            affected_users = [row[0] for row in cursor.fetchall()]
             # Удаляем (каскадное удаление через FOREIGN KEY)
             cursor.execute("DELETE FROM materials WHERE id = ?", (material_id,))
+            if affected_users:
+                self._rebuild_user_stats(cursor, affected_users)
             conn.commit()
-            return True
+        self._notify("material", material_id)
+        if affected_users:
+            self._notify("ratings")
+        return True
     
     def update_material(self, material_id: int, title: Optional[str] = None, 
                        text_content: Optional[str] = None, level: Optional[str] = None,
@@ -301,14 +731,20 @@ class Database:
             if not updates:
                 return False
             
+            updates.append("version = version + 1")
             params.append(material_id)
             cursor.execute(f"""
                 UPDATE materials 
                 SET {', '.join(updates)}
                 WHERE id = ?
             """, params)
+            updated = cursor.rowcount > 0
+            if updated and text_content is not None:
+                self._store_material_pages(cursor, material_id, text_content)
             conn.commit()
-            return cursor.rowcount > 0
+        if updated:
+            self._notify("material", material_id)
+        return updated
     
     def append_to_material(self, material_id: int, additional_text: str) -> bool:
         """Добавляет текст к существующему материалу
@@ -331,62 +767,148 @@ class Database:
     # ===== МЕТОДЫ ДЛЯ ВОПРОСОВ И ОТВЕТОВ =====
     
     def add_question(self, material_id: int, question_text: str) -> int:
-        """Добавляет вопрос и возвращает его ID"""
+        """Добавляет вопрос и возвращает его ID (версия материала растёт)"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO questions (material_id, question_text)
                 VALUES (?, ?)
             """, (material_id, question_text))
+            question_id = cursor.lastrowid
+            cursor.execute("UPDATE materials SET version = version + 1 WHERE id = ?", (material_id,))
             conn.commit()
-            return cursor.lastrowid
+        self._notify("questions", material_id)
+        return question_id
     
     def add_answer(self, question_id: int, answer_text: str, is_correct: bool) -> int:
-        """Добавляет вариант ответа"""
+        """Добавляет вариант ответа (версия материала растёт)"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO answers (question_id, answer_text, is_correct)
                 VALUES (?, ?, ?)
             """, (question_id, answer_text, 1 if is_correct else 0))
+            answer_id = cursor.lastrowid
+            cursor.execute("""
+                UPDATE materials SET version = version + 1
+                WHERE id = (SELECT material_id FROM questions WHERE id = ?)
+                RETURNING id
+            """, (question_id,))
+            row = cursor.fetchone()
             conn.commit()
-            return cursor.lastrowid
+        if row:
+            self._notify("questions", row[0])
+        return answer_id
+    
+    def get_material_test(self, material_id: int) -> Optional[Dict]:
+        """Версия материала и его вопросы с ответами (исходные данные теста)
+        
+        Returns:
+            {'material_id', 'version', 'questions'} или None, если материала нет
+        """
+        with self._get_connection() as conn:
+            row = conn.execute("SELECT version FROM materials WHERE id = ?", (material_id,)).fetchone()
+            if not row:
+                return None
+            return {
+                'material_id': material_id,
+                'version': row['version'],
+                'questions': self.get_questions_for_material(material_id),
+            }
     
     def get_questions_for_material(self, material_id: int) -> List[Dict]:
-        """Получает все вопросы для материала с ответами"""
+        """Получает все вопросы для материала с ответами
+        
+        Вопросы и ответы читаются одним JOIN, ответы группируются по
+        вопросам уже в Python (вместо отдельного запроса на каждый вопрос).
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT q.id, q.question_text, q.material_id
+                SELECT q.id AS question_id, q.question_text, q.material_id,
+                       a.id AS answer_id, a.answer_text, a.is_correct
                 FROM questions q
+                LEFT JOIN answers a ON a.question_id = q.id
                 WHERE q.material_id = ?
-                ORDER BY q.id
+                ORDER BY q.id, a.id
             """, (material_id,))
-            questions = []
-            for q_row in cursor.fetchall():
-                question = dict(q_row)
-                # Получаем ответы для вопроса
-                cursor.execute("""
-                    SELECT id, answer_text, is_correct
-                    FROM answers
-                    WHERE question_id = ?
-                    ORDER BY id
-                """, (question['id'],))
-                question['answers'] = [dict(row) for row in cursor.fetchall()]
-                questions.append(question)
+            questions: List[Dict] = []
+            for row in cursor.fetchall():
+                if not questions or questions[-1]['id'] != row['question_id']:
+                    questions.append({
+                        'id': row['question_id'],
+                        'question_text': row['question_text'],
+                        'material_id': row['material_id'],
+                        'answers': [],
+                    })
+                # У вопроса без ответов LEFT JOIN вернёт одну строку с NULL
+                if row['answer_id'] is not None:
+                    questions[-1]['answers'].append({
+                        'id': row['answer_id'],
+                        'answer_text': row['answer_text'],
+                        'is_correct': row['is_correct'],
+                    })
             return questions
     
+    def count_questions(self, material_ids: Iterable[int]) -> Dict[int, int]:
+        """Считает вопросы сразу для нескольких материалов
+        
+        Returns:
+            {material_id: число вопросов}; материалы без вопросов - с нулём
+        """
+        ids = list(dict.fromkeys(material_ids))
+        counts = dict.fromkeys(ids, 0)
+        if not ids:
+            return counts
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            # Режем на пачки, чтобы не упереться в лимит параметров SQLite
+            for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+                chunk = ids[start:start + QUERY_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f"""
+                    SELECT material_id, COUNT(*) AS cnt
+                    FROM questions
+                    WHERE material_id IN ({placeholders})
+                    GROUP BY material_id
+                """, chunk)
+                for row in cursor.fetchall():
+                    counts[row['material_id']] = row['cnt']
+        return counts
+    
     # ===== МЕТОДЫ ДЛЯ ПРОГРЕССА =====
     
     def mark_material_studied(self, user_id: int, material_id: int) -> None:
-        """Отмечает материал как изученный"""
+        """Отмечает материал как изученный
+        
+        При первом изучении в той же транзакции увеличивает счётчик
+        материалов и баллы в user_stats. Повторное открытие только обновляет
+        studied_at и не сбрасывает кэши рейтинга (событие "progress_seen").
+        """
+        now = datetime.now().isoformat()
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                INSERT OR REPLACE INTO user_progress (user_id, material_id, studied_at)
+                INSERT OR IGNORE INTO user_progress (user_id, material_id, studied_at)
                 VALUES (?, ?, ?)
-            """, (user_id, material_id, datetime.now().isoformat()))
+            """, (user_id, material_id, now))
+            first_time = cursor.rowcount > 0
+            if first_time:
+                cursor.execute("""
+                    INSERT INTO user_stats (user_id, materials_studied, score, updated_at)
+                    VALUES (?, 1, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        materials_studied = materials_studied + 1,
+                        score = score + excluded.score,
+                        updated_at = excluded.updated_at
+                """, (user_id, MATERIAL_SCORE, now))
+            else:
+                cursor.execute("""
+                    UPDATE user_progress SET studied_at = ?
+                    WHERE user_id = ? AND material_id = ?
+                """, (now, user_id, material_id))
             conn.commit()
+        self._notify("progress" if first_time else "progress_seen", user_id)
     
     def is_material_studied(self, user_id: int, material_id: int) -> bool:
         """Проверяет, изучен ли материал"""
@@ -409,16 +931,24 @@ class Database:
     
     def save_test_result(self, user_id: int, material_id: int, correct: int, 
                         total: int, percentage: float) -> None:
-        """Сохраняет результат теста"""
+        """Сохраняет результат теста и в той же транзакции обновляет user_stats"""
+        now = datetime.now().isoformat()
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO test_results (user_id, material_id, correct, total, percentage, completed_at)
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (user_id, material_id, correct, total, percentage, datetime.now().isoformat()))
+            """, (user_id, material_id, correct, total, percentage, now))
+            cursor.execute("""
+                INSERT INTO user_stats (user_id, tests_completed, score, updated_at)
+                VALUES (?, 1, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    tests_completed = tests_completed + 1,
+                    score = score + excluded.score,
+                    updated_at = excluded.updated_at
+            """, (user_id, percentage * TEST_SCORE_FACTOR, now))
             conn.commit()
-            # Обновляем рейтинг
-            self._update_rating(user_id)
+        self._notify("test_result", user_id)
     
     def get_test_result(self, user_id: int, material_id: int) -> Optional[Dict]:
         """Получает последний результат теста"""
@@ -436,145 +966,242 @@ class Database:
                 return dict(row)
             return None
     
-    # ===== МЕТОДЫ ДЛЯ РЕЙТИНГА =====
+    # ===== НЕЗАВЕРШЁННЫЕ ТЕСТЫ =====
     
-    def _update_rating(self, user_id: int) -> None:
-        """Обновляет рейтинг пользователя"""
+    def save_test_session(self, user_id: int, material_id: int, question_ids: List[int],
+                          answers: bytes, updated_at: float) -> None:
+        """Сохраняет (или заменяет) незавершённый тест пользователя
+        
+        Args:
+            question_ids: ID вопросов в порядке показа
+            answers: Индексы выбранных ответов, по байту на вопрос
+            updated_at: Время последнего действия (time.time())
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            # Подсчитываем общий балл: изученные материалы + результаты тестов
             cursor.execute("""
-                SELECT 
-                    COALESCE(COUNT(DISTINCT up.material_id), 0) * 10 +
-                    COALESCE(SUM(tr.percentage) * 0.1, 0) as total_score
-                FROM users u
-                LEFT JOIN user_progress up ON u.user_id = up.user_id
-                LEFT JOIN test_results tr ON u.user_id = tr.user_id
-                WHERE u.user_id = ?
-                GROUP BY u.user_id
+                INSERT INTO test_sessions (user_id, material_id, question_ids, answers, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    material_id = excluded.material_id,
+                    question_ids = excluded.question_ids,
+                    answers = excluded.answers,
+                    updated_at = excluded.updated_at
+            """, (user_id, material_id, json.dumps(question_ids), answers, updated_at))
+    
+    def get_test_session(self, user_id: int) -> Optional[Dict]:
+        """Незавершённый тест пользователя или None"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT user_id, material_id, question_ids, answers, updated_at
+                FROM test_sessions WHERE user_id = ?
             """, (user_id,))
             row = cursor.fetchone()
-            total_score = row[0] if row else 0.0
-            
-            cursor.execute("""
-                INSERT OR REPLACE INTO ratings (user_id, total_score, updated_at)
-                VALUES (?, ?, ?)
-            """, (user_id, total_score, datetime.now().isoformat()))
-            conn.commit()
-            # Обновляем ранги всех пользователей
-            self._update_all_ranks()
+            if not row:
+                return None
+            session = dict(row)
+            session['question_ids'] = json.loads(session['question_ids'])
+            return session
     
-    def update_all_ratings(self) -> None:
-        """Обновляет рейтинги всех пользователей (вызывается при необходимости)"""
+    def delete_test_session(self, user_id: int) -> None:
+        """Удаляет незавершённый тест пользователя"""
+        with self._get_connection() as conn:
+            conn.execute("DELETE FROM test_sessions WHERE user_id = ?", (user_id,))
+    
+    def delete_expired_test_sessions(self, min_updated_at: float) -> int:
+        """Удаляет тесты без действий с min_updated_at и возвращает их число"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            # Получаем всех пользователей
-            cursor.execute("SELECT user_id FROM users")
-            users = cursor.fetchall()
-            
-            if not users:
-                # Нет пользователей - просто обновляем ранги (они будут пустыми)
-                self._update_all_ranks()
-                return
-            
-            for (user_id,) in users:
-                # Подсчитываем балл для каждого пользователя
-                cursor.execute("""
-                    SELECT 
-                        COALESCE(COUNT(DISTINCT up.material_id), 0) * 10 +
-                        COALESCE(SUM(tr.percentage) * 0.1, 0) as total_score
-                    FROM users u
-                    LEFT JOIN user_progress up ON u.user_id = up.user_id
-                    LEFT JOIN test_results tr ON u.user_id = tr.user_id
-                    WHERE u.user_id = ?
-                    GROUP BY u.user_id
-                """, (user_id,))
-                row = cursor.fetchone()
-                total_score = row[0] if row else 0.0
-                
-                cursor.execute("""
-                    INSERT OR REPLACE INTO ratings (user_id, total_score, updated_at)
-                    VALUES (?, ?, ?)
-                """, (user_id, total_score, datetime.now().isoformat()))
-            
-            conn.commit()
-            # Обновляем ранги
-            self._update_all_ranks()
+            cursor.execute("DELETE FROM test_sessions WHERE updated_at < ?", (min_updated_at,))
+            return cursor.rowcount
+    
+    def count_test_sessions(self) -> int:
+        """Число сохранённых незавершённых тестов"""
+        with self._get_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM test_sessions").fetchone()[0]
+    
+    # ===== СОСТОЯНИЯ ДИАЛОГОВ (FSM) =====
+    
+    def get_fsm_record(self, key: str) -> Optional[Dict]:
+        """Состояние диалога по ключу: {'state', 'data' (JSON), 'updated_at'} или None"""
+        with self._get_connection() as conn:
+            row = conn.execute(
+                "SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)
+            ).fetchone()
+            return dict(row) if row else None
+    
+    def save_fsm_records(self, records: Iterable[Tuple[str, Optional[str], str, float]]) -> int:
+        """Сохраняет пачку состояний диалогов одной транзакцией
+        
+        Args:
+            records: (key, state, data в JSON, updated_at); запись без состояния
+                и с пустыми данными удаляется
+        
+        Returns:
+            Сколько записей обработано
+        """
+        upserts = []
+        deletes = []
+        for key, state, data, updated_at in records:
+            if state is None and data == "{}":
+                deletes.append((key,))
+            else:
+                upserts.append((key, state, data, updated_at))
+        with self._get_connection() as conn:
+            if upserts:
+                conn.executemany("""
+                    INSERT INTO fsm_states (key, state, data, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state = excluded.state,
+                        data = excluded.data,
+                        updated_at = excluded.updated_at
+                """, upserts)
+            if deletes:
+                conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+        return len(upserts) + len(deletes)
     
-    def _update_all_ranks(self) -> None:
-        """Обновляет ранги всех пользователей"""
+    def delete_expired_fsm_records(self, min_updated_at: float) -> int:
+        """Удаляет состояния диалогов без действий с min_updated_at и возвращает их число"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT user_id, total_score
-                FROM ratings
-                ORDER BY total_score DESC
-            """)
-            users = cursor.fetchall()
-            for rank, (user_id, _) in enumerate(users, 1):
-                cursor.execute("""
-                    UPDATE ratings SET rank = ? WHERE user_id = ?
-                """, (rank, user_id))
+            cursor.execute("DELETE FROM fsm_states WHERE updated_at < ?", (min_updated_at,))
+            return cursor.rowcount
+    
+    def count_fsm_records(self) -> int:
+        """Число сохранённых состояний диалогов"""
+        with self._get_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM fsm_states").fetchone()[0]
+    
+    # ===== МЕТОДЫ ДЛЯ РЕЙТИНГА =====
+    
+    def _rebuild_user_stats(self, cursor: sqlite3.Cursor,
+                            user_ids: Optional[List[int]] = None) -> int:
+        """Пересчитывает user_stats с нуля одним запросом
+        
+        Прогресс и результаты тестов агрегируются отдельно (по одному проходу
+        по каждой таблице), затем все строки записываются одним upsert.
+        Явный список пользователей обрабатывается частями по QUERY_CHUNK_SIZE.
+        
+        Args:
+            cursor: Курсор открытой транзакции
+            user_ids: Ограничить пересчёт этими пользователями (None - все)
+        
+        Returns:
+            Количество пересчитанных пользователей
+        """
+        if user_ids is not None:
+            # Список ID режется на части, чтобы не упереться в лимит параметров SQLite
+            updated = 0
+            for start in range(0, len(user_ids), QUERY_CHUNK_SIZE):
+                chunk = user_ids[start:start + QUERY_CHUNK_SIZE]
+                updated += self._upsert_user_stats(
+                    cursor, f"u.user_id IN ({', '.join('?' * len(chunk))})", chunk
+                )
+            return updated
+        return self._upsert_user_stats(cursor, "true", [])
+    
+    @staticmethod
+    def _upsert_user_stats(cursor: sqlite3.Cursor, where: str, where_params: List) -> int:
+        """Один upsert user_stats для пользователей, отобранных условием where"""
+        params: List = [MATERIAL_SCORE, TEST_SCORE_FACTOR, datetime.now().isoformat()]
+        params.extend(where_params)
+        cursor.execute(f"""
+            INSERT INTO user_stats (user_id, materials_studied, tests_completed, score, updated_at)
+            SELECT 
+                u.user_id,
+                COALESCE(p.studied, 0),
+                COALESCE(t.tests, 0),
+                COALESCE(p.studied, 0) * ? + COALESCE(t.percentage_sum, 0) * ?,
+                ?
+            FROM users u
+            LEFT JOIN (
+                SELECT user_id, COUNT(*) as studied
+                FROM user_progress
+                GROUP BY user_id
+            ) p ON p.user_id = u.user_id
+            LEFT JOIN (
+                SELECT user_id, COUNT(*) as tests, SUM(percentage) as percentage_sum
+                FROM test_results
+                GROUP BY user_id
+            ) t ON t.user_id = u.user_id
+            WHERE {where}
+            ON CONFLICT(user_id) DO UPDATE SET materials_studied = excluded.materials_studied,
+                                               tests_completed = excluded.tests_completed,
+                                               score = excluded.score,
+                                               updated_at = excluded.updated_at
+        """, params)
+        return cursor.rowcount
+    
+    def update_all_ratings(self) -> None:
+        """Пересчитывает рейтинги (user_stats) всех пользователей одним запросом
+        
+        В обычной работе счётчики обновляются инкрементально; полный пересчёт
+        нужен только для восстановления после ручных правок БД.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            updated = self._rebuild_user_stats(cursor)
             conn.commit()
+        self._notify("ratings")
+        logging.info("Рейтинги пересчитаны: %s пользователей", updated)
     
     def get_leaderboard(self, limit: int = 10) -> List[Dict]:
-        """Возвращает рейтинг пользователей"""
+        """Возвращает рейтинг пользователей
+        
+        ТОП читается первыми строками индекса idx_user_stats_rank
+        (score DESC, user_id); счётчики берутся из той же строки user_stats.
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
+                WITH top AS (
+                    SELECT user_id, score, materials_studied, tests_completed
+                    FROM user_stats
+                    ORDER BY score DESC, user_id
+                    LIMIT ?
+                )
                 SELECT 
                     u.user_id,
                     u.name,
                     u.age,
                     u.country,
                     u.city,
-                    r.total_score,
-                    r.rank,
-                    COUNT(DISTINCT up.material_id) as materials_studied,
-                    COUNT(DISTINCT tr.id) as tests_completed
-                FROM users u
-                LEFT JOIN ratings r ON u.user_id = r.user_id
-                LEFT JOIN user_progress up ON u.user_id = up.user_id
-                LEFT JOIN test_results tr ON u.user_id = tr.user_id
-                WHERE r.rank IS NOT NULL
-                GROUP BY u.user_id, u.name, u.age, u.country, u.city, r.total_score, r.rank
-                ORDER BY r.rank
-                LIMIT ?
+                    t.score as total_score,
+                    ROW_NUMBER() OVER (ORDER BY t.score DESC, t.user_id) as rank,
+                    t.materials_studied,
+                    t.tests_completed
+                FROM top t
+                JOIN users u ON u.user_id = t.user_id
+                ORDER BY rank
             """, (limit,))
-            rows = cursor.fetchall()
-            return [
-                {
-                    'user_id': row[0],
-                    'name': row[1],
-                    'age': row[2],
-                    'country': row[3],
-                    'city': row[4],
-                    'total_score': row[5],
-                    'rank': row[6],
-                    'materials_studied': row[7],
-                    'tests_completed': row[8]
-                }
-                for row in rows
-            ]
+            return [dict(row) for row in cursor.fetchall()]
     
     def get_user_rank(self, user_id: int) -> Optional[Dict]:
-        """Возвращает место пользователя в рейтинге"""
+        """Возвращает место пользователя в рейтинге
+        
+        Место = число пользователей выше по индексу idx_user_stats_rank + 1.
+        Если статистики у пользователя ещё нет, rank будет None.
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT 
                     u.user_id,
                     u.name,
-                    r.rank,
-                    r.total_score,
-                    COUNT(DISTINCT up.material_id) as materials_studied,
-                    COUNT(DISTINCT tr.id) as tests_completed
+                    CASE WHEN s.user_id IS NULL THEN NULL ELSE (
+                        SELECT COUNT(*) + 1
+                        FROM user_stats s2
+                        WHERE s2.score > s.score
+                           OR (s2.score = s.score AND s2.user_id < s.user_id)
+                    ) END as rank,
+                    s.score as total_score,
+                    COALESCE(s.materials_studied, 0) as materials_studied,
+                    COALESCE(s.tests_completed, 0) as tests_completed
                 FROM users u
-                LEFT JOIN ratings r ON u.user_id = r.user_id
-                LEFT JOIN user_progress up ON u.user_id = up.user_id
-                LEFT JOIN test_results tr ON u.user_id = tr.user_id
+                LEFT JOIN user_stats s ON u.user_id = s.user_id
                 WHERE u.user_id = ?
-                GROUP BY u.user_id, u.name, r.rank, r.total_score
             """, (user_id,))
             row = cursor.fetchone()
             if row:
@@ -593,15 +1220,28 @@ class Database:
             """, (user_id, role, content, datetime.now().isoformat()))
             conn.commit()
 
+    def get_last_ai_message_at(self, user_id: int) -> Optional[str]:
+        """Время последнего сообщения пользователя в ai_history (ISO) или None"""
+        with self._get_connection() as conn:
+            row = conn.execute("""
+                SELECT created_at FROM ai_history
+                WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT 1
+            """, (user_id,)).fetchone()
+            return row[0] if row else None
+    
     def get_ai_history(self, user_id: int, limit: int = 6) -> List[Dict]:
         """Возвращает последние сообщения ИИ/пользователя для контекста."""
         with self._get_connection() as conn:
             cursor = conn.cursor()
+            # id растёт вместе со временем записи: обратный обход индекса
+            # (user_id, id) без сортировки, строки читаются по rowid
             cursor.execute("""
                 SELECT role, content, created_at
                 FROM ai_history
                 WHERE user_id = ?
-                ORDER BY created_at DESC
+                ORDER BY id DESC
                 LIMIT ?
             """, (user_id, limit))
             rows = cursor.fetchall()
@@ -618,6 +1258,7 @@ class Database:
                                                 updated_at = excluded.updated_at
             """, (user_id, summary_text, datetime.now().isoformat()))
             conn.commit()
+        self._notify("summary", user_id)
 
     def get_ai_summary(self, user_id: int) -> Optional[str]:
         """Возвращает сохранённое summary пользователя."""
@@ -629,22 +1270,256 @@ class Database:
             row = cursor.fetchone()
             return row[0] if row else None
 
-    # ===== Снимки прогресса для ИИ =====
+    def archive_ai_history(self, keep_last: int, hard_cap: int, batch_size: int,
+                           after_user_id: int = 0) -> Tuple[int, Optional[int]]:
+        """Переносит старую историю ИИ в сжатый архив (одна короткая транзакция)
+        
+        В архив уходят сообщения пользователя старше последних keep_last, уже
+        учтённые в summary (created_at <= ai_summaries.updated_at), а также
+        всё старше последних hard_cap независимо от summary.
+        
+        Пользователи обходятся по возрастанию user_id начиная после
+        after_user_id, не больше ARCHIVE_USERS_PER_BATCH за вызов: пользователи
+        выбираются поиском по индексу, для каждого читается не больше
+        hard_cap + batch_size строк - транзакция не сканирует всю таблицу.
+        
+        Returns:
+            (сколько сообщений перенесено, user_id для следующего вызова
+             или None, если проход по таблице закончен)
+        """
+        archived = 0
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            # Следующие пользователи по индексу (user_id, id): каждый шаг - один
+            # поиск в индексе, строки истории не перебираются и не считаются
+            cursor.execute("""
+                WITH RECURSIVE batch(user_id, n) AS (
+                    SELECT (SELECT MIN(user_id) FROM ai_history WHERE user_id > ?), 1
+                    UNION ALL
+                    SELECT (SELECT MIN(user_id) FROM ai_history WHERE user_id > batch.user_id), n + 1
+                    FROM batch
+                    WHERE batch.user_id IS NOT NULL AND n < ?
+                )
+                SELECT user_id FROM batch WHERE user_id IS NOT NULL
+            """, (after_user_id, ARCHIVE_USERS_PER_BATCH))
+            user_ids = [row[0] for row in cursor.fetchall()]
+            next_user_id = user_ids[-1] if len(user_ids) == ARCHIVE_USERS_PER_BATCH else None
 
-    def get_user_snapshot(self, user_id: int) -> Dict:
-        """Краткий профиль пользователя для контекста ИИ."""
-        user = self.get_user(user_id) or {}
-        progress_ids = self.get_user_progress(user_id)
-        studied_count = len(progress_ids)
+            for user_id in user_ids:
+                # Граница "последних keep_last" и жёсткого лимита по id
+                cursor.execute("""
+                    SELECT
+                        (SELECT id FROM ai_history WHERE user_id = :user_id
+                         ORDER BY id DESC LIMIT 1 OFFSET :keep_last) AS keep_cutoff,
+                        (SELECT id FROM ai_history WHERE user_id = :user_id
+                         ORDER BY id DESC LIMIT 1 OFFSET :hard_cap) AS cap_cutoff,
+                        (SELECT updated_at FROM ai_summaries WHERE user_id = :user_id) AS summary_at
+                """, {"user_id": user_id, "keep_last": keep_last, "hard_cap": hard_cap})
+                bounds = cursor.fetchone()
+                # Не больше keep_last сообщений - переносить нечего
+                if bounds["keep_cutoff"] is None:
+                    continue
+                limit = batch_size - archived
+                cursor.execute("""
+                    SELECT id, role, content, created_at
+                    FROM ai_history
+                    WHERE user_id = :user_id AND id <= :keep_cutoff
+                      AND (created_at <= :summary_at OR id <= :cap_cutoff)
+                    ORDER BY id
+                    LIMIT :limit
+                """, {
+                    "user_id": user_id,
+                    "keep_cutoff": bounds["keep_cutoff"],
+                    "summary_at": bounds["summary_at"],
+                    "cap_cutoff": bounds["cap_cutoff"] if bounds["cap_cutoff"] is not None else 0,
+                    "limit": limit,
+                })
+                rows = cursor.fetchall()
+                if not rows:
+                    continue
+
+                payload = zlib.compress(json.dumps(
+                    [dict(row) for row in rows], ensure_ascii=False
+                ).encode("utf-8"), 6)
+                cursor.execute("""
+                    INSERT INTO ai_history_archive
+                        (user_id, first_id, last_id, messages, first_at, last_at, payload)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (user_id, rows[0]["id"], rows[-1]["id"], len(rows),
+                      rows[0]["created_at"], rows[-1]["created_at"], payload))
+                cursor.executemany(
+                    "DELETE FROM ai_history WHERE id = ?", [(row["id"],) for row in rows]
+                )
+                archived += len(rows)
+                if len(rows) == limit:
+                    # Пачка заполнена - у пользователя может остаться ещё, продолжим с него
+                    next_user_id = user_id - 1
+                    break
+        return archived, next_user_id
+
+    def get_archived_ai_history(self, user_id: int) -> List[Dict]:
+        """Распаковывает архив истории пользователя (старые вперёд)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT payload FROM ai_history_archive
+                WHERE user_id = ?
+                ORDER BY last_id
+            """, (user_id,))
+            messages: List[Dict] = []
+            for row in cursor.fetchall():
+                messages.extend(json.loads(zlib.decompress(row[0]).decode("utf-8")))
+            return messages
+
+    def ai_history_stats(self) -> Dict[str, int]:
+        """Размер горячей истории и архива (для метрик)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM ai_history) AS hot_rows,
+                    (SELECT COUNT(*) FROM ai_history_archive) AS archive_blobs,
+                    (SELECT COALESCE(SUM(messages), 0) FROM ai_history_archive) AS archived_rows,
+                    (SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM ai_history_archive) AS archive_bytes
+            """)
+            return dict(cursor.fetchone())
+
+    # ===== КЭШ ОТВЕТОВ ИИ =====
+
+    def get_cached_answer(self, prompt_hash: str, min_created_at: float) -> Optional[Dict]:
+        """Ищет ответ по точному хэшу вопроса (не старше min_created_at)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, prompt_norm, answer, latency_ms
+                FROM ai_answer_cache
+                WHERE prompt_hash = ? AND created_at >= ?
+            """, (prompt_hash, min_created_at))
+            row = cursor.fetchone()
+            return dict(row) if row else None
 
-        last_materials = self.get_recent_materials_for_user(user_id, limit=3)
-        recent_tests = self.get_recent_tests(user_id, limit=3)
+    def get_similar_cached_answers(self, persona_key: str, buckets: List[int],
+                                   min_created_at: float, limit: int = 20) -> List[Dict]:
+        """Кандидаты из тех же LSH-корзин (похожесть проверяет вызывающий код)"""
+        if not buckets:
+            return []
+        placeholders = ",".join("?" * len(buckets))
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT c.id, c.prompt_norm, c.answer, c.latency_ms
+                FROM ai_answer_cache c
+                WHERE c.id IN (
+                    SELECT entry_id FROM ai_answer_lsh WHERE bucket IN ({placeholders})
+                )
+                  AND c.persona_key = ? AND c.created_at >= ?
+                LIMIT ?
+            """, (*buckets, persona_key, min_created_at, limit))
+            return [dict(row) for row in cursor.fetchall()]
 
+    def store_cached_answer(self, prompt_hash: str, persona_key: str, prompt_norm: str,
+                            answer: str, latency_ms: float, buckets: List[int],
+                            max_entries: int, min_created_at: float) -> None:
+        """Сохраняет ответ в кэш, удаляет устаревшие и лишние (LRU) записи"""
+        now = time.time()
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO ai_answer_cache
+                    (prompt_hash, persona_key, prompt_norm, answer, latency_ms, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(prompt_hash) DO UPDATE SET answer = excluded.answer,
+                                                      latency_ms = excluded.latency_ms,
+                                                      created_at = excluded.created_at,
+                                                      last_used_at = excluded.last_used_at
+            """, (prompt_hash, persona_key, prompt_norm, answer, latency_ms, now, now))
+            cursor.execute("SELECT id FROM ai_answer_cache WHERE prompt_hash = ?", (prompt_hash,))
+            entry_id = cursor.fetchone()[0]
+            cursor.execute("DELETE FROM ai_answer_lsh WHERE entry_id = ?", (entry_id,))
+            cursor.executemany(
+                "INSERT OR IGNORE INTO ai_answer_lsh (bucket, entry_id) VALUES (?, ?)",
+                [(bucket, entry_id) for bucket in buckets],
+            )
+
+            # Устаревшие по TTL и самые давно не использованные сверх лимита
+            cursor.execute("DELETE FROM ai_answer_cache WHERE created_at < ?", (min_created_at,))
+            cursor.execute("""
+                DELETE FROM ai_answer_cache WHERE id IN (
+                    SELECT id FROM ai_answer_cache
+                    ORDER BY last_used_at
+                    LIMIT MAX(0, (SELECT COUNT(*) FROM ai_answer_cache) - ?)
+                )
+            """, (max_entries,))
+
+    def touch_cached_answer(self, entry_id: int) -> None:
+        """Отмечает использование записи кэша (для LRU и статистики)"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE ai_answer_cache SET hits = hits + 1, last_used_at = ?
+                WHERE id = ?
+            """, (time.time(), entry_id))
+
+    def count_cached_answers(self) -> int:
+        """Число записей в кэше ответов ИИ"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM ai_answer_cache")
+            return cursor.fetchone()[0]
+
+    # ===== Снимки прогресса для ИИ =====
+
+    def get_user_snapshot(self, user_id: int) -> Dict:
+        """Краткий профиль пользователя для контекста ИИ.
+        
+        Один запрос с CTE: профиль, число изученных материалов, последние
+        материалы и тесты (собираются в JSON-массивы) и summary диалога.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                WITH last_materials AS (
+                    SELECT m.id, m.title, m.level, up.studied_at
+                    FROM user_progress up
+                    JOIN materials m ON m.id = up.material_id
+                    WHERE up.user_id = :user_id
+                    ORDER BY up.studied_at DESC
+                    LIMIT :limit
+                ),
+                recent_tests AS (
+                    SELECT tr.material_id, tr.correct, tr.total, tr.percentage,
+                           tr.completed_at, m.title
+                    FROM test_results tr
+                    LEFT JOIN materials m ON m.id = tr.material_id
+                    WHERE tr.user_id = :user_id
+                    ORDER BY tr.completed_at DESC
+                    LIMIT :limit
+                )
+                SELECT
+                    (SELECT json_object('user_id', u.user_id, 'name', u.name, 'age', u.age,
+                                        'country', u.country, 'city', u.city,
+                                        'registered_at', u.registered_at,
+                                        'last_active', u.last_active)
+                     FROM users u WHERE u.user_id = :user_id) AS user,
+                    (SELECT COUNT(*) FROM user_progress WHERE user_id = :user_id) AS studied_count,
+                    (SELECT json_group_array(json_object('id', id, 'title', title, 'level', level,
+                                                         'studied_at', studied_at))
+                     FROM last_materials) AS last_materials,
+                    (SELECT json_group_array(json_object('material_id', material_id,
+                                                         'correct', correct, 'total', total,
+                                                         'percentage', percentage,
+                                                         'completed_at', completed_at,
+                                                         'title', title))
+                     FROM recent_tests) AS recent_tests,
+                    (SELECT summary_text FROM ai_summaries WHERE user_id = :user_id) AS summary
+            """, {"user_id": user_id, "limit": 3})
+            row = cursor.fetchone()
         return {
-            "user": user,
-            "studied_count": studied_count,
-            "last_materials": last_materials,
-            "recent_tests": recent_tests,
+            "user": json.loads(row["user"]) if row["user"] else {},
+            "studied_count": row["studied_count"],
+            "last_materials": json.loads(row["last_materials"]),
+            "recent_tests": json.loads(row["recent_tests"]),
+            "summary": row["summary"],
         }
 
     def get_recent_materials_for_user(self, user_id: int, limit: int = 3) -> List[Dict]:
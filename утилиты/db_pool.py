@@ -0,0 +1,193 @@
+"""
+Пул подключений к SQLite
+
+Принцип разделения ответственности:
+- Только открытие, выдача и возврат подключений
+- Не содержит SQL бизнес-логики (она в database.py)
+
+Зачем нужен пул:
+- sqlite3.connect + PRAGMA на каждый вызов метода БД стоят дорого
+- Долгоживущее подключение хранит кэш подготовленных выражений (cached_statements)
+- PRAGMA выполняются один раз при создании подключения
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Sequence
+
+# PRAGMA, которые выполняются один раз для каждого нового подключения
+DEFAULT_PRAGMAS = (
+    "PRAGMA foreign_keys = ON;",
+)
+
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих подключений к SQLite
+
+    Повторный запрос подключения в том же потоке (например, метод БД
+    вызывает другой метод БД) возвращает уже выданное подключение,
+    поэтому вложенные вызовы не занимают лишних слотов пула.
+    """
+
+    def __init__(self, db_path: Path, max_size: int = 5, timeout: float = 10.0,
+                 pragmas: Sequence[str] = DEFAULT_PRAGMAS, cached_statements: int = 256):
+        """
+        Args:
+            db_path: Путь к файлу базы данных
+            max_size: Максимальное число открытых подключений
+            timeout: Сколько секунд ждать свободное подключение
+            pragmas: PRAGMA, выполняемые при создании подключения
+            cached_statements: Размер кэша подготовленных выражений на подключение
+        """
+        self.db_path = db_path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.pragmas = tuple(pragmas)
+        self.cached_statements = cached_statements
+
+        # LIFO: чаще выдаём самые "тёплые" подключения
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+        # Метрики для подбора размера пула под нагрузкой
+        self._hits = 0
+        self._misses = 0
+        self._reentrant = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """Открывает новое подключение и выполняет PRAGMA один раз"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,  # подключение может переходить между потоками пула
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        """Берёт свободное подключение, создаёт новое или ждёт освобождения"""
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Пул подключений закрыт")
+            can_create = self._created < self.max_size
+            if can_create:
+                self._created += 1
+                self._misses += 1
+
+        if can_create:
+            try:
+                return self._create_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Пул исчерпан - ждём, пока кто-нибудь вернёт подключение
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise sqlite3.OperationalError(
+                f"Нет свободных подключений к БД за {self.timeout:.1f} с (размер пула {self.max_size})"
+            )
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        """Возвращает подключение в пул"""
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Выдаёт подключение на время блока with
+
+        Как и sqlite3.Connection в with: при успешном выходе транзакция
+        фиксируется, при исключении - откатывается. Для вложенных вызовов
+        в том же потоке это делает только самый внешний блок.
+        """
+        held: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if held is not None:
+            with self._lock:
+                self._reentrant += 1
+            yield held
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def close(self) -> None:
+        """Закрывает все свободные подключения (занятые закроются при возврате)"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+        logging.info("Пул подключений к БД закрыт")
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики пула: попадания, ожидания и занятость"""
+        with self._lock:
+            idle = self._idle.qsize()
+            checkouts = self._hits + self._misses + self._waits
+            return {
+                "size": self._created,
+                "max_size": self.max_size,
+                "idle": idle,
+                "in_use": self._created - idle,
+                "checkouts": checkouts,
+                "hits": self._hits,
+                "misses": self._misses,
+                "reentrant": self._reentrant,
+                "hit_rate": (self._hits / checkouts) if checkouts else 0.0,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_avg_ms": (self._wait_total / self._waits * 1000) if self._waits else 0.0,
+                "wait_max_ms": self._wait_max * 1000,
+            }
@@ -0,0 +1,244 @@
+"""
+Хранилище состояний диалогов aiogram (FSM) в SQLite
+
+Принцип разделения ответственности:
+- Только хранение состояния и данных диалога по ключу aiogram
+- SQL - в database.py (таблица fsm_states), сами диалоги -
+  в обработчики/commands.py (регистрация) и обработчики/admin.py
+
+Как устроено:
+- Ключ - строка DefaultKeyBuilder (бот, чат, пользователь, destiny),
+  данные хранятся в JSON
+- Изменения копятся в памяти и записываются пачкой раз в
+  FSM_FLUSH_INTERVAL секунд: set_state + update_data одного обработчика
+  дают одну запись, а не две. При остановке накопленное записывается
+- Прочитанные состояния держатся в LRU на FSM_CACHE_SIZE ключей не дольше
+  FSM_CACHE_TTL секунд; FSMContextMiddleware читает состояние на каждое
+  обновление, поэтому без кэша каждое сообщение - запрос к БД
+- Диалог без действий дольше FSM_STATE_TTL секунд считается брошенным:
+  при чтении он пустой, фоновая задача удаляет такие записи из БД
+- Несколько копий бота с одной БД: FSM_FLUSH_INTERVAL=0 и FSM_CACHE_SIZE=0,
+  тогда каждое изменение сразу видно остальным
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from config import FSM_CACHE_SIZE, FSM_CACHE_TTL, FSM_FLUSH_INTERVAL, FSM_PURGE_INTERVAL, FSM_STATE_TTL
+from .async_database import AsyncDatabase, async_db
+
+
+class FsmRecord(NamedTuple):
+    """Состояние диалога: как оно лежит в строке fsm_states"""
+    state: Optional[str]
+    data: str
+    updated_at: float
+
+
+EMPTY_RECORD = FsmRecord(None, "{}", 0.0)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх таблицы fsm_states"""
+
+    def __init__(self, database: AsyncDatabase, ttl: float = FSM_STATE_TTL,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, cache_size: int = FSM_CACHE_SIZE,
+                 cache_ttl: float = FSM_CACHE_TTL, purge_interval: float = FSM_PURGE_INTERVAL,
+                 key_builder: Optional[KeyBuilder] = None):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            ttl: Через сколько секунд без действий диалог забывается
+            flush_interval: Как часто записывать изменения в БД, секунд (0 - сразу)
+            cache_size: Сколько состояний держать в памяти (0 - без кэша)
+            cache_ttl: Сколько секунд доверять состоянию из кэша
+            purge_interval: Как часто удалять просроченные состояния из БД, секунд
+            key_builder: Построитель строкового ключа из StorageKey
+        """
+        self._db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = max(0, cache_size)
+        self.cache_ttl = cache_ttl
+        self.purge_interval = purge_interval
+        self._key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # Всё ниже меняется только из цикла событий, блокировки не нужны
+        # Изменения, ещё не записанные в БД, и пачка, которая пишется сейчас
+        self._pending: Dict[str, FsmRecord] = {}
+        self._flushing: Dict[str, FsmRecord] = {}
+        # key -> (запись, время загрузки по monotonic)
+        self._cache: "OrderedDict[str, Tuple[FsmRecord, float]]" = OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._last_purge = time.monotonic()
+
+        # Метрики
+        self._reads = 0
+        self._cache_hits = 0
+        self._db_reads = 0
+        self._writes = 0
+        self._flushes = 0
+        self._flushed = 0
+        self._failures = 0
+        self._expired = 0
+
+    def _cache_put(self, key: str, record: FsmRecord) -> None:
+        if not self.cache_size:
+            return
+        cached = self._cache.get(key)
+        # Чтение, начатое до записи, не должно затереть более новое состояние
+        if cached is not None and cached[0].updated_at > record.updated_at:
+            return
+        self._cache[key] = (record, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str) -> FsmRecord:
+        """Текущее состояние: несохранённое, из кэша или из БД"""
+        self._reads += 1
+        record = self._pending.get(key) or self._flushing.get(key)
+        if record is None:
+            cached = self._cache.get(key)
+            if cached is not None and time.monotonic() - cached[1] < self.cache_ttl:
+                self._cache.move_to_end(key)
+                record = cached[0]
+        if record is not None:
+            self._cache_hits += 1
+        else:
+            self._db_reads += 1
+            row = await self._db.get_fsm_record(key)
+            record = FsmRecord(row['state'], row['data'], row['updated_at']) if row else EMPTY_RECORD
+            # Пока шло чтение, состояние могли изменить
+            record = self._pending.get(key) or self._flushing.get(key) or record
+            self._cache_put(key, record)
+        if record.updated_at and time.time() - record.updated_at > self.ttl:
+            self._expired += 1
+            return EMPTY_RECORD
+        return record
+
+    async def _store(self, key: str, state: Optional[str], data: str) -> None:
+        record = FsmRecord(state, data, time.time())
+        self._pending[key] = record
+        self._cache_put(key, record)
+        self._writes += 1
+        if self.flush_interval <= 0:
+            await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        """Устанавливает состояние диалога (данные не меняются)"""
+        db_key = self._key_builder.build(key)
+        current = await self._load(db_key)
+        await self._store(db_key, state.state if isinstance(state, State) else state, current.data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        """Текущее состояние диалога или None"""
+        return (await self._load(self._key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        """Заменяет данные диалога (состояние не меняется)"""
+        db_key = self._key_builder.build(key)
+        current = await self._load(db_key)
+        await self._store(db_key, current.state, json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        """Данные диалога (новый dict, изменения не сохраняются без set_data)"""
+        return json.loads((await self._load(self._key_builder.build(key))).data)
+
+    async def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией
+
+        Returns:
+            Сколько записей сохранено
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            self._flushing, self._pending = self._pending, {}
+            batch = [(key, *record) for key, record in self._flushing.items()]
+            try:
+                written = await self._db.save_fsm_records(batch)
+            except Exception:
+                # Не теряем изменения: вернём их в очередь, более новые важнее
+                self._failures += 1
+                self._pending = {**self._flushing, **self._pending}
+                raise
+            finally:
+                self._flushing = {}
+            self._flushes += 1
+            self._flushed += written
+            return written
+
+    async def purge_expired(self) -> int:
+        """Удаляет брошенные диалоги из памяти и БД
+
+        Returns:
+            Сколько записей удалено из БД
+        """
+        min_updated_at = time.time() - self.ttl
+        for key in [k for k, (record, _) in self._cache.items() if record.updated_at < min_updated_at]:
+            del self._cache[key]
+        return await self._db.delete_expired_fsm_records(min_updated_at)
+
+    async def _loop(self) -> None:
+        interval = self.flush_interval if self.flush_interval > 0 else self.purge_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Не удалось записать состояния диалогов: %s", exc)
+            if self.purge_interval > 0 and time.monotonic() - self._last_purge >= self.purge_interval:
+                self._last_purge = time.monotonic()
+                try:
+                    removed = await self.purge_expired()
+                    if removed:
+                        logging.info("Удалено брошенных диалогов: %d", removed)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logging.warning("Не удалось удалить брошенные диалоги: %s", exc)
+
+    def start(self) -> None:
+        """Запускает фоновую запись изменений и удаление брошенных диалогов"""
+        if self._task is None and (self.flush_interval > 0 or self.purge_interval > 0):
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновую задачу и записывает накопленные изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.error("Состояния диалогов не записаны при остановке: %s", exc)
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: чтения из кэша и БД, записи и их схлопывание"""
+        return {
+            "reads": self._reads,
+            "cache_hits": self._cache_hits,
+            "db_reads": self._db_reads,
+            "hit_rate": (self._cache_hits / self._reads) if self._reads else 0.0,
+            "cached": len(self._cache),
+            "cache_size": self.cache_size,
+            "writes": self._writes,
+            "pending": len(self._pending),
+            "flushes": self._flushes,
+            "flushed": self._flushed,
+            "coalesced": max(0, self._writes - self._flushed - len(self._pending)),
+            "failures": self._failures,
+            "expired": self._expired,
+            "flush_interval_s": self.flush_interval,
+            "ttl_s": self.ttl,
+        }
+
+
+# Глобальное хранилище состояний диалогов
+fsm_storage = SQLiteStorage(async_db)
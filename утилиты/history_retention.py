@@ -0,0 +1,129 @@
+"""
+Перенос старой истории диалога с ИИ в архив
+
+Принцип разделения ответственности:
+- Только расписание и метрики переноса
+- SQL отбора и сжатия (archive_ai_history) - в database.py,
+  сворачивание истории в summary - в обработчики/ai.py
+
+Как устроено:
+- В ai_history остаются последние AI_HISTORY_KEEP_LAST сообщений пользователя
+  и всё, что ещё не учтено в summary; более старые сообщения уже "свёрнуты"
+  в ai_summaries и переносятся в ai_history_archive сжатыми пачками
+- Сообщения старше последних AI_HISTORY_HARD_CAP уходят в архив всегда
+- Перенос идёт пачками (не больше AI_HISTORY_ARCHIVE_BATCH сообщений и
+  нескольких десятков пользователей по возрастанию user_id): каждая пачка -
+  отдельная короткая транзакция в потоке-писателе, между пачками успевают
+  выполниться обычные записи бота
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from config import (
+    AI_HISTORY_ARCHIVE_BATCH,
+    AI_HISTORY_HARD_CAP,
+    AI_HISTORY_KEEP_LAST,
+    AI_HISTORY_RETENTION_INTERVAL,
+)
+from .async_database import AsyncDatabase, async_db
+
+# Пауза между пачками, секунд: очередь писателя успевает разобрать записи бота
+BATCH_PAUSE = 0.05
+
+
+class HistoryRetention:
+    """Периодический перенос старых сообщений ai_history в архив"""
+
+    def __init__(self, database: AsyncDatabase,
+                 keep_last: int = AI_HISTORY_KEEP_LAST,
+                 hard_cap: int = AI_HISTORY_HARD_CAP,
+                 batch_size: int = AI_HISTORY_ARCHIVE_BATCH,
+                 interval: float = AI_HISTORY_RETENTION_INTERVAL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            keep_last: Сколько последних сообщений пользователя не трогать
+            hard_cap: Сколько сообщений пользователя хранить максимум
+            batch_size: Максимум сообщений за одну транзакцию
+            interval: Пауза между запусками, секунд (0 - фоновая задача не нужна)
+        """
+        self._db = database
+        self.keep_last = max(1, keep_last)
+        self.hard_cap = max(self.keep_last, hard_cap)
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+        # Метрики
+        self._runs = 0
+        self._batches = 0
+        self._archived = 0
+        self._failures = 0
+        self._batch_max = 0.0
+        self._last_run: Optional[float] = None
+
+    async def run_once(self) -> int:
+        """Переносит в архив всё, что подходит под правила, пачками
+
+        Returns:
+            Сколько сообщений перенесено
+        """
+        total = 0
+        after_user_id: Optional[int] = 0
+        while after_user_id is not None:
+            started = time.perf_counter()
+            archived, after_user_id = await self._db.archive_ai_history(
+                self.keep_last, self.hard_cap, self.batch_size, after_user_id
+            )
+            self._batch_max = max(self._batch_max, time.perf_counter() - started)
+            self._batches += 1
+            total += archived
+            self._archived += archived
+            if after_user_id is not None:
+                await asyncio.sleep(BATCH_PAUSE)
+        self._runs += 1
+        self._last_run = time.time()
+        return total
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                archived = await self.run_once()
+                if archived:
+                    logging.info("История ИИ: в архив перенесено %d сообщений", archived)
+            except Exception as exc:  # pylint: disable=broad-except
+                self._failures += 1
+                logging.warning("Не удалось перенести историю ИИ в архив: %s", exc)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """Запускает фоновую задачу (если интервал задан)"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновую задачу"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: запуски, пачки, перенесённые сообщения"""
+        return {
+            "keep_last": self.keep_last,
+            "hard_cap": self.hard_cap,
+            "runs": self._runs,
+            "batches": self._batches,
+            "archived": self._archived,
+            "failures": self._failures,
+            "batch_max_ms": self._batch_max * 1000,
+            "last_run_ago_s": (time.time() - self._last_run) if self._last_run else -1,
+        }
+
+
+# Глобальный перенос истории ИИ в архив
+history_retention = HistoryRetention(async_db)
@@ -5,6 +5,8 @@
 - Только создание и форматирование клавиатур
 - Не содержит бизнес-логики
 """
+from typing import Sequence
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
@@ -132,6 +134,42 @@ def build_material_navigation_keyboard(
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def build_test_answer_keyboard(material_id: int, question_index: int,
+                               answers: Sequence[str]) -> InlineKeyboardMarkup:
+    """
+    Создает клавиатуру с вариантами ответов на вопрос теста
+    
+    Клавиатура не зависит от пользователя и строится один раз при компиляции
+    теста (утилиты/test_definitions.py); чей это тест, обработчик узнаёт
+    по отправителю callback'а
+    
+    Args:
+        material_id: ID материала
+        question_index: Индекс вопроса
+        answers: Тексты вариантов ответа
+    
+    Returns:
+        InlineKeyboardMarkup с вариантами ответа и кнопкой отмены
+    """
+    buttons = []
+    
+    for i, answer_text in enumerate(answers):
+        button_text = answer_text[:50] + "..." if len(answer_text) > 50 else answer_text
+        # Формат: test_answer:material_id:question_index:answer_index
+        buttons.append([
+            InlineKeyboardButton(
+                text=f"{chr(65 + i)}. {button_text}",
+                callback_data=f"test_answer:{material_id}:{question_index}:{i}"
+            )
+        ])
+    
+    buttons.append([
+        InlineKeyboardButton(text="❌ Отменить тест", callback_data=f"test_cancel:{material_id}")
+    ])
+    
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 def build_material_info_keyboard(material_id: int) -> InlineKeyboardMarkup:
     """
     Создает клавиатуру для страницы информации о материале
@@ -0,0 +1,186 @@
+"""
+Сервис рейтинга: общий кэш ТОПа для /leaderboard и кнопки "Рейтинг"
+
+Принцип разделения ответственности:
+- Только выборка ТОПа, его кэширование и форматирование текста
+- SQL остаётся в database.py, отправка сообщений - в обработчиках
+
+Как работает кэш:
+- Строки ТОПа и готовый HTML-текст хранятся в памяти процесса
+- Запись результата теста/прогресса помечает кэш устаревшим; пока возраст
+  кэша меньше LEADERBOARD_CACHE_TTL, пользователи получают сохранённый текст,
+  а ТОП перечитывается в фоне (одним запросом на всех)
+- Старше TTL кэш не отдаётся никогда - это граница "несвежести"
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config import LEADERBOARD_CACHE_TTL
+from .async_database import AsyncDatabase, async_db
+
+# События БД, после которых ТОП может измениться
+RATING_EVENTS = frozenset({"user", "progress", "test_result", "ratings"})
+
+MEDALS = ["🥇", "🥈", "🥉"]
+
+
+def render_leaderboard(rows: List[Dict], limit: int) -> str:
+    """Форматирует ТОП пользователей в HTML"""
+    text = f"🏆 <b>ТОП-{limit} ПОЛЬЗОВАТЕЛЕЙ</b>\n\n"
+    
+    for entry in rows:
+        rank = entry['rank']
+        medal = MEDALS[rank - 1] if rank <= 3 else "  "
+        name = entry['name']
+        score = entry['total_score']
+        materials = entry['materials_studied'] or 0
+        tests = entry['tests_completed'] or 0
+        country = entry.get('country', 'Неизвестно') or 'Неизвестно'
+        city = entry.get('city', 'Неизвестно') or 'Неизвестно'
+        age = entry.get('age', 'Неизвестно') or 'Неизвестно'
+        
+        text += (
+            f"{medal} <b>#{rank}</b> {name}\n"
+            f"   🌍 {country}, {city} | 👤 {age} лет\n"
+            f"   ⭐ Баллов: {score:.1f} | "
+            f"📚 Материалов: {materials} | "
+            f"📝 Тестов: {tests}\n\n"
+        )
+    
+    return text
+
+
+def render_user_rank(user_rank: Optional[Dict], limit: int) -> str:
+    """Форматирует место пользователя, если он не попал в ТОП"""
+    if not user_rank or not user_rank.get('rank'):
+        return ""
+    
+    rank = user_rank['rank']
+    if rank <= limit:
+        return ""
+    
+    text = f"\n━━━━━━━━━━━━━━━━━━━━\n"
+    text += f"📍 <b>Ваше место: #{rank}</b>\n"
+    text += f"⭐ Баллов: {user_rank['total_score']:.1f}\n"
+    text += f"📚 Материалов: {user_rank['materials_studied'] or 0}\n"
+    text += f"📝 Тестов: {user_rank['tests_completed'] or 0}"
+    return text
+
+
+class LeaderboardService:
+    """Кэширует ТОП рейтинга и его отрисованный текст"""
+
+    def __init__(self, database: AsyncDatabase, limit: int = 10,
+                 ttl: float = LEADERBOARD_CACHE_TTL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            limit: Размер ТОПа
+            ttl: Максимальный возраст кэша в секундах
+        """
+        self._db = database
+        self.limit = limit
+        self.ttl = ttl
+
+        self._rows: Optional[List[Dict]] = None
+        self._text: Optional[str] = None
+        self._loaded_at = 0.0
+        self._dirty = False
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Подписчик БД вызывается из потока-писателя
+        self._state_lock = threading.Lock()
+
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+        database.sync.add_listener(self._on_db_change)
+
+    def _on_db_change(self, event: str, entity_id: Optional[int]) -> None:
+        if event in RATING_EVENTS:
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        """Помечает кэш устаревшим (он будет обновлён при следующем запросе)"""
+        with self._state_lock:
+            self._dirty = True
+            self._invalidations += 1
+
+    async def _refresh(self) -> None:
+        """Перечитывает ТОП из БД (один запрос, даже если ждут многие)"""
+        async with self._refresh_lock:
+            with self._state_lock:
+                if self._rows is not None and not self._dirty and self._age() < self.ttl:
+                    return  # кто-то уже обновил, пока мы ждали
+                self._dirty = False
+                self._misses += 1
+            try:
+                rows = await self._db.get_leaderboard(limit=self.limit)
+            except Exception:
+                with self._state_lock:
+                    self._dirty = True
+                raise
+            text = render_leaderboard(rows, self.limit) if rows else None
+            with self._state_lock:
+                self._rows, self._text = rows, text
+                self._loaded_at = time.monotonic()
+
+    def _age(self) -> float:
+        return time.monotonic() - self._loaded_at
+
+    def _refresh_in_background(self) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+            self._refresh_task.add_done_callback(self._log_refresh_error)
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logging.warning("Не удалось обновить кэш рейтинга: %s", task.exception())
+
+    async def _ensure_fresh(self) -> None:
+        with self._state_lock:
+            cached = self._rows is not None and self._age() < self.ttl
+            dirty = self._dirty
+            if cached:
+                if dirty:
+                    self._stale_hits += 1
+                else:
+                    self._hits += 1
+        if not cached:
+            await self._refresh()
+        elif dirty:
+            self._refresh_in_background()
+
+    async def get_rows(self) -> List[Dict]:
+        """Строки ТОПа (из кэша или БД)"""
+        await self._ensure_fresh()
+        return self._rows or []
+
+    async def get_text(self) -> Optional[str]:
+        """Готовый HTML-текст ТОПа или None, если рейтинг пуст"""
+        await self._ensure_fresh()
+        return self._text
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов кэша"""
+        with self._state_lock:
+            requests = self._hits + self._stale_hits + self._misses
+            return {
+                "hits": self._hits,
+                "stale_hits": self._stale_hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_rate": ((self._hits + self._stale_hits) / requests) if requests else 0.0,
+                "age_s": self._age() if self._rows is not None else 0.0,
+                "ttl_s": self.ttl,
+            }
+
+
+# Глобальный сервис рейтинга
+leaderboard = LeaderboardService(async_db)
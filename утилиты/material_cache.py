@@ -0,0 +1,156 @@
+"""
+Кэш страниц материалов
+
+Принцип разделения ответственности:
+- Только хранение уже отформатированных страниц материалов
+- Форматирование выполняется при записи материала (database.py),
+  страницы хранятся в таблице material_pages
+
+Зачем нужен кэш:
+- Без кэша каждое нажатие "Далее ▶️" - запрос к БД
+- С кэшем переход на уже открытую страницу - поиск в словаре без обращения к БД
+- При промахе читается одна страница по первичному ключу, а не весь текст
+
+Кэш сбрасывается по событию "material" из БД (update_material,
+append_to_material, delete_material), размер ограничен по LRU, а возраст -
+MATERIAL_CACHE_TTL (на случай изменений из другого процесса бота).
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from config import MATERIAL_CACHE_SIZE, MATERIAL_CACHE_TTL
+from .async_database import AsyncDatabase, async_db
+
+
+class MaterialPages:
+    """Заголовочные данные материала и уже загруженные страницы"""
+    __slots__ = ("material_id", "version", "title", "level", "video_file_id",
+                 "text_length", "total_pages", "pages", "loaded_at")
+
+    def __init__(self, row: Dict):
+        self.material_id: int = row['id']
+        self.version: int = row['version']
+        self.title: str = row['title']
+        self.level: str = row['level'] or 'базовый'
+        self.video_file_id: Optional[str] = row['video_file_id']
+        self.text_length: int = row['text_length'] or 0
+        self.total_pages: int = row['total_pages']
+        self.pages: Dict[int, str] = {}
+        self.loaded_at = time.monotonic()
+
+    def page(self, page_index: int) -> str:
+        """Текст страницы (первая, если индекс вне диапазона)"""
+        if page_index in self.pages:
+            return self.pages[page_index]
+        return self.pages.get(0, "")
+
+
+class MaterialPageCache:
+    """LRU-кэш страниц материалов с инвалидацией по событиям БД"""
+
+    def __init__(self, database: AsyncDatabase, max_entries: int = MATERIAL_CACHE_SIZE,
+                 ttl: float = MATERIAL_CACHE_TTL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            max_entries: Сколько материалов держать в памяти
+            ttl: Максимальный возраст записи в секундах
+        """
+        self._db = database
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, MaterialPages]" = OrderedDict()
+        # Подписчик БД вызывается из потока-писателя
+        self._lock = threading.Lock()
+        # Растёт при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+        database.sync.add_listener(self._on_db_change)
+
+    def _on_db_change(self, event: str, entity_id: Optional[int]) -> None:
+        if event == "material" and entity_id is not None:
+            self.invalidate(entity_id)
+
+    def invalidate(self, material_id: int) -> None:
+        """Удаляет материал из кэша"""
+        with self._lock:
+            self._entries.pop(material_id, None)
+            self._generation += 1
+            self._invalidations += 1
+
+    def _lookup(self, material_id: int, page_index: int) -> Optional[MaterialPages]:
+        """Ищет запись с нужной страницей (вызывается под блокировкой)"""
+        entry = self._entries.get(material_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.loaded_at >= self.ttl:
+            del self._entries[material_id]
+            return None
+        if page_index not in entry.pages:
+            # Номер вне диапазона отдаём первой страницей, если она уже загружена
+            out_of_range = not 0 <= page_index < entry.total_pages
+            if not (out_of_range and (0 in entry.pages or entry.total_pages == 0)):
+                return None
+        self._entries.move_to_end(material_id)
+        return entry
+
+    async def get(self, material_id: int, page_index: int = 0) -> Optional[MaterialPages]:
+        """Возвращает материал с загруженной страницей page_index
+
+        Returns:
+            MaterialPages или None, если материала нет
+        """
+        with self._lock:
+            entry = self._lookup(material_id, page_index)
+            if entry is not None:
+                self._hits += 1
+                return entry
+            self._misses += 1
+            generation = self._generation
+
+        row = await self._db.get_material_page(material_id, page_index)
+        if not row:
+            return None
+        if row['html'] is None and page_index != 0 and row['total_pages']:
+            # Страницы с таким номером нет - покажем первую
+            page_index = 0
+            row = await self._db.get_material_page(material_id, page_index)
+            if not row:
+                return None
+
+        with self._lock:
+            entry = self._entries.get(material_id)
+            if entry is None or entry.version != row['version']:
+                entry = MaterialPages(row)
+            if row['html'] is not None:
+                entry.pages[page_index] = row['html']
+            if generation == self._generation:
+                self._entries[material_id] = entry
+                self._entries.move_to_end(material_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов кэша"""
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "pages": sum(len(entry.pages) for entry in self._entries.values()),
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_rate": (self._hits / requests) if requests else 0.0,
+            }
+
+
+# Глобальный кэш страниц материалов
+material_pages = MaterialPageCache(async_db)
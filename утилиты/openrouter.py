@@ -0,0 +1,344 @@
+"""
+Асинхронный клиент OpenRouter (chat completions)
+
+Принцип разделения ответственности:
+- Только HTTP: сессия, пул соединений, таймауты, разбор ответа
+- Сборка промпта и работа с историей остаются в обработчики/ai.py
+
+Как устроено:
+- Одна aiohttp.ClientSession на весь процесс: TLS-соединения переиспользуются
+  (keep-alive), а не открываются заново на каждый /ask
+- TCPConnector ограничивает число соединений всего и на один хост
+- Базовый URL задаётся в config (OPENROUTER_BASE_URL), поэтому клиент
+  можно направить на локальную заглушку
+- stream_chat читает ответ потоком (SSE) и отдаёт текст по кусочкам
+- На 429 и 502/503/504 запрос повторяется с паузой (Retry-After или
+  экспоненциальная задержка с джиттером)
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+
+from config import (
+    OPENROUTER_BASE_URL,
+    OPENROUTER_CONNECT_TIMEOUT,
+    OPENROUTER_KEEPALIVE,
+    OPENROUTER_MAX_CONNECTIONS,
+    OPENROUTER_MAX_PER_HOST,
+    OPENROUTER_MAX_RETRIES,
+    OPENROUTER_MODEL,
+    OPENROUTER_RETRY_BASE_DELAY,
+    OPENROUTER_RETRY_MAX_DELAY,
+    OPENROUTER_TIMEOUT,
+)
+
+# Статусы, после которых запрос имеет смысл повторить
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+
+def retry_delay(attempt: int, retry_after: Optional[str],
+                base: float, max_delay: float) -> Optional[float]:
+    """Пауза перед повтором: Retry-After или экспонента с полным джиттером
+
+    Returns:
+        Секунды ожидания или None, если сервер просит ждать дольше max_delay
+    """
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            seconds = None  # формат HTTP-даты не разбираем - считаем сами
+        if seconds is not None:
+            if seconds > max_delay:
+                return None
+            # Небольшой джиттер, чтобы ожидавшие не вернулись одновременно
+            return seconds + random.uniform(0, base)
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+
+class OpenRouterError(Exception):
+    """Ошибка запроса к OpenRouter (HTTP-статус, сеть или формат ответа)"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class OpenRouterClient:
+    """Общий асинхронный HTTP-клиент с пулом keep-alive соединений"""
+
+    def __init__(self, base_url: str = OPENROUTER_BASE_URL,
+                 timeout: float = OPENROUTER_TIMEOUT,
+                 connect_timeout: float = OPENROUTER_CONNECT_TIMEOUT,
+                 max_connections: int = OPENROUTER_MAX_CONNECTIONS,
+                 max_per_host: int = OPENROUTER_MAX_PER_HOST,
+                 keepalive: float = OPENROUTER_KEEPALIVE,
+                 max_retries: int = OPENROUTER_MAX_RETRIES,
+                 retry_base_delay: float = OPENROUTER_RETRY_BASE_DELAY,
+                 retry_max_delay: float = OPENROUTER_RETRY_MAX_DELAY):
+        """
+        Args:
+            base_url: Базовый URL API (без /chat/completions)
+            timeout: Полный таймаут запроса по умолчанию, секунд
+            connect_timeout: Таймаут установки соединения, секунд
+            max_connections: Максимум открытых соединений
+            max_per_host: Максимум соединений к одному хосту
+            keepalive: Сколько секунд держать простаивающее соединение
+            max_retries: Сколько раз повторять запрос при 429/5xx
+            retry_base_delay: Базовая пауза экспоненциальной задержки, секунд
+            retry_max_delay: Максимальная пауза перед повтором, секунд
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.keepalive = keepalive
+        self.max_retries = max(0, max_retries)
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+        # Сессия создаётся лениво: ей нужен уже запущенный event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_lock = asyncio.Lock()
+
+        # Метрики
+        self._requests = 0
+        self._errors = 0
+        self._in_flight = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._connections_created = 0
+        self._connections_reused = 0
+        self._retries = 0
+        self._rate_limited = 0
+
+    async def _on_connection_create(self, session, context, params) -> None:
+        """Трассировка aiohttp: открыто новое соединение"""
+        self._connections_created += 1
+
+    async def _on_connection_reuse(self, session, context, params) -> None:
+        """Трассировка aiohttp: взято соединение из пула keep-alive"""
+        self._connections_reused += 1
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая её при первом запросе"""
+        if self._session is not None and not self._session.closed:
+            return self._session
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.max_connections,
+                    limit_per_host=self.max_per_host,
+                    keepalive_timeout=self.keepalive,
+                    ttl_dns_cache=300,
+                )
+                # Считаем новые и переиспользованные соединения (эффект keep-alive)
+                trace = aiohttp.TraceConfig()
+                trace.on_connection_create_end.append(self._on_connection_create)
+                trace.on_connection_reuseconn.append(self._on_connection_reuse)
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    trace_configs=[trace],
+                    timeout=aiohttp.ClientTimeout(
+                        total=self.timeout, connect=self.connect_timeout
+                    ),
+                    headers={"Content-Type": "application/json"},
+                )
+            return self._session
+
+    @asynccontextmanager
+    async def _post(self, payload: Dict, headers: Dict[str, str],
+                    timeout: aiohttp.ClientTimeout) -> AsyncIterator[aiohttp.ClientResponse]:
+        """POST /chat/completions с повторами; отдаёт успешный ответ
+
+        Raises:
+            OpenRouterError: при HTTP-статусе >= 400 после всех повторов
+        """
+        session = await self._get_session()
+        attempt = 0
+        while True:
+            response = await session.post(
+                f"{self.base_url}/chat/completions",
+                json=payload,
+                headers=headers,
+                timeout=timeout,
+            )
+            if response.status == 429:
+                self._rate_limited += 1
+            delay = None
+            if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                delay = retry_delay(
+                    attempt, response.headers.get("Retry-After"),
+                    self.retry_base_delay, self.retry_max_delay,
+                )
+            if delay is None:
+                break
+            response.release()
+            attempt += 1
+            self._retries += 1
+            logging.info(
+                "OpenRouter ответил %s, повтор %d/%d через %.1f с",
+                response.status, attempt, self.max_retries, delay,
+            )
+            await asyncio.sleep(delay)
+
+        try:
+            if response.status >= 400:
+                body = await response.text()
+                raise OpenRouterError(
+                    f"HTTP {response.status}: {body[:200]}", status=response.status
+                )
+            yield response
+        finally:
+            response.release()
+
+    async def chat(self, api_key: str, messages: List[Dict[str, str]],
+                   model: str = OPENROUTER_MODEL,
+                   timeout: Optional[float] = None) -> str:
+        """Отправляет диалог в модель и возвращает текст ответа
+
+        Args:
+            api_key: Ключ OpenRouter
+            messages: Сообщения в формате chat completions
+            model: Идентификатор модели
+            timeout: Полный таймаут этого запроса (по умолчанию - из конструктора)
+
+        Raises:
+            OpenRouterError: при ошибке сети, HTTP-статусе >= 400 (после повторов)
+                             или таймауте
+        """
+        request_timeout = aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else self.timeout,
+            connect=self.connect_timeout,
+        )
+        payload = {"model": model, "messages": messages}
+        headers = {"Authorization": f"Bearer {api_key}"}
+
+        self._requests += 1
+        self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            async with self._post(payload, headers, request_timeout) as response:
+                data = await response.json(content_type=None)
+        except OpenRouterError:
+            self._errors += 1
+            raise
+        except asyncio.TimeoutError as exc:
+            self._errors += 1
+            raise OpenRouterError("Превышено время ожидания ответа") from exc
+        except (aiohttp.ClientError, ValueError) as exc:
+            self._errors += 1
+            raise OpenRouterError(str(exc) or exc.__class__.__name__) from exc
+        finally:
+            self._in_flight -= 1
+            elapsed = time.perf_counter() - started
+            self._latency_total += elapsed
+            self._latency_max = max(self._latency_max, elapsed)
+
+        return (
+            data.get("choices", [{}])[0]
+            .get("message", {})
+            .get("content", "")
+        ) or ""
+
+    async def stream_chat(self, api_key: str, messages: List[Dict[str, str]],
+                          model: str = OPENROUTER_MODEL,
+                          timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Отправляет диалог в модель и отдаёт ответ по мере генерации (SSE)
+
+        Args:
+            api_key: Ключ OpenRouter
+            messages: Сообщения в формате chat completions
+            model: Идентификатор модели
+            timeout: Максимальная пауза между кусками ответа, секунд
+                     (общего лимита нет: длинный ответ может идти долго)
+
+        Yields:
+            Очередной фрагмент текста ответа
+
+        Raises:
+            OpenRouterError: при ошибке сети, HTTP-статусе >= 400, паузе
+                             дольше timeout или ошибке внутри потока
+        """
+        request_timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=self.connect_timeout,
+            sock_read=timeout if timeout is not None else self.timeout,
+        )
+        payload = {"model": model, "messages": messages, "stream": True}
+        headers = {"Authorization": f"Bearer {api_key}", "Accept": "text/event-stream"}
+
+        self._requests += 1
+        self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            async with self._post(payload, headers, request_timeout) as response:
+                # События SSE: строки "data: {...}", комментарии начинаются с ":"
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    error = chunk.get("error")
+                    if error:
+                        raise OpenRouterError(
+                            str(error.get("message", error) if isinstance(error, dict) else error)
+                        )
+                    delta = (
+                        chunk.get("choices", [{}])[0]
+                        .get("delta", {})
+                        .get("content")
+                    )
+                    if delta:
+                        yield delta
+        except OpenRouterError:
+            self._errors += 1
+            raise
+        except asyncio.TimeoutError as exc:
+            self._errors += 1
+            raise OpenRouterError("Превышено время ожидания ответа") from exc
+        except (aiohttp.ClientError, ValueError) as exc:
+            self._errors += 1
+            raise OpenRouterError(str(exc) or exc.__class__.__name__) from exc
+        finally:
+            self._in_flight -= 1
+            elapsed = time.perf_counter() - started
+            self._latency_total += elapsed
+            self._latency_max = max(self._latency_max, elapsed)
+
+    async def close(self) -> None:
+        """Закрывает сессию и все соединения пула"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logging.info("HTTP-сессия OpenRouter закрыта")
+        self._session = None
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики клиента: запросы, ошибки, задержки, соединения"""
+        return {
+            "requests": self._requests,
+            "errors": self._errors,
+            "in_flight": self._in_flight,
+            "latency_avg_ms": (self._latency_total / self._requests * 1000) if self._requests else 0.0,
+            "latency_max_ms": self._latency_max * 1000,
+            "max_connections": self.max_connections,
+            "max_per_host": self.max_per_host,
+            "connections_created": self._connections_created,
+            "connections_reused": self._connections_reused,
+            "retries": self._retries,
+            "rate_limited": self._rate_limited,
+        }
+
+
+# Глобальный клиент (сессия откроется при первом запросе)
+openrouter = OpenRouterClient()
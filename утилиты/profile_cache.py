@@ -0,0 +1,101 @@
+"""
+Кэш профилей пользователей (строка users) по user_id
+
+Принцип разделения ответственности:
+- Только кэширование результата get_user
+- SQL - в database.py, подстановка профиля в обработчики -
+  в обработчики/middlewares.py
+
+Как устроено:
+- LRU на USER_PROFILE_CACHE_SIZE записей с TTL USER_PROFILE_CACHE_TTL
+- Кэшируется и отсутствие профиля (незарегистрированный пользователь),
+  чтобы повторные нажатия до регистрации не ходили в БД
+- Запись сбрасывается событием БД "user" (register_user), поэтому
+  только что зарегистрированный пользователь сразу виден
+- last_active в профиле может отставать: время активности пишется
+  отложенно (утилиты/activity_buffer.py) и обработчикам не нужно
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from config import USER_PROFILE_CACHE_SIZE, USER_PROFILE_CACHE_TTL
+from .async_database import AsyncDatabase, async_db
+
+
+class UserProfileCache:
+    """LRU/TTL-кэш профиля пользователя с инвалидацией по событиям БД"""
+
+    def __init__(self, database: AsyncDatabase, max_entries: int = USER_PROFILE_CACHE_SIZE,
+                 ttl: float = USER_PROFILE_CACHE_TTL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            max_entries: Сколько пользователей держать в памяти
+            ttl: Максимальный возраст записи, секунд
+        """
+        self._db = database
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        # user_id -> (профиль или None, время загрузки)
+        self._entries: "OrderedDict[int, Tuple[Optional[Dict], float]]" = OrderedDict()
+        # Подписчик БД вызывается из потока-писателя
+        self._lock = threading.Lock()
+        # Растёт при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+        database.sync.add_listener(self._on_db_change)
+
+    def _on_db_change(self, event: str, entity_id: Optional[int]) -> None:
+        if event == "user" and entity_id is not None:
+            self.invalidate(entity_id)
+
+    def invalidate(self, user_id: int) -> None:
+        """Удаляет профиль пользователя из кэша"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generation += 1
+            self._invalidations += 1
+
+    async def get(self, user_id: int) -> Optional[Dict]:
+        """Возвращает профиль пользователя или None, если он не зарегистрирован"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            generation = self._generation
+
+        profile = await self._db.get_user(user_id)
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (profile, time.monotonic())
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return profile
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов кэша"""
+        with self._lock:
+            requests = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_rate": (self._hits / requests) if requests else 0.0,
+            }
+
+
+# Глобальный кэш профилей
+user_profiles = UserProfileCache(async_db)
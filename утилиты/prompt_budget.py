@@ -0,0 +1,170 @@
+"""
+Сборка промпта /ask в пределах бюджета токенов
+
+Принцип разделения ответственности:
+- Только подсчёт токенов и решение, что из контекста поместится в запрос
+- Тексты персоны, контекста и истории готовит обработчики/ai.py
+
+Как устроено:
+- Токены оцениваются локально по регулярному выражению, без токенизатора
+  модели: латиница ~4 символа на токен, кириллица ~2.5, знак - 1 токен
+- Персона и вопрос ученика попадают в запрос всегда
+- Длинные сообщения истории сначала укорачиваются до лимита на сообщение
+- Если бюджет превышен, сначала выбрасываются старые сообщения истории,
+  затем обрезается блок контекста ученика (summary стоит в его конце)
+"""
+import logging
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+from config import AI_HISTORY_MESSAGE_TOKENS, AI_PROMPT_TOKEN_BUDGET
+
+# Слова (латиница/цифры и кириллица отдельно) и одиночные знаки
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+|[А-Яа-яЁё]+|[^\sA-Za-z0-9_А-Яа-яЁё]")
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+TRUNCATION_MARK = "…"
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов в тексте"""
+    tokens = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        word = match.group()
+        if word[0].isascii():
+            tokens += math.ceil(len(word) / 4) if word[0].isalnum() or word[0] == "_" else 1
+        elif word[0].isalpha():
+            tokens += math.ceil(len(word) / 2.5)
+        else:
+            tokens += 1
+    return tokens
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    """Токены сообщения вместе со служебными"""
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст с конца так, чтобы он уложился в max_tokens"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # Двоичный поиск по длине: оценка монотонна по префиксу
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) + 1 <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low].rstrip() + TRUNCATION_MARK
+
+
+class PromptBudget:
+    """Собирает сообщения для модели, укладываясь в бюджет токенов"""
+
+    def __init__(self, budget: int = AI_PROMPT_TOKEN_BUDGET,
+                 message_cap: int = AI_HISTORY_MESSAGE_TOKENS):
+        """
+        Args:
+            budget: Максимум токенов во входе модели
+            message_cap: Максимум токенов на одно сообщение истории
+        """
+        self.budget = budget
+        self.message_cap = message_cap
+
+        # Метрики
+        self._requests = 0
+        self._tokens_total = 0
+        self._tokens_max = 0
+        self._trimmed = 0
+        self._history_dropped = 0
+
+    def assemble(self, persona: Dict[str, str], context: Optional[Dict[str, str]],
+                 history: List[Dict[str, str]], prompt: Dict[str, str]
+                 ) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+        """Собирает промпт: персона, контекст, история, вопрос
+
+        Returns:
+            (сообщения для модели, отчёт с числом токенов по частям)
+        """
+        fixed = message_tokens(persona) + message_tokens(prompt)
+
+        # Длинные ответы в истории укорачиваем заранее
+        history = [
+            {**item, "content": truncate_to_tokens(item["content"], self.message_cap)}
+            for item in history
+        ]
+        history_costs = [message_tokens(item) for item in history]
+        context_cost = message_tokens(context) if context else 0
+
+        # Старые сообщения истории уходят первыми
+        dropped = 0
+        while history and fixed + context_cost + sum(history_costs) > self.budget:
+            history.pop(0)
+            history_costs.pop(0)
+            dropped += 1
+
+        # Затем обрезаем контекст ученика с конца
+        context_trimmed = False
+        if context and fixed + context_cost > self.budget:
+            allowed = self.budget - fixed - MESSAGE_OVERHEAD
+            content = truncate_to_tokens(context["content"], allowed)
+            context = {**context, "content": content} if content else None
+            context_cost = message_tokens(context) if context else 0
+            context_trimmed = True
+
+        messages = [persona]
+        if context:
+            messages.append(context)
+        messages += history
+        messages.append(prompt)
+
+        report = {
+            "budget": self.budget,
+            "total": fixed + context_cost + sum(history_costs),
+            "persona": message_tokens(persona),
+            "context": context_cost,
+            "history": sum(history_costs),
+            "history_kept": len(history),
+            "history_dropped": dropped,
+            "prompt": message_tokens(prompt),
+            "context_trimmed": int(context_trimmed),
+        }
+
+        self._requests += 1
+        self._tokens_total += report["total"]
+        self._tokens_max = max(self._tokens_max, report["total"])
+        if dropped or context_trimmed:
+            self._trimmed += 1
+        self._history_dropped += dropped
+        return messages, report
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: средний и максимальный размер промпта, обрезки"""
+        return {
+            "budget": self.budget,
+            "requests": self._requests,
+            "tokens_avg": (self._tokens_total / self._requests) if self._requests else 0.0,
+            "tokens_max": self._tokens_max,
+            "trimmed": self._trimmed,
+            "history_dropped": self._history_dropped,
+        }
+
+
+def log_prompt_report(user_id: int, report: Dict[str, int]) -> None:
+    """Пишет в лог размер промпта по частям"""
+    logging.info(
+        "Промпт /ask для %s: ~%d/%d токенов (персона %d, контекст %d%s, "
+        "история %d в %d сообщ., выброшено %d, вопрос %d)",
+        user_id, report["total"], report["budget"], report["persona"], report["context"],
+        ", обрезан" if report["context_trimmed"] else "", report["history"],
+        report["history_kept"], report["history_dropped"], report["prompt"],
+    )
+
+
+# Глобальный сборщик промпта
+prompt_budget = PromptBudget()
@@ -0,0 +1,154 @@
+"""
+Фоновое сворачивание истории диалога с ИИ в summary
+
+Принцип разделения ответственности:
+- Только планирование: когда и сколько раз запускать summary для пользователя
+- Сам запрос к модели передаётся снаружи (обработчики/ai.py)
+
+Как устроено:
+- После ответа /ask обработчик сообщает о новых сообщениях (notify) и сразу
+  отвечает пользователю - второй запрос к модели не стоит на пути ответа
+- Для пользователя запускается не больше одной задачи: повторные уведомления
+  лишь увеличивают счётчик новых сообщений (coalescing)
+- Summary строится, когда накопилось N новых сообщений или прошло T секунд
+  с первого из них
+- Число одновременных запросов summary ограничено семафором
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Set
+
+from config import AI_SUMMARY_CONCURRENCY, AI_SUMMARY_DELAY, AI_SUMMARY_EVERY_MESSAGES
+
+# Функция, которая строит и сохраняет summary для пользователя
+SummaryWorker = Callable[[int], Awaitable[None]]
+
+
+class SummaryScheduler:
+    """Отложенный запуск summary с объединением повторных триггеров"""
+
+    def __init__(self, worker: SummaryWorker,
+                 every_messages: int = AI_SUMMARY_EVERY_MESSAGES,
+                 delay: float = AI_SUMMARY_DELAY,
+                 max_concurrency: int = AI_SUMMARY_CONCURRENCY):
+        """
+        Args:
+            worker: Корутина worker(user_id), обновляющая summary
+            every_messages: Сколько новых сообщений запускают summary сразу
+            delay: Через сколько секунд после первого нового сообщения
+                   запустить summary, даже если порог не набран
+            max_concurrency: Максимум одновременно выполняемых summary
+        """
+        self.worker = worker
+        self.every_messages = max(1, every_messages)
+        self.delay = delay
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        # Новые сообщения с последнего summary и время первого из них
+        self._pending: Dict[int, int] = {}
+        self._pending_since: Dict[int, float] = {}
+        # Одна задача на пользователя: ожидание таймера или выполнение
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._running: Set[int] = set()
+        self._closed = False
+
+        # Метрики
+        self._notifications = 0
+        self._coalesced = 0
+        self._runs = 0
+        self._failures = 0
+        self._run_total = 0.0
+
+    def notify(self, user_id: int, new_messages: int = 1) -> None:
+        """Сообщает о новых сообщениях в истории пользователя (не блокирует)"""
+        if self._closed:
+            return
+        self._notifications += 1
+        pending = self._pending.get(user_id, 0) + new_messages
+        self._pending[user_id] = pending
+        self._pending_since.setdefault(user_id, time.monotonic())
+
+        if user_id in self._running:
+            # Идёт summary - после завершения он сам перепланируется
+            self._coalesced += 1
+            return
+
+        task = self._tasks.get(user_id)
+        if task is not None:
+            if pending < self.every_messages:
+                self._coalesced += 1
+                return
+            # Порог набран, пока ждали таймер - запускаем сразу
+            task.cancel()
+        self._schedule(user_id)
+
+    def _schedule(self, user_id: int) -> None:
+        """Создаёт задачу ожидания с задержкой по оставшемуся времени"""
+        if self._pending.get(user_id, 0) >= self.every_messages:
+            wait = 0.0
+        else:
+            elapsed = time.monotonic() - self._pending_since[user_id]
+            wait = max(0.0, self.delay - elapsed)
+        self._tasks[user_id] = asyncio.create_task(self._run_after(user_id, wait))
+
+    async def _run_after(self, user_id: int, wait: float) -> None:
+        """Ждёт, затем строит summary под семафором"""
+        try:
+            if wait:
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # Таймер отменён ради немедленного запуска или остановки
+            if self._tasks.get(user_id) is asyncio.current_task():
+                del self._tasks[user_id]
+            return
+
+        self._running.add(user_id)
+        try:
+            async with self._semaphore:
+                # Сообщения, пришедшие во время запроса, попадут в следующий запуск
+                self._pending.pop(user_id, None)
+                self._pending_since.pop(user_id, None)
+                started = time.perf_counter()
+                try:
+                    await self.worker(user_id)
+                except Exception as exc:  # pylint: disable=broad-except
+                    self._failures += 1
+                    logging.warning("Не удалось обновить summary для %s: %s", user_id, exc)
+                finally:
+                    self._runs += 1
+                    self._run_total += time.perf_counter() - started
+        finally:
+            self._running.discard(user_id)
+            if self._tasks.get(user_id) is asyncio.current_task():
+                del self._tasks[user_id]
+
+        if self._pending.get(user_id) and not self._closed:
+            self._schedule(user_id)
+
+    async def close(self) -> None:
+        """Отменяет ожидающие запуски и дожидается выполняющихся"""
+        self._closed = True
+        waiting = [t for uid, t in self._tasks.items() if uid not in self._running]
+        for task in waiting:
+            task.cancel()
+        tasks = list(self._tasks.values())
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # Задача, отменённая до первого шага, не успевает убрать себя сама
+        self._tasks.clear()
+        logging.info("Планировщик summary остановлен (отменено ожидающих: %d)", len(waiting))
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: уведомления, объединения, запуски, ошибки"""
+        return {
+            "notifications": self._notifications,
+            "coalesced": self._coalesced,
+            "runs": self._runs,
+            "failures": self._failures,
+            "scheduled": len(self._tasks) - len(self._running),
+            "running": len(self._running),
+            "run_avg_ms": (self._run_total / self._runs * 1000) if self._runs else 0.0,
+            "every_messages": self.every_messages,
+            "delay_s": self.delay,
+        }
@@ -0,0 +1,217 @@
+"""
+Кэш скомпилированных тестов (вопросы и ответы материала)
+
+Принцип разделения ответственности:
+- Только компиляция и кэширование тестов материала
+- SQL - в database.py (get_material_test), клавиатуры - в keyboards.py,
+  прохождение теста - в утилиты/test_sessions.py и обработчики/tests.py
+
+Как устроено:
+- Тест компилируется один раз на версию материала: вопросы - объекты
+  со __slots__ и кортежами ответов, индекс правильного ответа посчитан
+  заранее, текст вопроса и клавиатура с ответами собраны заранее
+- Скомпилированный тест не изменяется: все ученики, проходящие тест,
+  ссылаются на один и тот же объект, проверка ответа - сравнение индексов
+- Одновременные промахи по одному материалу ждут одну загрузку из БД
+- Сбрасывается по событиям БД "questions" (добавлен вопрос или ответ)
+  и "material" (материал изменён или удалён); версия материала растёт
+  при тех же изменениях и видна в скомпилированном тесте
+"""
+import asyncio
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+from config import TEST_DEFINITION_CACHE_SIZE
+from .async_database import AsyncDatabase, async_db
+from .keyboards import build_test_answer_keyboard
+
+
+class CompiledQuestion:
+    """Неизменяемый вопрос теста с готовым текстом и клавиатурой"""
+    __slots__ = ("id", "text", "answers", "correct_index", "prompt_html", "keyboard")
+
+    def __init__(self, question_id: int, text: str, answers: Tuple[str, ...], correct_index: int,
+                 prompt_html: str, keyboard: InlineKeyboardMarkup):
+        self.id = question_id
+        self.text = text
+        self.answers = answers
+        # -1, если правильный ответ не указан
+        self.correct_index = correct_index
+        self.prompt_html = prompt_html
+        self.keyboard = keyboard
+
+    @property
+    def correct_text(self) -> str:
+        """Текст правильного ответа"""
+        return self.answers[self.correct_index] if self.correct_index >= 0 else "Не указано"
+
+    def is_correct(self, answer_index: int) -> bool:
+        """Правильный ли выбран ответ"""
+        return answer_index == self.correct_index
+
+
+class CompiledTest:
+    """Неизменяемый тест материала: вопросы по порядку"""
+    __slots__ = ("material_id", "version", "questions", "question_ids")
+
+    def __init__(self, material_id: int, version: int, questions: Tuple[CompiledQuestion, ...]):
+        self.material_id = material_id
+        self.version = version
+        self.questions = questions
+        self.question_ids = tuple(question.id for question in questions)
+
+    def score(self, answers: bytes) -> int:
+        """Число правильных ответов (индексы выбранных ответов по порядку вопросов)"""
+        return sum(1 for question, answer in zip(self.questions, answers)
+                   if answer == question.correct_index)
+
+    def size_bytes(self) -> int:
+        """Примерный размер теста без клавиатур"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.questions) + sys.getsizeof(self.question_ids)
+        for question in self.questions:
+            size += (sys.getsizeof(question) + sys.getsizeof(question.text)
+                     + sys.getsizeof(question.prompt_html) + sys.getsizeof(question.answers)
+                     + sum(sys.getsizeof(answer) for answer in question.answers))
+        return size
+
+
+def compile_test(row: Dict) -> Optional[CompiledTest]:
+    """
+    Компилирует тест из результата get_material_test
+
+    Returns:
+        CompiledTest или None, если у материала нет вопросов
+    """
+    raw_questions = row['questions']
+    if not raw_questions:
+        return None
+    material_id = row['material_id']
+    total = len(raw_questions)
+    questions = []
+    for index, question in enumerate(raw_questions):
+        answers = tuple(answer['answer_text'] for answer in question['answers'])
+        correct_index = next(
+            (i for i, answer in enumerate(question['answers']) if answer['is_correct']), -1
+        )
+        prompt_html = (
+            f"📝 <b>Вопрос {index + 1} из {total}</b>\n\n"
+            f"{question['question_text']}\n\n"
+            f"Выберите правильный ответ:"
+        )
+        questions.append(CompiledQuestion(
+            question['id'], question['question_text'], answers, correct_index,
+            prompt_html, build_test_answer_keyboard(material_id, index, answers),
+        ))
+    return CompiledTest(material_id, row['version'], tuple(questions))
+
+
+class TestDefinitionCache:
+    """LRU-кэш скомпилированных тестов по material_id"""
+
+    def __init__(self, database: AsyncDatabase, max_entries: int = TEST_DEFINITION_CACHE_SIZE):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            max_entries: Сколько материалов держать в памяти
+        """
+        self._db = database
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[int, CompiledTest]" = OrderedDict()
+        # Загрузки, которые сейчас идут: material_id -> future с результатом
+        self._loading: Dict[int, asyncio.Future] = {}
+        # Подписчик БД вызывается из потока-писателя
+        self._lock = threading.Lock()
+        # Растёт при каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._compiled = 0
+        self._invalidations = 0
+
+        database.sync.add_listener(self._on_db_change)
+
+    def _on_db_change(self, event: str, entity_id: Optional[int]) -> None:
+        if event in ("questions", "material"):
+            self.invalidate(entity_id)
+
+    def invalidate(self, material_id: Optional[int] = None) -> None:
+        """Сбрасывает тест материала (или все, если material_id не задан)"""
+        with self._lock:
+            if material_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(material_id, None)
+            self._generation += 1
+            self._invalidations += 1
+
+    async def get(self, material_id: int) -> Optional[CompiledTest]:
+        """Скомпилированный тест материала или None, если вопросов нет"""
+        with self._lock:
+            test = self._entries.get(material_id)
+            if test is not None:
+                self._entries.move_to_end(material_id)
+                self._hits += 1
+                return test
+            self._misses += 1
+            generation = self._generation
+
+        # Вызывается только из цикла событий, поэтому _loading без блокировки
+        pending = self._loading.get(material_id)
+        if pending is not None:
+            self._coalesced += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[material_id] = future
+        try:
+            row = await self._db.get_material_test(material_id)
+            test = compile_test(row) if row else None
+            self._compiled += 1
+        except Exception as exc:
+            future.set_exception(exc)
+            # Исключение уже передано ожидающим, не выводим "never retrieved"
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._loading.pop(material_id, None)
+        future.set_result(test)
+
+        if test is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[material_id] = test
+                    self._entries.move_to_end(material_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        return test
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий и промахов кэша, размер тестов в памяти"""
+        with self._lock:
+            tests = list(self._entries.values())
+            requests = self._hits + self._misses
+            hits, misses = self._hits, self._misses
+        return {
+            "entries": len(tests),
+            "max_entries": self.max_entries,
+            "hits": hits,
+            "misses": misses,
+            "coalesced": self._coalesced,
+            "compiled": self._compiled,
+            "invalidations": self._invalidations,
+            "hit_rate": (hits / requests) if requests else 0.0,
+            "memory_bytes": sum(test.size_bytes() for test in tests),
+        }
+
+
+# Глобальный кэш скомпилированных тестов
+test_definitions = TestDefinitionCache(async_db)
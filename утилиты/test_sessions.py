@@ -0,0 +1,223 @@
+"""
+Хранилище незавершённых тестов
+
+Принцип разделения ответственности:
+- Только состояние прохождения: какой тест, порядок вопросов, выбранные ответы
+- Вопросы - в общем кэше скомпилированных тестов (утилиты/test_definitions.py),
+  SQL - в database.py, сообщения пользователю - в обработчики/tests.py
+
+Как устроено:
+- Запись о тесте компактная: ID материала, кортеж ID вопросов и по байту
+  на выбранный ответ; вопросы и ответы не копируются
+- Каждое изменение сразу пишется в таблицу test_sessions (через
+  поток-писатель), поэтому тест продолжается после перезапуска бота
+- В памяти - LRU на TEST_SESSION_CACHE_SIZE тестов; при промахе запись
+  читается из БД
+- Тест без ответов дольше TEST_SESSION_TTL секунд считается брошенным:
+  при обращении он удаляется, а фоновая задача раз в
+  TEST_SESSION_PURGE_INTERVAL секунд удаляет такие тесты из БД
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from config import TEST_SESSION_CACHE_SIZE, TEST_SESSION_PURGE_INTERVAL, TEST_SESSION_TTL
+from .async_database import AsyncDatabase, async_db
+from .test_definitions import CompiledTest
+
+
+class TestSession:
+    """Незавершённый тест пользователя"""
+    __slots__ = ("user_id", "material_id", "question_ids", "answers", "updated_at")
+
+    def __init__(self, user_id: int, material_id: int, question_ids: Tuple[int, ...],
+                 answers: bytearray, updated_at: float):
+        self.user_id = user_id
+        self.material_id = material_id
+        self.question_ids = question_ids
+        # Индекс выбранного ответа на каждый уже отвеченный вопрос
+        self.answers = answers
+        self.updated_at = updated_at
+
+    @property
+    def current_question(self) -> int:
+        """Индекс вопроса, который ждёт ответа"""
+        return len(self.answers)
+
+    def matches(self, definition: CompiledTest) -> bool:
+        """Не изменились ли вопросы материала с начала теста"""
+        return definition.question_ids == self.question_ids
+
+    def size_bytes(self) -> int:
+        """Сколько памяти занимает запись (без общего скомпилированного теста)"""
+        return (sys.getsizeof(self) + sys.getsizeof(self.question_ids)
+                + sys.getsizeof(self.answers) + sys.getsizeof(self.updated_at))
+
+
+class TestSessionStore:
+    """Незавершённые тесты: LRU в памяти поверх таблицы test_sessions"""
+
+    def __init__(self, database: AsyncDatabase, ttl: float = TEST_SESSION_TTL,
+                 max_entries: int = TEST_SESSION_CACHE_SIZE,
+                 purge_interval: float = TEST_SESSION_PURGE_INTERVAL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            ttl: Через сколько секунд без действий тест удаляется
+            max_entries: Сколько тестов держать в памяти
+            purge_interval: Как часто удалять брошенные тесты из БД, секунд
+        """
+        self._db = database
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.purge_interval = purge_interval
+        self._sessions: "OrderedDict[int, TestSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # Метрики
+        self._started = 0
+        self._resumed = 0
+        self._finished = 0
+        self._expired = 0
+
+    def _remember(self, session: TestSession) -> None:
+        with self._lock:
+            self._sessions[session.user_id] = session
+            self._sessions.move_to_end(session.user_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def _forget(self, user_id: int) -> None:
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    async def _save(self, session: TestSession) -> None:
+        await self._db.save_test_session(
+            session.user_id, session.material_id, list(session.question_ids),
+            bytes(session.answers), session.updated_at,
+        )
+
+    async def start(self, user_id: int, definition: CompiledTest) -> TestSession:
+        """Начинает тест заново (прошлый незавершённый тест заменяется)"""
+        session = TestSession(user_id, definition.material_id, definition.question_ids,
+                              bytearray(), time.time())
+        await self._save(session)
+        self._remember(session)
+        self._started += 1
+        return session
+
+    async def get(self, user_id: int) -> Optional[TestSession]:
+        """Незавершённый тест пользователя или None (брошенный тест удаляется)"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self._sessions.move_to_end(user_id)
+
+        if session is None:
+            row = await self._db.get_test_session(user_id)
+            if row is None:
+                return None
+            with self._lock:
+                # Параллельный запрос мог уже загрузить тест: все работают с одним объектом
+                session = self._sessions.get(user_id)
+            if session is None:
+                session = TestSession(row['user_id'], row['material_id'], tuple(row['question_ids']),
+                                      bytearray(row['answers']), row['updated_at'])
+                self._resumed += 1
+                self._remember(session)
+
+        if time.time() - session.updated_at > self.ttl:
+            self._expired += 1
+            await self.discard(user_id)
+            return None
+        return session
+
+    async def record_answer(self, session: TestSession, question_index: int, answer_index: int) -> bool:
+        """Запоминает ответ на вопрос question_index и сохраняет тест
+
+        Проверка и запись идут без await между ними, поэтому двойное нажатие
+        не запишет два ответа на один вопрос.
+
+        Returns:
+            False, если вопрос уже отвечен (ожидается другой индекс)
+        """
+        if session.current_question != question_index:
+            return False
+        session.answers.append(answer_index)
+        session.updated_at = time.time()
+        await self._save(session)
+        return True
+
+    async def discard(self, user_id: int) -> None:
+        """Удаляет тест (завершён, отменён или брошен)"""
+        self._forget(user_id)
+        await self._db.delete_test_session(user_id)
+
+    async def finish(self, user_id: int) -> None:
+        """Удаляет завершённый тест"""
+        self._finished += 1
+        await self.discard(user_id)
+
+    async def purge_expired(self) -> int:
+        """Удаляет брошенные тесты из памяти и БД
+
+        Returns:
+            Сколько тестов удалено из БД
+        """
+        min_updated_at = time.time() - self.ttl
+        with self._lock:
+            stale = [uid for uid, s in self._sessions.items() if s.updated_at < min_updated_at]
+            for user_id in stale:
+                del self._sessions[user_id]
+        removed = await self._db.delete_expired_test_sessions(min_updated_at)
+        self._expired += removed
+        return removed
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                removed = await self.purge_expired()
+                if removed:
+                    logging.info("Удалено брошенных тестов: %d", removed)
+            except Exception as exc:  # pylint: disable=broad-except
+                logging.warning("Не удалось удалить брошенные тесты: %s", exc)
+
+    def start_purging(self) -> None:
+        """Запускает фоновое удаление брошенных тестов"""
+        if self.purge_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновое удаление (сами тесты уже сохранены в БД)"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: тесты в памяти, их размер, продолжения после перезапуска"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        memory = sum(session.size_bytes() for session in sessions)
+        return {
+            "in_memory": len(sessions),
+            "max_entries": self.max_entries,
+            "memory_bytes": memory,
+            "bytes_per_session": (memory / len(sessions)) if sessions else 0.0,
+            "started": self._started,
+            "resumed": self._resumed,
+            "finished": self._finished,
+            "expired": self._expired,
+            "ttl_s": self.ttl,
+        }
+
+
+# Глобальное хранилище незавершённых тестов
+test_sessions = TestSessionStore(async_db)
@@ -0,0 +1,94 @@
+"""
+Периодический checkpoint WAL-журнала БД
+
+Принцип разделения ответственности:
+- Только расписание и метрики checkpoint
+- Сам PRAGMA wal_checkpoint - в database.py (checkpoint_wal)
+
+Зачем нужен:
+- SQLite сам переносит WAL в основной файл при фиксации транзакции, когда
+  журнал дорастает до 1000 страниц, и эту работу делает запрос бота
+- Пока читатели держат старые снимки, автоматический checkpoint не успевает
+  и журнал растёт, а вместе с ним - время чтения
+- Фоновый PASSIVE checkpoint через поток-писатель не ждёт читателей и
+  держит журнал коротким
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from config import DB_CHECKPOINT_INTERVAL
+from .async_database import AsyncDatabase, async_db
+
+
+class WalCheckpointer:
+    """Фоновая задача PRAGMA wal_checkpoint(PASSIVE)"""
+
+    def __init__(self, database: AsyncDatabase, interval: float = DB_CHECKPOINT_INTERVAL):
+        """
+        Args:
+            database: Асинхронный фасад БД
+            interval: Пауза между checkpoint, секунд (0 - фоновая задача не нужна)
+        """
+        self._db = database
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+        # Метрики
+        self._runs = 0
+        self._busy = 0
+        self._failures = 0
+        self._pages = 0
+        self._duration_max = 0.0
+        self._last: Dict[str, int] = {"busy": 0, "wal_pages": 0, "checkpointed": 0}
+
+    async def run_once(self) -> Dict[str, int]:
+        """Выполняет один checkpoint и обновляет метрики"""
+        started = time.perf_counter()
+        result = await self._db.checkpoint_wal()
+        self._duration_max = max(self._duration_max, time.perf_counter() - started)
+        self._runs += 1
+        self._busy += result["busy"]
+        self._pages += max(0, result["checkpointed"])
+        self._last = result
+        return result
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as exc:  # pylint: disable=broad-except
+                self._failures += 1
+                logging.warning("Не удалось выполнить checkpoint WAL: %s", exc)
+
+    def start(self) -> None:
+        """Запускает фоновую задачу (только в профиле wal и с заданным интервалом)"""
+        if self.interval > 0 and self._db.sync.profile == "wal" and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновую задачу"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        """Возвращает метрики: запуски, занятость, размер журнала"""
+        return {
+            "profile": self._db.sync.profile,
+            "interval_s": self.interval,
+            "runs": self._runs,
+            "busy": self._busy,
+            "failures": self._failures,
+            "pages_checkpointed": self._pages,
+            "last_wal_pages": self._last["wal_pages"],
+            "duration_max_ms": self._duration_max * 1000,
+        }
+
+
+# Глобальный фоновый checkpoint
+wal_checkpointer = WalCheckpointer(async_db)